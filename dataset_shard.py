@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import argparse
+import hashlib
+import threading
+import unicodedata
+from collections import Counter
+
+# 複数のマシンで1つのデータセットを分担して処理するためのシャード分割
+# 画像は --dir_image からの相対パスのハッシュでシャードに割り当てるので、各マシンは連携せずに重複のない部分集合を処理できる
+# （tagger_v3 / VLMキャプショナーからは parse_shard / select_shard / ShardManifest を import して使う）
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.bmp')
+
+def parse_shard(spec):
+    """'K/N'（1 <= K <= N）を (K, N) にする（argparse の type に使う）"""
+    try:
+        k, n = (int(v) for v in spec.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"シャードは K/N の形式で指定してください: {spec}")
+    if not 1 <= k <= n:
+        raise argparse.ArgumentTypeError(f"シャード番号は 1 から N の範囲で指定してください: {spec}")
+    return k, n
+
+def relative_key(path, root):
+    """
+    シャードの割り当てとマニフェストに使う画像の相対パス
+    OSやファイルシステムが違っても同じになるよう、区切り文字を / に、Unicodeを NFC に揃える
+    """
+    if os.path.isfile(root):
+        relative = os.path.basename(path)
+    else:
+        relative = os.path.relpath(path, root)
+    return unicodedata.normalize('NFC', relative.replace(os.sep, '/'))
+
+def shard_of(key, n):
+    """相対パスが属するシャード番号（1 から n）"""
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % n + 1
+
+def select_shard(paths, root, shard):
+    """paths のうち shard（(K, N)、None なら全件）に割り当てられた画像だけを返す"""
+    if shard is None:
+        return list(paths)
+    k, n = shard
+    return [path for path in paths if shard_of(relative_key(path, root), n) == k]
+
+def manifest_path(directory, shard):
+    return os.path.join(directory, f"shard_{shard[0]}_of_{shard[1]}.json")
+
+class ShardManifest:
+    """
+    シャードの処理結果（割り当てられた画像、書き出しが完了した画像、タグの出現回数）を --dir_save に記録する
+    resume=True の場合は同じシャード・同じ key の既存のマニフェストに追記する（出現回数は実行ごとに加算する）
+    """
+
+    def __init__(self, directory, shard, root, key=None, resume=False):
+        self.path = manifest_path(directory, shard)
+        self.shard = shard
+        self.root = root
+        self.key = key
+        self.assigned = set()
+        self.completed = set()
+        self.tag_frequencies = Counter()
+        self.lock = threading.Lock()
+        if resume and os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                previous = json.load(f)
+            if previous['shard'] == f"{shard[0]}/{shard[1]}" and previous['key'] == key:
+                self.completed.update(previous['completed'])
+                self.tag_frequencies.update(previous['tag_frequencies'])
+
+    def assign(self, paths):
+        """このシャードに割り当てられた画像を記録する"""
+        with self.lock:
+            self.assigned.update(relative_key(path, self.root) for path in paths)
+
+    def add(self, path, tags=None):
+        """書き出しが完了した画像と、そのキャプションのタグを記録する"""
+        with self.lock:
+            self.completed.add(relative_key(path, self.root))
+            if tags:
+                self.tag_frequencies.update(tags)
+
+    def save(self):
+        with self.lock:
+            manifest = {
+                'shard': f"{self.shard[0]}/{self.shard[1]}",
+                'key': self.key,
+                'completed': sorted(self.completed),
+                'missing': sorted(self.assigned - self.completed),
+                'tag_frequencies': dict(self.tag_frequencies.most_common()),
+            }
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        return manifest
+
+def list_images(dir_image, recursive=True):
+    """--dir_image の画像を列挙する（recursive=False ならサブディレクトリは見ない。単一ファイルの指定にも対応）"""
+    if os.path.isfile(dir_image):
+        return [dir_image]
+    image_paths = []
+    for root, _, files in os.walk(dir_image):
+        image_paths.extend(os.path.join(root, f) for f in files if f.lower().endswith(IMAGE_EXTENSIONS))
+        if not recursive:
+            break
+    return image_paths
+
+def merge_manifests(manifests, dir_image=None, recursive=True):
+    """
+    全シャードのマニフェストをまとめ、タグの出現回数を合計し、すべての画像がちょうど1回ずつ処理されたかを確かめる
+    dir_image を指定すると、マニフェストに現れない画像も未処理として数える（recursive は処理時の --recursive に合わせる）
+    """
+    shard_counts = {int(m['shard'].split('/')[1]) for m in manifests}
+    if len(shard_counts) != 1:
+        raise ValueError(f"シャード数の異なるマニフェストが混在しています: {sorted(shard_counts)}")
+    n = shard_counts.pop()
+    keys = {m['key'] for m in manifests}
+
+    shards = Counter(int(m['shard'].split('/')[0]) for m in manifests)
+    coverage = Counter()
+    misassigned = []
+    missing = set()
+    tag_frequencies = Counter()
+    for m in manifests:
+        k = int(m['shard'].split('/')[0])
+        coverage.update(m['completed'])
+        misassigned.extend(key for key in m['completed'] if shard_of(key, n) != k)
+        missing.update(m['missing'])
+        tag_frequencies.update(m['tag_frequencies'])
+
+    if dir_image is not None:
+        missing.update(relative_key(path, dir_image) for path in list_images(dir_image, recursive))
+    missing -= coverage.keys()
+
+    return {
+        'shards': n,
+        'keys': sorted(keys, key=str),
+        'missing_shards': [k for k in range(1, n + 1) if k not in shards],
+        'duplicate_shards': sorted(k for k, count in shards.items() if count > 1),
+        'images': len(coverage),
+        'duplicates': sorted(key for key, count in coverage.items() if count > 1),
+        'misassigned': sorted(misassigned),
+        'missing': sorted(missing),
+        'tag_frequencies': dict(tag_frequencies.most_common()),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='複数のマシンで分担したタグ付け・キャプション付けのシャードを扱うツール')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_merge = subparsers.add_parser('merge', help='各シャードのマニフェストをまとめ、すべての画像が1回ずつ処理されたかを確かめる')
+    parser_merge.add_argument('manifests', nargs='+', help='shard_K_of_N.json、またはそれを含むディレクトリ（各マシンの --dir_save）')
+    parser_merge.add_argument('--dir_image', help='元の画像ディレクトリ（指定するとどのマニフェストにも現れない画像も検出する）')
+    parser_merge.add_argument('--recursive', action='store_true', help='--dir_image のサブディレクトリの画像も数える（処理時に --recursive を指定した場合）')
+    parser_merge.add_argument('--output', help='まとめた結果（タグの出現回数を含む）を書き出すJSONファイル')
+    args = parser.parse_args()
+
+    manifest_files = []
+    for path in args.manifests:
+        if os.path.isdir(path):
+            manifest_files.extend(
+                os.path.join(path, f) for f in sorted(os.listdir(path))
+                if f.startswith('shard_') and f.endswith('.json')
+            )
+        elif os.path.isfile(path):
+            manifest_files.append(path)
+        else:
+            print(f"エラー: {path} が存在しません。", file=sys.stderr)
+            sys.exit(1)
+    if not manifest_files:
+        print("エラー: マニフェストが見つかりません。", file=sys.stderr)
+        sys.exit(1)
+
+    manifests = []
+    for path in manifest_files:
+        with open(path, 'r', encoding='utf-8') as f:
+            manifests.append(json.load(f))
+    try:
+        merged = merge_manifests(manifests, args.dir_image, args.recursive)
+    except ValueError as e:
+        print(f"エラー: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(merged, f, ensure_ascii=False, indent=2)
+
+    print(f"{len(manifest_files)} 個のマニフェスト（{merged['shards']} シャード）から {merged['images']} 枚の画像をまとめました。")
+    if len(merged['keys']) > 1:
+        print(f"警告: モデル・設定の異なるシャードが混在しています: {merged['keys']}", file=sys.stderr)
+    problems = [
+        ('マニフェストのないシャード', merged['missing_shards']),
+        ('複数のマニフェストがあるシャード', merged['duplicate_shards']),
+        ('複数のシャードで処理された画像', merged['duplicates']),
+        ('割り当てと異なるシャードで処理された画像', merged['misassigned']),
+        ('処理されていない画像', merged['missing']),
+    ]
+    for label, items in problems:
+        if items:
+            print(f"{label}: {len(items)} 件（例: {items[:5]}）", file=sys.stderr)
+    if any(items for _, items in problems):
+        sys.exit(1)
+    print("すべての画像がちょうど1回ずつ処理されました。")
+
+if __name__ == '__main__':
+    main()
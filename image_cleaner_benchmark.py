@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+import psutil
+
+import image_cleaner_v7
+
+
+def make_synthetic_hashes(n, threshold, duplicate_ratio=0.1, seed=0):
+    """
+    ランダムな64ビットハッシュと、ビット反転で作った近傍重複を生成する
+    戻り値: (ハッシュ配列, 植え込んだ近傍ペア (K, 2))
+    """
+    rng = np.random.default_rng(seed)
+    n_dup = int(n * duplicate_ratio)
+    n_base = n - n_dup
+    hashes = rng.integers(0, np.iinfo(np.uint64).max, n_base, dtype=np.uint64, endpoint=True)
+
+    # 元ハッシュから0〜threshold ビットを反転した重複を作る
+    sources = rng.integers(0, n_base, n_dup)
+    flips = rng.integers(0, threshold + 1, n_dup)
+    dups = hashes[sources].copy()
+    bit_values = np.uint64(1) << np.arange(64, dtype=np.uint64)
+    for k in range(n_dup):
+        bits = rng.choice(64, flips[k], replace=False)
+        dups[k] ^= np.bitwise_or.reduce(bit_values[bits]) if len(bits) else np.uint64(0)
+
+    planted = np.stack([sources, np.arange(n_base, n)], axis=1)
+    return np.concatenate([hashes, dups]), planted
+
+
+def bench_index(args):
+    """MIH索引による全ペア探索のスケーリングと再現率を計測する"""
+    results = []
+    for n in args.sizes:
+        hashes, planted = make_synthetic_hashes(n, args.threshold, args.duplicate_ratio, args.seed)
+
+        start = time.perf_counter()
+        index = image_cleaner_v7.MultiIndexHashIndex(hashes, args.threshold)
+        build_sec = time.perf_counter() - start
+
+        start = time.perf_counter()
+        pairs = index.self_pairs(args.chunk_size)
+        query_sec = time.perf_counter() - start
+
+        # 植え込んだペアが全て見つかっているか（完全一致ハッシュ同士の衝突は除外しない）
+        found = set(map(tuple, np.sort(pairs, axis=1).tolist()))
+        planted_set = set(map(tuple, np.sort(planted, axis=1).tolist()))
+        recall = len(planted_set & found) / len(planted_set) if planted_set else 1.0
+
+        result = {
+            "n": n,
+            "threshold": args.threshold,
+            "substrings": len(index.substrings),
+            "radius": index.radius,
+            "build_sec": round(build_sec, 3),
+            "query_sec": round(query_sec, 3),
+            "hashes_per_sec": round(n / (build_sec + query_sec), 1),
+            "pairs": len(pairs),
+            "planted_recall": recall,
+        }
+
+        # 指定サイズ以下ではタイル分割の総当たりと速度・結果を突き合わせる
+        if n <= args.verify_max:
+            start = time.perf_counter()
+            reference = image_cleaner_v7.find_pairs_bruteforce(hashes, args.threshold, args.max_memory, args.workers)
+            result["bruteforce_sec"] = round(time.perf_counter() - start, 3)
+            result["exact"] = set(map(tuple, reference.tolist())) == found
+
+        print(json.dumps(result, ensure_ascii=False))
+        results.append(result)
+    return results
+
+
+def make_4k_images(directory, count, fmt, seed=0):
+    """ベンチマーク用の4K画像（グラデーション＋ノイズ）を生成する"""
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i in range(count):
+        small = rng.integers(0, 256, (27, 48, 3), dtype=np.uint8)
+        image = cv2.resize(small, (3840, 2160), interpolation=cv2.INTER_CUBIC)
+        image = cv2.add(image, rng.integers(0, 16, image.shape, dtype=np.uint8))
+        path = os.path.join(directory, f"bench_{i:05d}.{fmt}")
+        cv2.imwrite(path, image)
+        paths.append(path)
+    return paths
+
+
+def bench_decode(args):
+    """従来のフルデコード逐次処理と、縮小デコード（逐次・並列）のハッシュ計算速度を比較する"""
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for fmt in args.formats:
+            paths = make_4k_images(os.path.join(work_dir, fmt), args.count, fmt, args.seed)
+
+            # 従来の経路: cv2.imread でフルデコードしてから縮小
+            start = time.perf_counter()
+            for path in paths:
+                image_cleaner_v7.calculate_dhash(cv2.imread(path))
+            full_sec = time.perf_counter() - start
+
+            result = {"format": fmt, "count": len(paths), "full_decode_images_per_sec": round(len(paths) / full_sec, 2)}
+            for workers in sorted({1, args.workers}):
+                cleaner_args = argparse.Namespace(debug=False, mem_cache='OFF', workers=workers)
+                start = time.perf_counter()
+                image_cleaner_v7.compute_image_hashes(paths, cleaner_args, {})
+                elapsed = time.perf_counter() - start
+                result[f"reduced_decode_workers{workers}_images_per_sec"] = round(len(paths) / elapsed, 2)
+
+            print(json.dumps(result, ensure_ascii=False))
+            results.append(result)
+    return results
+
+
+# 合成データセットで作る変形の種類
+VARIANT_KINDS = ['jpeg', 'resize', 'crop', 'brightness']
+
+
+def make_variant(image, kind, args):
+    """元画像から指定した種類の変形画像を作る（jpeg は保存時に圧縮するので画素はそのまま）"""
+    height, width = image.shape[:2]
+    if kind == 'resize':
+        size = (max(1, int(width * args.resize_scale)), max(1, int(height * args.resize_scale)))
+        return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    if kind == 'crop':
+        dy, dx = int(height * args.crop_ratio), int(width * args.crop_ratio)
+        return image[dy:height - dy, dx:width - dx]
+    if kind == 'brightness':
+        return cv2.add(image, np.full(image.shape, args.brightness, dtype=np.uint8))
+    return image
+
+
+def make_labeled_dataset(directory, args):
+    """
+    正解ラベル付きの合成データセットを生成する
+    ランダムな元画像（PNG）ごとに、JPEG再圧縮・縮小・切り抜き・明度変更の変形（JPEG）を作る
+    同じ元画像から作った画像は同じラベルを持ち、これを重複の正解とする
+    戻り値: (パスのリスト, ラベル配列, 変形の種類のリスト)
+    """
+    rng = np.random.default_rng(args.seed)
+    os.makedirs(directory, exist_ok=True)
+    width, height = args.image_size
+    paths, labels, kinds = [], [], []
+    for base in range(args.bases):
+        # 低解像度のノイズを拡大して、元画像同士のdhashがばらつくようにする
+        small = rng.integers(0, 256, (6, 8, 3), dtype=np.uint8)
+        image = cv2.resize(small, (width, height), interpolation=cv2.INTER_CUBIC)
+        image = cv2.add(image, rng.integers(0, 8, image.shape, dtype=np.uint8))
+
+        path = os.path.join(directory, f"base{base:06d}_original.png")
+        cv2.imwrite(path, image)
+        paths.append(path)
+        labels.append(base)
+        kinds.append('original')
+
+        for kind in args.variants:
+            path = os.path.join(directory, f"base{base:06d}_{kind}.jpg")
+            quality = args.jpeg_quality if kind == 'jpeg' else 95
+            cv2.imwrite(path, make_variant(image, kind, args), [cv2.IMWRITE_JPEG_QUALITY, quality])
+            paths.append(path)
+            labels.append(base)
+            kinds.append(kind)
+    return paths, np.array(labels, dtype=np.int64), kinds
+
+
+class PeakRssSampler:
+    """自プロセスと子プロセス（ワーカープール）の合計RSSを一定間隔で測り、最大値を記録する"""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _sample(self):
+        process = psutil.Process()
+        rss = process.memory_info().rss
+        for child in process.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.Error:
+                pass
+        self.peak = max(self.peak, rss)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._sample()
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+
+def run_v4(paths, options):
+    """
+    image_cleaner_v4 を実行する
+    v4 はハッシュ計算と重複判定を同じループで行うため、ハッシュ計算だけを別に1回計測し、
+    重複判定の時間は remove_duplicates 全体の時間との差とする
+    """
+    import image_cleaner_v4
+
+    start = time.perf_counter()
+    for path in paths:
+        image_cleaner_v4.dhash(cv2.imread(path, cv2.IMREAD_GRAYSCALE))
+    hash_sec = time.perf_counter() - start
+
+    cleaner_args = argparse.Namespace(process_group=options.v4_process_group)
+    start = time.perf_counter()
+    duplicates = image_cleaner_v4.remove_duplicates(paths, options.threshold, None, None, True, 'OFF', cleaner_args)
+    group_sec = max(time.perf_counter() - start - hash_sec, 1e-9)
+
+    position = {path: i for i, path in enumerate(paths)}
+    pairs = np.array([(position[a], position[b]) for a, b in duplicates], dtype=np.int64).reshape(-1, 2)
+    return image_cleaner_v7.connected_components(len(paths), pairs), hash_sec, group_sec
+
+
+def run_v7(paths, options, search='index', verify='none'):
+    """image_cleaner_v7 の縮小デコードとペア探索（MIH索引または総当たり、必要なら検証付き）を実行する"""
+    cleaner_args = argparse.Namespace(debug=False, mem_cache='OFF', workers=options.workers)
+    start = time.perf_counter()
+    hashed_paths, hashes = image_cleaner_v7.compute_image_hashes(paths, cleaner_args, {}, desc=None)
+    hash_sec = time.perf_counter() - start
+
+    start = time.perf_counter()
+    groups = image_cleaner_v7.find_similar_groups(
+        hashed_paths, hashes, options.threshold, 1000, search, options.max_memory, options.workers, verify
+    )
+    group_sec = time.perf_counter() - start
+
+    # 読めなかった画像やグループに入らなかった画像は自分だけのラベルにする
+    labels = np.arange(len(paths), dtype=np.int64)
+    position = {path: i for i, path in enumerate(paths)}
+    for group in groups:
+        members = [position[hashed_paths[i]] for i in group]
+        labels[members] = min(members)
+    return labels, hash_sec, group_sec
+
+
+# 計測できるクリーナー（名前: (画像パスのリスト, オプション) -> (各画像のグループラベル, ハッシュ秒, 判定秒)）
+CLEANERS = {
+    'v4': run_v4,
+    'v7': run_v7,
+    'v7_bruteforce': lambda paths, options: run_v7(paths, options, search='bruteforce'),
+    'v7_verify_phash': lambda paths, options: run_v7(paths, options, verify='phash'),
+}
+
+
+def pair_metrics(truth, predicted):
+    """
+    画像ペア単位の適合率・再現率を求める
+    同じ正解ラベルを持つペアを正解の重複とし、同じグループに入れられたペアを検出した重複とする
+    """
+    def count_pairs(labels):
+        _, counts = np.unique(labels, return_counts=True, axis=0)
+        return int((counts * (counts - 1) // 2).sum())
+
+    true_pairs = count_pairs(truth)
+    predicted_pairs = count_pairs(predicted)
+    hit_pairs = count_pairs(np.stack([truth, predicted], axis=1))
+    return {
+        "true_pairs": true_pairs,
+        "predicted_pairs": predicted_pairs,
+        "precision": round(hit_pairs / predicted_pairs, 4) if predicted_pairs else 1.0,
+        "recall": round(hit_pairs / true_pairs, 4) if true_pairs else 1.0,
+    }
+
+
+def _run_cleaner(name, paths, labels, kinds, options):
+    """1つのクリーナーを計測する（ピークRSSを分離するため、別プロセスで呼び出す）"""
+    with PeakRssSampler() as sampler:
+        predicted, hash_sec, group_sec = CLEANERS[name](paths, options)
+
+    n = len(paths)
+    result = {
+        "cleaner": name,
+        "images": n,
+        "threshold": options.threshold,
+        "hash_sec": round(hash_sec, 3),
+        "hash_images_per_sec": round(n / hash_sec, 1),
+        "group_sec": round(group_sec, 3),
+        # 全ペアを調べた場合に相当するペア数で割った、手法によらず比較できる判定速度
+        "group_pairs_per_sec": round(n * (n - 1) / 2 / group_sec, 1),
+        "peak_rss_mb": round(sampler.peak / (1 << 20), 1),
+    }
+    result.update(pair_metrics(labels, predicted))
+
+    # 変形の種類ごとに、元画像と同じグループに入った割合
+    kinds = np.array(kinds)
+    base_label = predicted[np.flatnonzero(kinds == 'original')][labels]
+    result["variant_recall"] = {
+        kind: round(float(np.mean(predicted[kinds == kind] == base_label[kinds == kind])), 4)
+        for kind in VARIANT_KINDS if (kinds == kind).any()
+    }
+    return result
+
+
+def bench_recall(args):
+    """合成データセットで各クリーナーの速度・ピークRSS・適合率・再現率を計測する"""
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        dataset_dir = args.dataset_dir or os.path.join(work_dir, 'dataset')
+        paths, labels, kinds = make_labeled_dataset(dataset_dir, args)
+        print(f"合成データセット: 元画像 {args.bases} 枚、合計 {len(paths)} 枚 ({dataset_dir})")
+
+        # クリーナーごとに新しいプロセスで実行し、前の計測のメモリ使用量が混ざらないようにする
+        context = multiprocessing.get_context('spawn')
+        for name in args.cleaners:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                result = executor.submit(_run_cleaner, name, paths, labels, kinds, args).result()
+            print(json.dumps(result, ensure_ascii=False))
+            results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='image_cleaner のベンチマーク')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_index = subparsers.add_parser('index', help='MIH索引のスケーリングを計測する')
+    parser_index.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000, 2000000], help='ハッシュ数（複数指定可）')
+    parser_index.add_argument('--threshold', type=int, default=10, help='ハミング距離のしきい値（デフォルト: 10）')
+    parser_index.add_argument('--duplicate_ratio', type=float, default=0.1, help='植え込む近傍重複の割合（デフォルト: 0.1）')
+    parser_index.add_argument('--chunk_size', type=int, default=1000, help='一度に問い合わせるハッシュ数（デフォルト: 1000）')
+    parser_index.add_argument('--verify_max', type=int, default=100000, help='総当たりと比較する最大サイズ（デフォルト: 100000）')
+    parser_index.add_argument('--max_memory', type=int, default=512, help='総当たり探索のタイルのメモリ上限（MB、デフォルト: 512）')
+    parser_index.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='総当たり探索のプロセス数（デフォルト: CPUコア数）')
+    parser_index.add_argument('--seed', type=int, default=0, help='乱数シード')
+    parser_index.add_argument('--output', help='結果を書き出すJSONファイル')
+
+    parser_decode = subparsers.add_parser('decode', help='4K画像のハッシュ計算速度を計測する')
+    parser_decode.add_argument('--formats', nargs='+', default=['png', 'jpg'], help='計測する画像形式（デフォルト: png jpg）')
+    parser_decode.add_argument('--count', type=int, default=128, help='形式ごとの画像数（デフォルト: 128）')
+    parser_decode.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='並列ハッシュ計算のプロセス数（デフォルト: CPUコア数）')
+    parser_decode.add_argument('--seed', type=int, default=0, help='乱数シード')
+    parser_decode.add_argument('--output', help='結果を書き出すJSONファイル')
+
+    parser_recall = subparsers.add_parser('recall', help='合成データセットで各クリーナーの速度と精度を計測する')
+    parser_recall.add_argument('--cleaners', nargs='+', choices=list(CLEANERS), default=['v4', 'v7'], help='計測するクリーナー（デフォルト: v4 v7）')
+    parser_recall.add_argument('--bases', type=int, default=500, help='元画像の数（デフォルト: 500）')
+    parser_recall.add_argument('--variants', nargs='+', choices=VARIANT_KINDS, default=VARIANT_KINDS, help='元画像ごとに作る変形（デフォルト: 全て）')
+    parser_recall.add_argument('--image_size', type=int, nargs=2, default=[640, 480], metavar=('WIDTH', 'HEIGHT'), help='元画像のサイズ（デフォルト: 640 480）')
+    parser_recall.add_argument('--jpeg_quality', type=int, default=30, help='jpeg 変形の圧縮品質（デフォルト: 30）')
+    parser_recall.add_argument('--resize_scale', type=float, default=0.5, help='resize 変形の倍率（デフォルト: 0.5）')
+    parser_recall.add_argument('--crop_ratio', type=float, default=0.05, help='crop 変形で各辺から切り落とす割合（デフォルト: 0.05）')
+    parser_recall.add_argument('--brightness', type=int, default=40, help='brightness 変形で加える輝度（デフォルト: 40）')
+    parser_recall.add_argument('--threshold', type=int, default=10, help='ハミング距離のしきい値（デフォルト: 10）')
+    parser_recall.add_argument('--v4_process_group', type=int, default=2, help='v4 の --process_group（デフォルト: 2）')
+    parser_recall.add_argument('--max_memory', type=int, default=512, help='総当たり探索のタイルのメモリ上限（MB、デフォルト: 512）')
+    parser_recall.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='v7 のプロセス数（デフォルト: CPUコア数）')
+    parser_recall.add_argument('--dataset_dir', help='合成データセットの書き出し先（省略時は一時ディレクトリを使い、終了時に削除する）')
+    parser_recall.add_argument('--seed', type=int, default=0, help='乱数シード')
+    parser_recall.add_argument('--output', help='結果を書き出すJSONファイル')
+
+    args = parser.parse_args()
+
+    if args.command == 'index':
+        results = bench_index(args)
+    elif args.command == 'decode':
+        results = bench_decode(args)
+    elif args.command == 'recall':
+        results = bench_recall(args)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
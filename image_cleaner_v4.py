@@ -13,7 +13,8 @@ import shutil
 def dhash(image, hash_size=8):
     resized = cv2.resize(image, (hash_size + 1, hash_size))
     diff = resized[:, 1:] > resized[:, :-1]
-    return sum([2 ** i for (i, v) in enumerate(diff.flatten()) if v])
+    # 差分ビットをまとめてパックして整数化（i番目の差分が 2**i に対応）
+    return int.from_bytes(np.packbits(diff.flatten(), bitorder='little').tobytes(), 'little')
 
 # 安全終了のためのシグナルハンドラ
 def signal_handler(sig, frame):
@@ -93,7 +94,7 @@ def remove_duplicates(image_files, threshold, save_dir, save_dir_duplicate, debu
 
     if debug:
         print("デバッグモードが有効です。ファイルは移動されません。")
-        return
+        return duplicates
 
     ensure_directory(save_dir)
     if save_dir_duplicate:
@@ -9,11 +9,21 @@ import signal
 import gc
 import shutil
 import numpy as np
+from PIL import Image, UnidentifiedImageError
 from collections import defaultdict
 from tqdm import tqdm
 import time
 from pathlib import Path
 import itertools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import math
+import sqlite3
+import subprocess
+
+from image_probe import ProbeCache, probe_images, DEFAULT_PROBE_CACHE_PATH
+from wd14_preprocess import load_image as load_image_for_wd14
+import re
+import json
 
 # シグナルハンドラー設定
 def signal_handler(sig, frame):
@@ -22,8 +32,24 @@ def signal_handler(sig, frame):
 
 signal.signal(signal.SIGINT, signal_handler)
 
-def calculate_dhash(image, hash_size=8):
-    """画像からDifferential Hash（dhash）を計算する"""
+# 並列ハッシュ計算で1タスクにまとめる画像数
+HASH_CHUNK_SIZE = 64
+
+# dhashは出力方法やメモリキャッシュの有無に関わらず、常に1/8の縮小デコードから計算する
+# （同じ画像が実行方法によって別のハッシュにならないように。ハッシュキャッシュにはこの名前で記録する）
+HASH_ALGORITHM = 'dhash_reduced'
+
+# 逐次モードで1度にハッシュ化・判定する画像数
+SEQUENTIAL_CHUNK_SIZE = 1024
+
+# 逐次モードで新しいファイルを待つとき、更新から何秒経ったファイルを書き込み完了とみなすか
+SEQUENTIAL_SETTLE_SEC = 2
+
+# ハッシュキャッシュの既定の保存先
+DEFAULT_HASH_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'data-kitchen', 'image_cleaner_hashes.sqlite')
+
+def resize_for_dhash(image, hash_size=8):
+    """dhash計算用のグレースケールサムネイル（横hash_size+1 x 縦hash_size）を作成する"""
     # グレースケールに変換
     if len(image.shape) == 3:
         gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
@@ -31,17 +57,103 @@ def calculate_dhash(image, hash_size=8):
         gray = image
     
     # リサイズ（横に+1ピクセル）
-    resized = cv2.resize(gray, (hash_size + 1, hash_size))
+    return cv2.resize(gray, (hash_size + 1, hash_size))
+
+def calculate_dhash_batch(thumbnails):
+    """
+    サムネイル配列 (N, hash_size, hash_size+1) からdhashをまとめて計算する
+    ビットの並びは従来どおり「平坦化した差分のi番目 = 2**i」で、結果は shape (N,) の uint64 配列
+    """
+    thumbnails = np.asarray(thumbnails)
+    n = thumbnails.shape[0]
     
-    # 差分を計算
-    diff = resized[:, 1:] > resized[:, :-1]
+    # 差分を計算して (N, 64) のビット列にする
+    bits = (thumbnails[:, :, 1:] > thumbnails[:, :, :-1]).reshape(n, -1)
+    if bits.shape[1] != 64:
+        raise ValueError(f"uint64 に格納できるのは 64 ビット（hash_size=8）のハッシュのみです: {bits.shape[1]} ビット")
     
-    # 2次元配列を1次元に変換し、ビット列に変換
-    return sum([2 ** i for i, v in enumerate(diff.flatten()) if v])
+    # 下位ビットから詰めて8バイトにし、リトルエンディアンのuint64として解釈
+    packed = np.packbits(bits, axis=1, bitorder='little')
+    return packed.view('<u8').reshape(n).astype(np.uint64, copy=False)
+
+def calculate_dhash(image, hash_size=8):
+    """画像からDifferential Hash（dhash）を計算する"""
+    return int(calculate_dhash_batch(resize_for_dhash(image, hash_size)[np.newaxis])[0])
+
+# 0〜255の各値に含まれる1ビットの数（np.bitwise_count が使えない環境用）
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def popcount64(values):
+    """uint64配列の各要素について立っているビット数を数える"""
+    values = np.asarray(values, dtype=np.uint64)
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    # バイト単位の表引きで数えて合計する
+    flat = np.ascontiguousarray(values).reshape(-1)
+    return _POPCOUNT_TABLE[flat.view(np.uint8)].reshape(values.shape + (8,)).sum(axis=-1, dtype=np.uint8)
 
 def hamming_distance(hash1, hash2):
-    """2つのハッシュ値間のハミング距離を計算"""
-    return bin(hash1 ^ hash2).count('1')
+    """2つのハッシュ値（またはuint64配列同士）のハミング距離を計算"""
+    distance = popcount64(np.bitwise_xor(np.asarray(hash1, dtype=np.uint64), np.asarray(hash2, dtype=np.uint64)))
+    return int(distance) if np.ndim(distance) == 0 else distance
+
+def _bruteforce_tile_size(max_memory, workers=1):
+    """
+    総当たり探索のタイル一辺の長さを --max_memory（MB）から決める
+    1要素あたり XOR結果(8B) + ビット数(1B) + 比較結果(1B) の約10Bを、ワーカー数で割った予算に収める
+    """
+    budget = max_memory * 1024 * 1024 // max(1, workers)
+    return max(1, int(math.isqrt(max(1, budget // 10))))
+
+def bruteforce_tile_pairs(hashes, row_start, row_end, col_start, col_end, threshold):
+    """ハッシュ配列の行タイルと列タイルを総当たりで比較し、距離 threshold 以内のペア (i, j)（i < j）を返す"""
+    rows = hashes[row_start:row_end]
+    cols = hashes[col_start:col_end]
+    close_i, close_j = np.nonzero(popcount64(rows[:, np.newaxis] ^ cols[np.newaxis, :]) <= threshold)
+    close_i += row_start
+    close_j += col_start
+    keep = close_j > close_i
+    return np.stack([close_i[keep], close_j[keep]], axis=1).astype(np.int64)
+
+# プロセスプールの各ワーカーが保持するハッシュ配列としきい値
+_bruteforce_state = {}
+
+def _init_bruteforce_worker(hashes, threshold):
+    _bruteforce_state['hashes'] = hashes
+    _bruteforce_state['threshold'] = threshold
+
+def _bruteforce_worker(tile):
+    return bruteforce_tile_pairs(_bruteforce_state['hashes'], *tile, _bruteforce_state['threshold'])
+
+def find_pairs_bruteforce(hashes, threshold, max_memory=512, workers=1, desc=None):
+    """
+    全ペアを総当たりで比較する厳密な探索（MIH索引の検証用・フォールバック用）
+    上三角部分のタイルだけを処理し、workers > 1 ならタイルをプロセスプールに分散する
+    """
+    hashes = np.ascontiguousarray(hashes, dtype=np.uint64)
+    n = len(hashes)
+    tile = _bruteforce_tile_size(max_memory, workers)
+    tiles = [
+        (row, min(row + tile, n), col, min(col + tile, n))
+        for row in range(0, n, tile)
+        for col in range(row, n, tile)
+    ]
+    
+    found = []
+    if workers > 1 and len(tiles) > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_bruteforce_worker, initargs=(hashes, threshold)) as executor:
+            for pairs in tqdm(executor.map(_bruteforce_worker, tiles), total=len(tiles), desc=desc, disable=desc is None):
+                found.append(pairs)
+    else:
+        for row_start, row_end, col_start, col_end in tqdm(tiles, desc=desc, disable=desc is None):
+            found.append(bruteforce_tile_pairs(hashes, row_start, row_end, col_start, col_end, threshold))
+    
+    if not found:
+        return np.empty((0, 2), dtype=np.int64)
+    return np.concatenate(found)
+
+def natural_sort_key(s, _nsre=re.compile('([0-9]+)')):
+    return [int(text) if text.isdigit() else text.lower() for text in re.split(_nsre, str(s))]
 
 def get_image_files(directory, extensions, recursive=False):
     """指定されたディレクトリから対象拡張子の画像ファイルを取得"""
@@ -82,17 +194,69 @@ def get_save_path(src_path, src_dir, save_dir, preserve_structure=False, preserv
     
     return save_path
 
-def save_image(img_path, save_path, cache_images=None, mem_cache="OFF"):
+# Linux の FICLONE ioctl（reflink用）
+FICLONE = 0x40049409
+
+def reflink_file(src_path, save_path):
+    """
+    コピーオンライトでファイルを複製する（Btrfs/XFS/APFSなど）
+    対応していない環境では OSError を送出する
+    """
+    if sys.platform.startswith('linux'):
+        import fcntl
+        with open(src_path, 'rb') as src, open(save_path, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        shutil.copystat(src_path, save_path)
+    elif sys.platform == 'darwin':
+        result = subprocess.run(['cp', '-c', src_path, save_path], capture_output=True)
+        if result.returncode != 0:
+            raise OSError(result.stderr.decode(errors='replace').strip())
+    else:
+        raise OSError(f"{sys.platform} ではreflinkに対応していません")
+
+# コピーへのフォールバックを警告済みの出力モード
+_fallback_warned = set()
+
+def place_file(img_path, save_path, output_mode="copy"):
+    """
+    画素データに触れずにファイルを配置する
+    hardlink/reflink/symlink が使えない場合（別ファイルシステムなど）はコピーにフォールバックする
+    """
+    if output_mode == "move":
+        shutil.move(img_path, save_path)
+        return
+    
+    if output_mode in ("hardlink", "reflink", "symlink"):
+        if os.path.lexists(save_path):
+            os.remove(save_path)
+        try:
+            if output_mode == "hardlink":
+                os.link(img_path, save_path)
+            elif output_mode == "symlink":
+                os.symlink(os.path.abspath(img_path), save_path)
+            else:
+                reflink_file(img_path, save_path)
+            return
+        except OSError as e:
+            if output_mode not in _fallback_warned:
+                print(f"警告: {output_mode} を作成できないためコピーにフォールバックします: {e}")
+                _fallback_warned.add(output_mode)
+    
+    shutil.copy2(img_path, save_path)
+
+def save_image(img_path, save_path, cache_images=None, mem_cache="OFF", output_mode="copy"):
     """画像を保存する関数（リトライ機能付き）"""
-    try:
+    def write():
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
         if mem_cache == "ON" and cache_images and img_path in cache_images:
             # メモリからの保存
-            os.makedirs(os.path.dirname(save_path), exist_ok=True)
             cv2.imwrite(save_path, cache_images[img_path])
         else:
-            # ファイルからコピー
-            os.makedirs(os.path.dirname(save_path), exist_ok=True)
-            shutil.copy2(img_path, save_path)
+            # ファイルを配置（コピー・リンク・移動）
+            place_file(img_path, save_path, output_mode)
+    
+    try:
+        write()
         return True
     except Exception as e:
         print(f"エラー: {img_path} の保存中に例外が発生しました: {e}")
@@ -102,11 +266,7 @@ def save_image(img_path, save_path, cache_images=None, mem_cache="OFF"):
             try:
                 print(f"リトライ {retry+1}/{max_retries}...")
                 time.sleep(1)  # 少し待機
-                os.makedirs(os.path.dirname(save_path), exist_ok=True)
-                if mem_cache == "ON" and cache_images and img_path in cache_images:
-                    cv2.imwrite(save_path, cache_images[img_path])
-                else:
-                    shutil.copy2(img_path, save_path)
+                write()
                 print("リトライ成功")
                 return True
             except Exception as e:
@@ -115,73 +275,322 @@ def save_image(img_path, save_path, cache_images=None, mem_cache="OFF"):
                     print(f"{img_path} の保存をスキップします。")
                     return False
 
-def find_similar_images(image_hashes, threshold, process_group_size):
+def _flip_masks(width, radius):
+    """width ビット中 radius 個以下のビットを反転させるマスクを全て列挙する"""
+    masks = [0]
+    for r in range(1, radius + 1):
+        for bits in itertools.combinations(range(width), r):
+            masks.append(sum(1 << b for b in bits))
+    return np.array(masks, dtype=np.uint64)
+
+def choose_num_substrings(n, threshold, bits=64):
     """
-    類似画像を見つけてグループ化する
-    連結成分アルゴリズムを使用
+    MIHの分割数を簡単なコストモデルで決める
+    クエリ1件あたり「分割数 x 探索マスク数 x (1 + 偶然一致する候補の期待数)」が最小になるものを選ぶ
     """
-    # 各画像をグループIDにマッピング
-    image_to_group = {}
-    # 各グループIDに属する画像のリスト
-    groups = defaultdict(list)
-    next_group_id = 0
+    best_m, best_cost = 1, None
+    for m in range(1, min(threshold + 1, bits) + 1):
+        width = -(-bits // m)
+        radius = threshold // m
+        probes = sum(math.comb(width, r) for r in range(radius + 1))
+        if probes > 1_000_000:
+            continue
+        cost = m * probes * (1 + n / float(2 ** width))
+        if best_cost is None or cost < best_cost:
+            best_m, best_cost = m, cost
+    return best_m
+
+class MultiIndexHashIndex:
+    """
+    64ビットハッシュのマルチインデックスハッシング（MIH）索引
+    ハッシュを m 個の部分ビット列に分割してそれぞれバケット化する。
+    距離 threshold 以内のペアは、鳩の巣原理によりどれか1つの部分ビット列で
+    距離 threshold // m 以内になるため、その範囲だけを探索すれば取りこぼしなく（厳密に）列挙できる。
+    """
+
+    # 部分ビット列の幅がこれ以下なら、ソート済み配列の二分探索ではなく密なオフセット表で引く
+    # （ただし表の大きさが要素数の DENSE_TABLE_RATIO 倍を超える場合は二分探索にする）
+    DENSE_TABLE_BITS = 22
+    DENSE_TABLE_RATIO = 4
+
+    def __init__(self, hashes, threshold, num_substrings=None, tables=None):
+        self.hashes = hashes if tables is not None else np.ascontiguousarray(hashes, dtype=np.uint64)
+        m = num_substrings or choose_num_substrings(len(self.hashes), threshold)
+        
+        # 64ビットをできるだけ均等な m 個に分割（シフト量と幅）
+        base, extra = divmod(64, m)
+        self.substrings = []
+        shift = 0
+        for k in range(m):
+            width = base + (1 if k < extra else 0)
+            self.substrings.append((shift, width))
+            shift += width
+        
+        if tables is not None:
+            # 保存済みの表（メモリマップ）をそのまま使う
+            self.tables = tables
+            self.set_threshold(threshold)
+            return
+        
+        self.tables = []
+        for shift, width in self.substrings:
+            keys = self._substring(self.hashes, shift, width)
+            order = np.argsort(keys, kind='stable')
+            sorted_keys = keys[order]
+            if width <= self.DENSE_TABLE_BITS and 2 ** width <= self.DENSE_TABLE_RATIO * max(1, len(keys)):
+                # starts[k] から counts[k] 個がキー k のバケット（キャッシュ効率のため32ビット整数で持つ）
+                counts = np.bincount(sorted_keys.astype(np.intp), minlength=2 ** width).astype(np.int32)
+                starts = (np.cumsum(counts, dtype=np.int64) - counts).astype(np.int32 if len(keys) < 2 ** 31 else np.int64)
+                self.tables.append((order, None, (starts, counts)))
+            else:
+                self.tables.append((order, sorted_keys, None))
+        self.set_threshold(threshold)
+
+    def set_threshold(self, threshold):
+        """
+        探索するしきい値を変更する（表は作り直さない）
+        分割数 m を固定したままでも、鳩の巣原理により半径 threshold // m の探索で厳密に列挙できる
+        """
+        self.threshold = threshold
+        self.radius = threshold // len(self.substrings)
+        self.masks = [_flip_masks(width, self.radius) for _, width in self.substrings]
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def save(self, prefix):
+        """索引を prefix で始まる .npy ファイル群に保存する"""
+        np.save(f"{prefix}.hashes.npy", self.hashes)
+        for k, (order, sorted_keys, dense) in enumerate(self.tables):
+            np.save(f"{prefix}.sub{k}.order.npy", order)
+            if dense is not None:
+                np.save(f"{prefix}.sub{k}.starts.npy", dense[0])
+                np.save(f"{prefix}.sub{k}.counts.npy", dense[1])
+            else:
+                np.save(f"{prefix}.sub{k}.keys.npy", sorted_keys)
+
+    @classmethod
+    def load(cls, prefix, num_substrings, threshold, mmap_mode='r'):
+        """save で保存した索引をメモリマップで読み込む"""
+        hashes = np.load(f"{prefix}.hashes.npy", mmap_mode=mmap_mode)
+        tables = []
+        for k in range(num_substrings):
+            order = np.load(f"{prefix}.sub{k}.order.npy", mmap_mode=mmap_mode)
+            if os.path.exists(f"{prefix}.sub{k}.starts.npy"):
+                dense = (np.load(f"{prefix}.sub{k}.starts.npy", mmap_mode=mmap_mode),
+                         np.load(f"{prefix}.sub{k}.counts.npy", mmap_mode=mmap_mode))
+                tables.append((order, None, dense))
+            else:
+                tables.append((order, np.load(f"{prefix}.sub{k}.keys.npy", mmap_mode=mmap_mode), None))
+        return cls(hashes, threshold, num_substrings, tables=tables)
+
+    def files(self, prefix):
+        """save が作成するファイルのパス一覧"""
+        paths = [f"{prefix}.hashes.npy"]
+        for k, (_, _, dense) in enumerate(self.tables):
+            paths.append(f"{prefix}.sub{k}.order.npy")
+            if dense is not None:
+                paths += [f"{prefix}.sub{k}.starts.npy", f"{prefix}.sub{k}.counts.npy"]
+            else:
+                paths.append(f"{prefix}.sub{k}.keys.npy")
+        return paths
+
+    @staticmethod
+    def _substring(hashes, shift, width):
+        mask = np.uint64((1 << width) - 1)
+        return (hashes >> np.uint64(shift)) & mask
+
+    def _candidates(self, query_hashes):
+        """各部分ビット列のバケットを探索し、(クエリ番号, 索引内番号) の候補ペアを返す"""
+        for (shift, width), (order, sorted_keys, dense), masks in zip(self.substrings, self.tables, self.masks):
+            n_masks = len(masks)
+            if dense is not None:
+                # 密な表の場合は32ビット整数のまま引く
+                starts, counts_table = dense
+                keys = (self._substring(query_hashes, shift, width).astype(np.uint32)[:, np.newaxis]
+                        ^ masks.astype(np.uint32)[np.newaxis, :]).ravel()
+                counts = counts_table[keys]
+                hits = np.flatnonzero(counts)
+                counts = counts[hits]
+                lo = starts[keys[hits]]
+            else:
+                keys = (self._substring(query_hashes, shift, width)[:, np.newaxis] ^ masks[np.newaxis, :]).ravel()
+                lo = np.searchsorted(sorted_keys, keys, side='left')
+                counts = np.searchsorted(sorted_keys, keys, side='right') - lo
+                hits = np.flatnonzero(counts)
+                counts = counts[hits]
+                lo = lo[hits]
+            if len(hits) == 0:
+                continue
+            
+            # 空でないバケットだけを展開して候補を作る
+            query_idx = hits // n_masks
+            if counts.max() == 1:
+                yield query_idx, order[lo]
+                continue
+            total = int(counts.sum())
+            owner = np.repeat(np.arange(len(hits)), counts)
+            offsets = np.arange(total) - (np.cumsum(counts) - counts)[owner]
+            yield query_idx[owner], order[lo[owner] + offsets]
+
+    def query(self, query_hashes):
+        """
+        クエリハッシュ群に対して距離 threshold 以内の索引内要素を全て返す
+        戻り値: (クエリ番号配列, 索引内番号配列)（重複なし）
+        """
+        query_hashes = np.ascontiguousarray(query_hashes, dtype=np.uint64)
+        found_q, found_i = [], []
+        for query_idx, index_idx in self._candidates(query_hashes):
+            close = popcount64(query_hashes[query_idx] ^ self.hashes[index_idx]) <= self.threshold
+            found_q.append(query_idx[close])
+            found_i.append(index_idx[close])
+        if not found_q:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        
+        # 複数の部分ビット列で見つかったペアを1つにまとめる
+        pair_keys = np.unique(np.concatenate(found_q).astype(np.int64) * len(self.hashes) + np.concatenate(found_i))
+        return pair_keys // len(self.hashes), pair_keys % len(self.hashes)
+
+    def self_pairs(self, chunk_size=1000, desc=None):
+        """索引内の全ペア (i, j)（i < j）のうち距離 threshold 以内のものを返す"""
+        n = len(self.hashes)
+        chunk_size = max(1, chunk_size)
+        found = []
+        for start in tqdm(range(0, n, chunk_size), desc=desc, disable=desc is None):
+            query_idx, index_idx = self.query(self.hashes[start:start + chunk_size])
+            query_idx = query_idx + start
+            keep = index_idx > query_idx
+            found.append(np.stack([query_idx[keep], index_idx[keep]], axis=1))
+        if not found:
+            return np.empty((0, 2), dtype=np.int64)
+        return np.concatenate(found)
+
+def connected_components(n, pairs):
+    """
+    ペア配列 (K, 2) から連結成分を求める
+    戻り値: 各要素のラベル（その成分に属する最小のインデックス）
+    """
+    labels = np.arange(n, dtype=np.int64)
+    if len(pairs) == 0:
+        return labels
+    left, right = pairs[:, 0], pairs[:, 1]
+    while True:
+        # 各辺の両端の代表を小さい方へ付け替える
+        root_l, root_r = labels[left], labels[right]
+        lower = np.minimum(root_l, root_r)
+        new_labels = labels.copy()
+        np.minimum.at(new_labels, root_l, lower)
+        np.minimum.at(new_labels, root_r, lower)
+        # ポインタジャンプで代表を根まで圧縮
+        while True:
+            jumped = new_labels[new_labels]
+            if np.array_equal(jumped, new_labels):
+                break
+            new_labels = jumped
+        if np.array_equal(new_labels, labels):
+            return labels
+        labels = new_labels
+
+def groups_from_labels(labels):
+    """連結成分ラベルから2要素以上のグループ（元の順序を保ったインデックス配列）のリストを作る"""
+    order = np.argsort(labels, kind='stable')
+    sorted_labels = labels[order]
+    boundaries = np.flatnonzero(np.diff(sorted_labels)) + 1
+    groups = [g for g in np.split(order, boundaries) if len(g) > 1]
+    groups.sort(key=lambda g: g[0])
+    return groups
+
+def expand_hash_pairs(pairs, inverse):
+    """
+    ユニークハッシュ単位のペアを画像単位のペア (i, j)（i < j）に展開する
+    同じハッシュを持つ画像同士の組み合わせも含める
+    """
+    order = np.argsort(inverse, kind='stable')
+    counts = np.bincount(inverse)
+    starts = np.cumsum(counts) - counts
+    found = []
+    
+    # 異なるハッシュ同士: 各ペアのメンバーの直積
+    if len(pairs):
+        left, right = pairs[:, 0], pairs[:, 1]
+        count_l, count_r = counts[left], counts[right]
+        sizes = count_l * count_r
+        owner = np.repeat(np.arange(len(pairs)), sizes)
+        offsets = np.arange(int(sizes.sum())) - (np.cumsum(sizes) - sizes)[owner]
+        found.append(np.stack([
+            order[starts[left[owner]] + offsets // count_r[owner]],
+            order[starts[right[owner]] + offsets % count_r[owner]],
+        ], axis=1))
     
-    files_list = list(image_hashes.keys())
-    n = len(files_list)
+    # 同じハッシュ同士: メンバー数ごとにまとめて上三角の組み合わせを作る
+    for size in np.unique(counts[counts > 1]):
+        buckets = np.flatnonzero(counts == size)
+        members = order[starts[buckets][:, np.newaxis] + np.arange(size)]
+        tri_i, tri_j = np.triu_indices(size, 1)
+        found.append(np.stack([members[:, tri_i].ravel(), members[:, tri_j].ravel()], axis=1))
     
+    if not found:
+        return np.empty((0, 2), dtype=np.int64)
+    return np.sort(np.concatenate(found).astype(np.int64), axis=1)
+
+def find_similar_pairs(hashes, threshold, search='index', process_group_size=1000, max_memory=512, workers=1):
+    """
+    ハッシュ配列から距離 threshold 以内の全ペア (i, j)（i < j）を列挙する
+    search='index' はMIH索引、search='bruteforce' はタイル分割した総当たり
+    """
+    if search == 'bruteforce':
+        return find_pairs_bruteforce(hashes, threshold, max_memory, workers, desc="類似ペアの探索（総当たり）")
+    index = MultiIndexHashIndex(hashes, threshold)
+    return index.self_pairs(process_group_size, desc="類似ペアの探索")
+
+def similarity_graph(image_paths, image_hashes, threshold, process_group_size, search='index', max_memory=512, workers=1,
+                     verify='none', verify_threshold=None, hash_cache=None):
+    """
+    類似画像のグラフを作る
+    image_paths と image_hashes（uint64配列）は同じ順序で対応している
+    距離 threshold 以内の全ペアを厳密に列挙する。完全一致するハッシュは1つの頂点にまとめる
+    verify が 'none' 以外なら、dhashのペアを候補として画像単位に展開し、verify の特徴量で検証したペアだけを残す
+    戻り値: (頂点数, 頂点ペア配列 (K, 2), 各画像の頂点番号の配列)
+    """
+    n = len(image_paths)
     print(f"画像ペアの類似性を判定中... 合計 {n} 枚の画像")
     
-    # 処理ブロックに分割
-    block_size = min(process_group_size, n)
+    # 完全一致するハッシュは先に1つにまとめる（同一フレームが大量にある場合のペア数爆発を防ぐ）
+    unique_hashes, inverse = np.unique(np.asarray(image_hashes, dtype=np.uint64), return_inverse=True)
+    inverse = inverse.reshape(-1)
     
-    for i in tqdm(range(0, n, block_size), desc="ブロック処理"):
-        block_end = min(i + block_size, n)
-        block_files = files_list[i:block_end]
-        
-        # ブロック内の画像ペアを比較
-        for img1, img2 in itertools.combinations(block_files, 2):
-            hash1 = image_hashes[img1]
-            hash2 = image_hashes[img2]
-            
-            distance = hamming_distance(hash1, hash2)
-            
-            if distance <= threshold:
-                # 両方の画像がすでにグループに属しているかチェック
-                if img1 in image_to_group and img2 in image_to_group:
-                    if image_to_group[img1] != image_to_group[img2]:
-                        # 異なるグループを結合
-                        g1 = image_to_group[img1]
-                        g2 = image_to_group[img2]
-                        
-                        # g2のすべての画像をg1に移動
-                        for img in groups[g2]:
-                            image_to_group[img] = g1
-                            groups[g1].append(img)
-                        
-                        # g2を削除
-                        groups.pop(g2)
-                
-                # img1がグループに属しているが、img2は属していない場合
-                elif img1 in image_to_group:
-                    g = image_to_group[img1]
-                    image_to_group[img2] = g
-                    groups[g].append(img2)
-                
-                # img2がグループに属しているが、img1は属していない場合
-                elif img2 in image_to_group:
-                    g = image_to_group[img2]
-                    image_to_group[img1] = g
-                    groups[g].append(img1)
-                
-                # 両方ともグループに属していない場合、新しいグループを作成
-                else:
-                    image_to_group[img1] = next_group_id
-                    image_to_group[img2] = next_group_id
-                    groups[next_group_id] = [img1, img2]
-                    next_group_id += 1
+    pairs = find_similar_pairs(unique_hashes, threshold, search, process_group_size, max_memory, workers)
     
-    # 単一画像のグループを除外
-    similar_groups = [group for group in groups.values() if len(group) > 1]
+    if verify != 'none':
+        # 候補ペアを画像単位に展開し、高価な特徴量で検証したペアだけを頂点ペアにする
+        candidates = expand_hash_pairs(pairs, inverse)
+        verified = verify_candidate_pairs(image_paths, candidates, verify, verify_threshold, workers, hash_cache)
+        return n, verified, np.arange(n)
+    return len(unique_hashes), pairs, inverse
+
+def find_similar_groups(image_paths, image_hashes, threshold, process_group_size, search='index', max_memory=512, workers=1,
+                        verify='none', verify_threshold=None, hash_cache=None):
+    """
+    類似画像を見つけてグループ化する（similarity_graph の連結成分を画像単位に展開する）
+    戻り値: 2枚以上のグループ（画像インデックスの配列）のリスト
+    """
+    n_nodes, pairs, node_of_image = similarity_graph(
+        image_paths, image_hashes, threshold, process_group_size, search, max_memory, workers,
+        verify, verify_threshold, hash_cache
+    )
+    return groups_from_labels(connected_components(n_nodes, pairs)[node_of_image])
+
+def find_similar_images(image_paths, image_hashes, threshold, process_group_size, search='index', max_memory=512, workers=1,
+                        verify='none', verify_threshold=None, hash_cache=None):
+    """
+    類似画像を見つけてグループ化する（find_similar_groups の結果をパスで返す）
+    戻り値: (パスのリストのグループのリスト, グループに含まれる画像パスのセット)
+    """
+    groups = find_similar_groups(
+        image_paths, image_hashes, threshold, process_group_size, search, max_memory, workers,
+        verify, verify_threshold, hash_cache
+    )
+    similar_groups = [[image_paths[i] for i in group] for group in groups]
     
     # 処理された画像のセットを取得
     processed_images = set()
@@ -190,6 +599,1232 @@ def find_similar_images(image_hashes, threshold, process_group_size):
     
     return similar_groups, processed_images
 
+class HashCache:
+    """
+    画像ハッシュの永続キャッシュ（SQLite）
+    (絶対パス, ファイルサイズ, mtime_ns, hash_size, アルゴリズム) が一致する場合だけ保存済みの値を再利用する
+    """
+
+    def __init__(self, db_path, rebuild=False):
+        db_dir = os.path.dirname(os.path.abspath(db_path))
+        create_directory(db_dir)
+        self.db_path = db_path
+        self.rebuild = rebuild
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS hashes ('
+            'path TEXT NOT NULL, algorithm TEXT NOT NULL, hash_size INTEGER NOT NULL, '
+            'size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, value BLOB NOT NULL, '
+            'PRIMARY KEY (path, algorithm, hash_size))'
+        )
+        self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def file_key(path):
+        """キャッシュの照合に使う (絶対パス, サイズ, mtime_ns) を返す（取得できない場合は None）"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return os.path.abspath(path), st.st_size, st.st_mtime_ns
+
+    def lookup(self, keys, algorithm, hash_size):
+        """
+        file_key のリストに対応する保存済みの値（bytes）を返す
+        見つからない・ファイルが更新されている場合は None
+        """
+        values = [None] * len(keys)
+        if not self.rebuild:
+            positions = {key[0]: i for i, key in enumerate(keys) if key is not None}
+            paths = list(positions)
+            # SQLiteのプレースホルダ数の上限に収まるよう分割して問い合わせる
+            for start in range(0, len(paths), 900):
+                chunk = paths[start:start + 900]
+                rows = self.conn.execute(
+                    f'SELECT path, size, mtime_ns, value FROM hashes WHERE algorithm = ? AND hash_size = ? '
+                    f'AND path IN ({",".join("?" * len(chunk))})',
+                    [algorithm, hash_size] + chunk,
+                )
+                for path, size, mtime_ns, value in rows:
+                    i = positions[path]
+                    if keys[i][1] == size and keys[i][2] == mtime_ns:
+                        values[i] = value
+        hit_count = sum(value is not None for value in values)
+        self.hits += hit_count
+        self.misses += len(values) - hit_count
+        return values
+
+    def store(self, entries, algorithm, hash_size):
+        """(file_key, 値のbytes) のリストを保存（既存の行は置き換える）"""
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO hashes (path, algorithm, hash_size, size, mtime_ns, value) VALUES (?, ?, ?, ?, ?, ?)',
+            [(key[0], algorithm, hash_size, key[1], key[2], value) for key, value in entries if key is not None],
+        )
+        self.conn.commit()
+
+    def stats_line(self):
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0.0
+        return f"ハッシュキャッシュ: {self.hits}/{total} 件ヒット（ヒット率 {rate:.1f}%）"
+
+    def close(self):
+        self.conn.close()
+
+class ReferenceIndex:
+    """
+    整理済みデータセットのハッシュ索引（ディスクに永続化し、追記できる）
+    MIH索引をセグメント単位で .npy に保存してメモリマップで読み込み、新しい画像は新しいセグメントとして追記する
+    大きさの近いセグメント同士を併合するため、セグメント数は O(log N) に保たれ、
+    1回の実行の照合・追記のコストは新しい画像の数にほぼ比例する
+    meta.json にはハッシュの計算方法を記録し、異なる方法で作成された索引は読み込まない
+    """
+
+    META_FILE = 'meta.json'
+    PATHS_FILE = 'paths.txt'
+
+    def __init__(self, directory, threshold):
+        self.directory = directory
+        self.threshold = threshold
+        create_directory(directory)
+        meta_path = os.path.join(directory, self.META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                self.meta = json.load(f)
+            algorithm = self.meta.get('algorithm')
+            if algorithm is None:
+                # 計算方法を記録していなかった索引は、フル解像度から計算したハッシュが混在している可能性がある
+                print(f"警告: 索引 {directory} にはハッシュの計算方法が記録されていません。照合結果が不正確な場合は --build_reference で作り直してください。")
+                self.meta['algorithm'] = HASH_ALGORITHM
+            elif algorithm != HASH_ALGORITHM:
+                raise ValueError(
+                    f"索引 {directory} のハッシュの計算方法（{algorithm}）がこのバージョン（{HASH_ALGORITHM}）と異なります。"
+                    "別のディレクトリに --build_reference で作り直してください。"
+                )
+        else:
+            # 分割数は索引が育った後の規模（100万枚）を想定して作成時に固定する
+            self.meta = {
+                'algorithm': HASH_ALGORITHM,
+                'num_substrings': choose_num_substrings(1_000_000, threshold),
+                'count': 0,
+                'next_segment': 0,
+                'segments': [],
+            }
+        self.segments = [self._load_segment(segment) for segment in self.meta['segments']]
+
+    def __len__(self):
+        return self.meta['count']
+
+    def _prefix(self, segment):
+        return os.path.join(self.directory, segment['name'])
+
+    def _load_segment(self, segment):
+        return MultiIndexHashIndex.load(self._prefix(segment), self.meta['num_substrings'], self.threshold)
+
+    def _write_meta(self):
+        # 途中で中断しても壊れないよう一時ファイルに書いてから置き換える
+        meta_path = os.path.join(self.directory, self.META_FILE)
+        with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.meta, f, ensure_ascii=False, indent=2)
+        os.replace(meta_path + '.tmp', meta_path)
+
+    def match(self, query_hashes, chunk_size=1000):
+        """
+        各クエリハッシュについて、索引内に距離 threshold 以内のハッシュがあるかを調べる
+        戻り値: 一致した索引内の通し番号の配列（一致しない場合は -1）
+        """
+        query_hashes = np.ascontiguousarray(query_hashes, dtype=np.uint64)
+        matched = np.full(len(query_hashes), -1, dtype=np.int64)
+        for segment, index in zip(self.meta['segments'], self.segments):
+            for start in range(0, len(query_hashes), chunk_size):
+                query_idx, index_idx = index.query(query_hashes[start:start + chunk_size])
+                # 最初に見つかった一致だけを記録する
+                query_idx = query_idx + start
+                first = matched[query_idx] < 0
+                matched[query_idx[first]] = index_idx[first] + segment['start']
+        return matched
+
+    def paths(self):
+        """索引内の通し番号順の画像パス一覧"""
+        paths_file = os.path.join(self.directory, self.PATHS_FILE)
+        if not os.path.exists(paths_file):
+            return []
+        with open(paths_file, 'r', encoding='utf-8') as f:
+            return f.read().splitlines()
+
+    def append(self, hashes, paths):
+        """新しい画像のハッシュとパスを新しいセグメントとして追記する"""
+        hashes = np.ascontiguousarray(hashes, dtype=np.uint64)
+        if len(hashes) == 0:
+            return
+        with open(os.path.join(self.directory, self.PATHS_FILE), 'a', encoding='utf-8') as f:
+            for path in paths:
+                f.write(f"{path}\n")
+        self._add_segment(hashes, self.meta['count'])
+        self.meta['count'] += len(hashes)
+        
+        # 新しいセグメントが1つ前のセグメントの半分以上になったら併合する
+        while len(self.segments) >= 2 and self.meta['segments'][-1]['count'] * 2 >= self.meta['segments'][-2]['count']:
+            merged = np.concatenate([np.asarray(self.segments[-2].hashes), np.asarray(self.segments[-1].hashes)])
+            start = self.meta['segments'][-2]['start']
+            old_files = []
+            for _ in range(2):
+                segment, index = self.meta['segments'].pop(), self.segments.pop()
+                old_files += index.files(self._prefix(segment))
+            # メモリマップを閉じてから古いセグメントを削除する（Windowsでは開いたままだと削除できない）
+            del index
+            gc.collect()
+            self._add_segment(merged, start)
+            for path in old_files:
+                os.remove(path)
+        self._write_meta()
+
+    def _add_segment(self, hashes, start):
+        segment = {'name': f"seg{self.meta['next_segment']:06d}", 'start': start, 'count': len(hashes)}
+        self.meta['next_segment'] += 1
+        index = MultiIndexHashIndex(hashes, self.threshold, self.meta['num_substrings'])
+        index.save(self._prefix(segment))
+        self.meta['segments'].append(segment)
+        self.segments.append(self._load_segment(segment))
+
+def load_image_for_hash(img_path):
+    """ハッシュ計算用に画像を読み込む（読み込めない場合は None、例外時は3回までリトライ）"""
+    try:
+        return cv2.imread(img_path)
+    except Exception as e:
+        print(f"エラー: {img_path} の処理中に例外が発生しました: {e}")
+        # リトライ処理
+        max_retries = 3
+        for retry in range(max_retries):
+            try:
+                print(f"リトライ {retry+1}/{max_retries}...")
+                time.sleep(1)  # 少し待機
+                image = cv2.imread(img_path)
+                print("リトライ成功")
+                return image
+            except Exception as e:
+                print(f"リトライ失敗: {e}")
+                if retry == max_retries - 1:
+                    print(f"{img_path} の処理をスキップします。")
+        return None
+
+def load_reduced_gray(img_path):
+    """
+    1/8に縮小デコードしたグレースケール画像を返す
+    JPEGはOpenCV/PillowともにDCT段階で縮小して読み込まれる
+    どちらでも読めない場合は None を返す
+    """
+    image = cv2.imread(img_path, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if image is None:
+        # OpenCVで読めない形式はPillowのdraftで縮小デコードする
+        try:
+            with Image.open(img_path) as img:
+                img.draft('L', (max(1, img.width // 8), max(1, img.height // 8)))
+                image = np.asarray(img.convert('L'))
+        except UnidentifiedImageError:
+            return None
+    return image
+
+def load_reduced_thumbnail(img_path, hash_size=8):
+    """縮小デコードでdhash用サムネイルを作成する（dhashはフル解像度を必要としないため）"""
+    image = load_reduced_gray(img_path)
+    if image is None:
+        return None
+    return resize_for_dhash(image, hash_size)
+
+def _hash_worker(img_paths):
+    """プロセスプール用: パスのチャンクを縮小デコードしてサムネイル配列と成否を返す"""
+    thumbnails = np.zeros((len(img_paths), 8, 9), dtype=np.uint8)
+    decoded = np.zeros(len(img_paths), dtype=bool)
+    for k, img_path in enumerate(img_paths):
+        max_retries = 3
+        for retry in range(max_retries + 1):
+            try:
+                thumbnail = load_reduced_thumbnail(img_path)
+                if thumbnail is None:
+                    print(f"警告: {img_path} を読み込めませんでした。スキップします。")
+                else:
+                    thumbnails[k] = thumbnail
+                    decoded[k] = True
+                break
+            except Exception as e:
+                if retry == max_retries:
+                    print(f"エラー: {img_path} の処理中に例外が発生しました: {e}。スキップします。")
+                else:
+                    time.sleep(1)  # 少し待機してリトライ
+    return thumbnails, decoded
+
+def uses_image_cache(args):
+    """
+    デコードしたフル解像度の画像をメモリに保持して保存に使うか
+    --mem_cache ON でも、コピーで画像を実際に保存する場合（計画ファイルの書き出し・索引の作成を除く）にしか使わない
+    """
+    return args.mem_cache == "ON" and args.output_mode == "copy" and not args.plan and not args.build_reference
+
+def compute_image_hashes(image_files, args, cache_images, hash_cache=None, desc="ハッシュ値の計算"):
+    """
+    画像ファイルのdhashを計算する
+    hash_cache があれば未変更のファイルは保存済みの値を使い、新規・更新ファイルだけをデコードする
+    dhashは常に縮小デコードから計算し、プロセスプールでチャンク単位に並列実行する
+    保存にメモリキャッシュを使う場合は、フル解像度の画像も読み込む（プロセス間で受け渡さずに済むスレッドで並列化する）
+    戻り値: (ハッシュを得られた画像パスのリスト, 対応するuint64配列)
+    """
+    # デバッグモードの場合はハッシュ計算をスキップ
+    if args.debug:
+        return list(image_files), np.array([hash(p) & 0xFFFFFFFFFFFFFFFF for p in image_files], dtype=np.uint64)  # 仮のハッシュ値
+    
+    # 保存にメモリキャッシュを使う場合だけ、フル解像度の画像が必要になる
+    reduced = not uses_image_cache(args)
+    
+    hashes = np.zeros(len(image_files), dtype=np.uint64)
+    valid = np.zeros(len(image_files), dtype=bool)
+    
+    # キャッシュ済みのハッシュを取得
+    keys = [HashCache.file_key(p) for p in image_files] if hash_cache is not None else [None] * len(image_files)
+    if hash_cache is not None:
+        for i, value in enumerate(hash_cache.lookup(keys, HASH_ALGORITHM, 8)):
+            if value is not None:
+                hashes[i] = np.frombuffer(value, dtype='<u8')[0]
+                valid[i] = True
+    
+    # 新規・更新された画像だけをデコードし、縮小済みサムネイルを1つの配列に集めてまとめてdhash化する
+    pending = np.flatnonzero(~valid)
+    thumbnails = np.empty((len(pending), 8, 9), dtype=np.uint8)
+    decoded = np.zeros(len(pending), dtype=bool)
+    if reduced and args.workers > 1 and len(pending) > HASH_CHUNK_SIZE:
+        chunks = [
+            [image_files[i] for i in pending[start:start + HASH_CHUNK_SIZE]]
+            for start in range(0, len(pending), HASH_CHUNK_SIZE)
+        ]
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            with tqdm(total=len(pending), desc=desc, disable=desc is None) as pbar:
+                for k, (chunk_thumbnails, chunk_decoded) in enumerate(executor.map(_hash_worker, chunks)):
+                    start = k * HASH_CHUNK_SIZE
+                    thumbnails[start:start + len(chunk_decoded)] = chunk_thumbnails
+                    decoded[start:start + len(chunk_decoded)] = chunk_decoded
+                    pbar.update(len(chunk_decoded))
+    elif reduced:
+        for k, i in enumerate(tqdm(pending, desc=desc, disable=desc is None)):
+            chunk_thumbnails, chunk_decoded = _hash_worker([image_files[i]])
+            thumbnails[k], decoded[k] = chunk_thumbnails[0], chunk_decoded[0]
+    else:
+        # cv2.imread はデコード中にGILを解放するので、スレッドでも並列に読み込める
+        # dhashはフル解像度の画像からではなく、他の経路と同じ縮小デコードから計算する
+        def load(img_path):
+            return load_image_for_hash(img_path), _hash_worker([img_path])
+        
+        pending_paths = [image_files[i] for i in pending]
+        with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+            loaded = executor.map(load, pending_paths)
+            for k, (image, (chunk_thumbnails, chunk_decoded)) in enumerate(tqdm(loaded, total=len(pending_paths), desc=desc, disable=desc is None)):
+                thumbnails[k], decoded[k] = chunk_thumbnails[0], chunk_decoded[0]
+                
+                # 保存時にメモリから書き出すため画像を保持する（読み込めなかった場合はファイルを配置する）
+                if image is not None and decoded[k]:
+                    cache_images[pending_paths[k]] = image
+    
+    if decoded.any():
+        new_indices = pending[decoded]
+        hashes[new_indices] = calculate_dhash_batch(thumbnails[decoded])
+        valid[new_indices] = True
+        if hash_cache is not None:
+            hash_cache.store(
+                [(keys[i], hashes[i:i + 1].astype('<u8').tobytes()) for i in new_indices], HASH_ALGORITHM, 8
+            )
+    
+    image_paths = [p for p, ok in zip(image_files, valid) if ok]
+    return image_paths, hashes[valid]
+
+# 候補ペアの検証に使える特徴量と既定のしきい値
+# phash: 64ビットのDCTハッシュ（ハミング距離）、dhash256: 256ビットのdhash（ハミング距離）、mse: 32x32グレースケールの平均二乗誤差
+VERIFY_METHODS = {
+    'phash': 10,
+    'dhash256': 40,
+    'mse': 100.0,
+}
+
+# 検証の距離計算で一度に処理するペア数
+VERIFY_CHUNK_SIZE = 1 << 16
+
+def calculate_verify_feature(gray, method):
+    """縮小デコード済みのグレースケール画像から検証用の特徴量（1次元配列）を計算する"""
+    if method == 'phash':
+        # 32x32のDCTの低周波8x8成分を中央値で2値化する
+        small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+        low = cv2.dct(small)[:8, :8].reshape(-1)
+        bits = low > np.median(low)
+        return np.packbits(bits, bitorder='little').view('<u8').astype(np.uint64)
+    if method == 'dhash256':
+        thumbnail = cv2.resize(gray, (17, 16), interpolation=cv2.INTER_AREA)
+        bits = (thumbnail[:, 1:] > thumbnail[:, :-1]).reshape(-1)
+        return np.packbits(bits, bitorder='little').view('<u8').astype(np.uint64)
+    if method == 'mse':
+        return cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).reshape(-1)
+    raise ValueError(f"未対応の検証方法です: {method}")
+
+def _verify_feature_spec(method):
+    """特徴量の (要素数, dtype) を返す"""
+    if method == 'mse':
+        return 32 * 32, np.uint8
+    return (4 if method == 'dhash256' else 1), np.uint64
+
+def verify_distance(features_a, features_b, method):
+    """特徴量の行同士の距離を計算する（phash/dhash256はハミング距離、mseは平均二乗誤差）"""
+    if method == 'mse':
+        diff = features_a.astype(np.int32) - features_b.astype(np.int32)
+        return (diff * diff).mean(axis=1)
+    return popcount64(features_a ^ features_b).sum(axis=1, dtype=np.int64)
+
+def _verify_feature_worker(task):
+    """プロセスプール用: パスのチャンクを縮小デコードして検証用特徴量と成否を返す"""
+    method, img_paths = task
+    size, dtype = _verify_feature_spec(method)
+    features = np.zeros((len(img_paths), size), dtype=dtype)
+    decoded = np.zeros(len(img_paths), dtype=bool)
+    for k, img_path in enumerate(img_paths):
+        try:
+            gray = load_reduced_gray(img_path)
+        except Exception as e:
+            print(f"エラー: {img_path} の検証用特徴量の計算中に例外が発生しました: {e}")
+            continue
+        if gray is not None:
+            features[k] = calculate_verify_feature(gray, method)
+            decoded[k] = True
+    return features, decoded
+
+def compute_verify_features(image_paths, method, workers=1, hash_cache=None, desc="検証用特徴量の計算"):
+    """
+    検証用特徴量を計算する（候補ペアに含まれる画像だけを渡す）
+    hash_cache があれば 'verify_<method>' として特徴量を保存・再利用する
+    戻り値: (特徴量配列 (N, size), 計算できたかどうかの配列)
+    """
+    size, dtype = _verify_feature_spec(method)
+    algorithm = f'verify_{method}'
+    features = np.zeros((len(image_paths), size), dtype=dtype)
+    valid = np.zeros(len(image_paths), dtype=bool)
+    
+    keys = [HashCache.file_key(p) for p in image_paths] if hash_cache is not None else [None] * len(image_paths)
+    if hash_cache is not None:
+        for i, value in enumerate(hash_cache.lookup(keys, algorithm, size)):
+            if value is not None:
+                features[i] = np.frombuffer(value, dtype=features.dtype)
+                valid[i] = True
+    
+    pending = np.flatnonzero(~valid)
+    chunks = [
+        (method, [image_paths[i] for i in pending[start:start + HASH_CHUNK_SIZE]])
+        for start in range(0, len(pending), HASH_CHUNK_SIZE)
+    ]
+    if workers > 1 and len(chunks) > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(_verify_feature_worker, chunks)
+    else:
+        executor = None
+        results = map(_verify_feature_worker, chunks)
+    
+    decoded = np.zeros(len(pending), dtype=bool)
+    try:
+        with tqdm(total=len(pending), desc=desc, disable=desc is None) as pbar:
+            for k, (chunk_features, chunk_decoded) in enumerate(results):
+                start = k * HASH_CHUNK_SIZE
+                features[pending[start:start + len(chunk_decoded)]] = chunk_features
+                decoded[start:start + len(chunk_decoded)] = chunk_decoded
+                pbar.update(len(chunk_decoded))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    
+    new_indices = pending[decoded]
+    valid[new_indices] = True
+    if hash_cache is not None and len(new_indices):
+        hash_cache.store([(keys[i], features[i].tobytes()) for i in new_indices], algorithm, size)
+    return features, valid
+
+def verify_candidate_pairs(image_paths, pairs, method, verify_threshold=None, workers=1, hash_cache=None, verbose=True):
+    """
+    dhash索引が出した画像単位の候補ペアを、より高価な特徴量で検証して絞り込む
+    特徴量は候補ペアに含まれる画像についてだけ計算する
+    特徴量を計算できなかった画像を含むペアは、dhashの判定どおり重複として残す
+    """
+    if len(pairs) == 0:
+        return pairs
+    if verify_threshold is None:
+        verify_threshold = VERIFY_METHODS[method]
+    
+    involved, local = np.unique(pairs, return_inverse=True)
+    local = local.reshape(pairs.shape)
+    features, valid = compute_verify_features(
+        [image_paths[i] for i in involved], method, workers, hash_cache,
+        desc=f"検証用特徴量の計算（{method}）" if verbose else None
+    )
+    
+    keep = np.ones(len(pairs), dtype=bool)
+    for start in range(0, len(pairs), VERIFY_CHUNK_SIZE):
+        left = local[start:start + VERIFY_CHUNK_SIZE, 0]
+        right = local[start:start + VERIFY_CHUNK_SIZE, 1]
+        close = verify_distance(features[left], features[right], method) <= verify_threshold
+        keep[start:start + VERIFY_CHUNK_SIZE] = close | ~valid[left] | ~valid[right]
+    
+    if verbose:
+        print(f"検証（{method}、しきい値 {verify_threshold}）: 候補 {len(pairs)} ペア中 {int(keep.sum())} ペアを重複と判定")
+    return pairs[keep]
+
+# WD14タガーの既定のリポジトリ（tagger_v3.py と同じモデルを再利用する）
+DEFAULT_WD14_TAGGER_REPO = "SmilingWolf/wd-v1-4-convnext-tagger-v2"
+
+# 埋め込みベクトルの永続ストアの既定の保存先
+DEFAULT_EMBEDDING_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'data-kitchen', 'embeddings')
+
+def find_embedding_tensor(graph):
+    """
+    ONNXグラフの出力（タグ確率）から遡り、分類層（MatMul/Gemm）に入る特徴量テンソルの名前を返す
+    Sigmoid や Identity、バイアスの Add は読み飛ばす
+    """
+    producers = {output: node for node in graph.node for output in node.output}
+    initializers = {init.name for init in graph.initializer}
+    tensor = graph.output[0].name
+    while tensor in producers:
+        node = producers[tensor]
+        inputs = [name for name in node.input if name and name not in initializers]
+        if node.op_type in ('MatMul', 'Gemm'):
+            return inputs[0]
+        if node.op_type not in ('Sigmoid', 'Identity', 'Add', 'Reshape', 'Flatten') or not inputs:
+            break
+        tensor = inputs[0]
+    raise ValueError("分類層の入力となる特徴量テンソルが見つかりませんでした")
+
+class Wd14Embedder:
+    """
+    WD14タガーのONNXモデルから、分類層直前のプーリング済み特徴量（埋め込み）を取り出す
+    特徴量テンソルをグラフの出力に追加したモデルを model_embedding.onnx として元のモデルの隣に作成して再利用する
+    """
+
+    def __init__(self, repo_id, model_dir, threads=1):
+        import onnxruntime as ort
+        
+        model_location = os.path.join(model_dir, repo_id.replace("/", "_"))
+        onnx_path = os.path.join(model_location, "model.onnx")
+        if not os.path.exists(onnx_path):
+            from huggingface_hub import hf_hub_download
+            print(f"WD14タガーのモデルをダウンロード中: {repo_id}")
+            hf_hub_download(
+                repo_id, "model.onnx", cache_dir=model_location, force_download=True,
+                force_filename="model.onnx", user_agent="image_cleaner_v7.py/1.0"
+            )
+        
+        embedding_path = os.path.join(model_location, "model_embedding.onnx")
+        if not os.path.exists(embedding_path) or os.path.getmtime(embedding_path) < os.path.getmtime(onnx_path):
+            import onnx
+            model = onnx.load(onnx_path)
+            feature_name = find_embedding_tensor(model.graph)
+            model.graph.output.append(onnx.helper.make_tensor_value_info(feature_name, onnx.TensorProto.FLOAT, None))
+            onnx.save(model, embedding_path)
+        
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(embedding_path, sess_options=options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_name = self.session.get_outputs()[-1].name
+        self.threads = threads
+
+    def embed(self, images):
+        """前処理済み画像のバッチ (N, 448, 448, 3) からL2正規化した埋め込み (N, D) を返す"""
+        features = self.session.run([self.output_name], {self.input_name: images})[0]
+        # プーリング前の特徴マップ（NHWC）が出力される場合は空間方向に平均する
+        if features.ndim > 2:
+            features = features.mean(axis=tuple(range(1, features.ndim - 1)))
+        norms = np.linalg.norm(features, axis=1, keepdims=True)
+        return features / np.maximum(norms, 1e-12)
+
+    def embed_paths(self, img_paths, batch_size=32, desc="埋め込みの計算"):
+        """
+        画像をバッチ単位で前処理して埋め込みを計算する（デコードはスレッドで並列化する）
+        前処理は tagger_v3.py と同じ（wd14_preprocess.load_image）
+        戻り値: (埋め込み (N, D) のリスト順の配列、読み込めたかどうかの配列)
+        """
+        def load(img_path):
+            try:
+                return load_image_for_wd14(img_path)
+            except Exception as e:
+                print(f"警告: {img_path} を読み込めませんでした（{e}）。スキップします。")
+                return None
+        
+        embeddings = None
+        decoded = np.zeros(len(img_paths), dtype=bool)
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            for start in tqdm(range(0, len(img_paths), batch_size), desc=desc, disable=desc is None):
+                images = list(executor.map(load, img_paths[start:start + batch_size]))
+                ok = [k for k, image in enumerate(images) if image is not None]
+                if not ok:
+                    continue
+                vectors = self.embed(np.stack([images[k] for k in ok]).astype(np.float32))
+                if embeddings is None:
+                    embeddings = np.zeros((len(img_paths), vectors.shape[1]), dtype=np.float16)
+                embeddings[[start + k for k in ok]] = vectors
+                decoded[[start + k for k in ok]] = True
+        if embeddings is None:
+            embeddings = np.zeros((len(img_paths), 0), dtype=np.float16)
+        return embeddings, decoded
+
+class EmbeddingStore:
+    """
+    埋め込みの永続ストア（float16の追記専用ファイルをメモリマップで読む）
+    各画像の行番号は HashCache に保存し、(絶対パス, サイズ, mtime_ns) が一致する場合だけ再利用する
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.meta_path = path + '.json'
+        create_directory(os.path.dirname(os.path.abspath(path)))
+        self.dim = None
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                self.dim = json.load(f)['dim']
+
+    def rows(self):
+        if self.dim is None or not os.path.exists(self.path):
+            return 0
+        return os.path.getsize(self.path) // (self.dim * 2)
+
+    def read(self, rows):
+        """行番号の配列に対応する埋め込みを返す"""
+        data = np.memmap(self.path, dtype=np.float16, mode='r', shape=(self.rows(), self.dim))
+        return np.asarray(data[rows])
+
+    def append(self, vectors):
+        """埋め込みを末尾に追記し、割り当てた行番号の配列を返す"""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float16)
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+            with open(self.meta_path, 'w', encoding='utf-8') as f:
+                json.dump({'dim': self.dim}, f)
+        start = self.rows()
+        with open(self.path, 'ab') as f:
+            f.write(vectors.tobytes())
+        return np.arange(start, start + len(vectors), dtype=np.int64)
+
+def compute_image_embeddings(image_files, args, hash_cache=None):
+    """
+    画像ファイルのWD14埋め込みを計算する
+    hash_cache があれば未変更のファイルは永続ストアの埋め込みを使い、新規・更新ファイルだけを推論する
+    （全てキャッシュ済みならモデル自体を読み込まない）
+    戻り値: (埋め込みを得られた画像パスのリスト, 対応する float16 配列 (N, D))
+    """
+    algorithm = f"wd14_embedding:{args.repo_id}"
+    store = EmbeddingStore(args.embedding_store or os.path.join(DEFAULT_EMBEDDING_DIR, args.repo_id.replace("/", "_") + ".f16"))
+    
+    rows = np.full(len(image_files), -1, dtype=np.int64)
+    keys = [HashCache.file_key(p) for p in image_files] if hash_cache is not None else [None] * len(image_files)
+    if hash_cache is not None and store.dim is not None:
+        stored_rows = store.rows()
+        for i, value in enumerate(hash_cache.lookup(keys, algorithm, store.dim)):
+            if value is not None:
+                row = int(np.frombuffer(value, dtype='<i8')[0])
+                if row < stored_rows:
+                    rows[i] = row
+    
+    pending = np.flatnonzero(rows < 0)
+    new_embeddings = None
+    decoded = np.zeros(len(pending), dtype=bool)
+    if len(pending):
+        embedder = Wd14Embedder(args.repo_id, args.model_dir, args.workers)
+        new_embeddings, decoded = embedder.embed_paths([image_files[i] for i in pending], args.embedding_batch_size)
+        if hash_cache is not None and decoded.any():
+            new_rows = store.append(new_embeddings[decoded])
+            new_indices = pending[decoded]
+            rows[new_indices] = new_rows
+            hash_cache.store(
+                [(keys[i], np.array([row], dtype='<i8').tobytes()) for i, row in zip(new_indices, new_rows)],
+                algorithm, store.dim
+            )
+    
+    dim = store.dim if store.dim is not None else (new_embeddings.shape[1] if new_embeddings is not None else 0)
+    embeddings = np.zeros((len(image_files), dim), dtype=np.float16)
+    valid = rows >= 0
+    if valid.any():
+        embeddings[valid] = store.read(rows[valid])
+    if new_embeddings is not None and hash_cache is None:
+        embeddings[pending[decoded]] = new_embeddings[decoded]
+        valid[pending[decoded]] = True
+    
+    image_paths = [p for p, ok in zip(image_files, valid) if ok]
+    return image_paths, embeddings[valid]
+
+def compute_image_features(image_files, args, cache_images, hash_cache=None):
+    """--method に応じて dhash（uint64 配列）または WD14 の埋め込み（float16 配列 (N, D)）を計算する"""
+    if args.method == 'embedding' and not args.debug:
+        return compute_image_embeddings(image_files, args, hash_cache)
+    return compute_image_hashes(image_files, args, cache_images, hash_cache)
+
+def _exact_embedding_pairs(vectors, threshold, max_memory=512):
+    """タイル分割した内積の総当たりで、コサイン類似度 threshold 以上のペアを返す"""
+    n = len(vectors)
+    tile = max(1, int(math.isqrt(max(1, max_memory * 1024 * 1024 // 5))))
+    found = []
+    for row in range(0, n, tile):
+        for col in range(row, n, tile):
+            close_i, close_j = np.nonzero(vectors[row:row + tile] @ vectors[col:col + tile].T >= threshold)
+            close_i += row
+            close_j += col
+            keep = close_j > close_i
+            found.append(np.stack([close_i[keep], close_j[keep]], axis=1))
+    return found
+
+def _ivf_embedding_pairs(vectors, threshold, nprobe=8, max_memory=512, seed=0):
+    """
+    転置ファイル（IVF）索引による近似探索で、コサイン類似度 threshold 以上のペアを返す
+    球面k-meansで作ったリストに各ベクトルを割り当て、各ベクトルは近い nprobe 個のリストの要素とだけ比較する
+    """
+    n, dim = vectors.shape
+    nlist = max(1, min(n, int(math.sqrt(n) * 4)))
+    nprobe = min(nprobe, nlist)
+    rng = np.random.default_rng(seed)
+    
+    # 標本で球面k-meansを学習する
+    sample = vectors[rng.choice(n, min(n, nlist * 40), replace=False)]
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(10):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+    
+    # 各ベクトルの近いリスト上位 nprobe 個（先頭が所属リスト）
+    chunk = max(1, max_memory * 1024 * 1024 // (4 * nlist))
+    probes = np.empty((n, nprobe), dtype=np.int64)
+    for start in range(0, n, chunk):
+        sims = vectors[start:start + chunk] @ centroids.T
+        top = np.argpartition(-sims, nprobe - 1, axis=1)[:, :nprobe] if nprobe < nlist else np.tile(np.arange(nlist), (len(sims), 1))
+        order = np.argsort(-np.take_along_axis(sims, top, axis=1), axis=1)
+        probes[start:start + chunk] = np.take_along_axis(top, order, axis=1)
+    
+    home = probes[:, 0]
+    members_order = np.argsort(home, kind='stable')
+    list_starts = np.searchsorted(home[members_order], np.arange(nlist + 1))
+    probe_owner = np.repeat(np.arange(n), nprobe)
+    probe_list = probes.ravel()
+    queries_order = np.argsort(probe_list, kind='stable')
+    query_starts = np.searchsorted(probe_list[queries_order], np.arange(nlist + 1))
+    
+    found = []
+    for lst in range(nlist):
+        members = members_order[list_starts[lst]:list_starts[lst + 1]]
+        queries = probe_owner[queries_order[query_starts[lst]:query_starts[lst + 1]]]
+        if len(members) == 0 or len(queries) == 0:
+            continue
+        step = max(1, max_memory * 1024 * 1024 // (5 * len(members)))
+        for start in range(0, len(queries), step):
+            q = queries[start:start + step]
+            close_q, close_m = np.nonzero(vectors[q] @ vectors[members].T >= threshold)
+            pairs = np.stack([q[close_q], members[close_m]], axis=1)
+            found.append(pairs[pairs[:, 0] != pairs[:, 1]])
+    return found
+
+def _hnsw_embedding_pairs(vectors, threshold, neighbors=16, workers=1):
+    """HNSW索引（hnswlib）の近傍探索で、コサイン類似度 threshold 以上のペアを返す"""
+    import hnswlib
+    n, dim = vectors.shape
+    index = hnswlib.Index(space='ip', dim=dim)
+    index.init_index(max_elements=n, ef_construction=200, M=16)
+    index.add_items(vectors, np.arange(n), num_threads=workers)
+    k = min(n, neighbors + 1)
+    index.set_ef(max(k * 2, 64))
+    labels, distances = index.knn_query(vectors, k=k, num_threads=workers)
+    # 内積空間の距離は 1 - 内積
+    close = (1.0 - distances) >= threshold
+    rows = np.repeat(np.arange(n), k).reshape(n, k)
+    pairs = np.stack([rows[close], labels[close].astype(np.int64)], axis=1)
+    return [pairs[pairs[:, 0] != pairs[:, 1]]]
+
+def find_embedding_groups(image_paths, embeddings, args, hash_cache=None):
+    """
+    埋め込みのコサイン類似度が --embedding_threshold 以上のペアを近似最近傍索引で列挙し、連結成分でまとめる
+    戻り値: 2枚以上のグループ（画像インデックスの配列）のリスト
+    """
+    n = len(image_paths)
+    print(f"埋め込みの類似性を判定中（{args.ann}）... 合計 {n} 枚の画像")
+    if n < 2:
+        return []
+    vectors = np.ascontiguousarray(embeddings, dtype=np.float32)
+    
+    ann = args.ann
+    if ann == 'hnsw':
+        try:
+            import hnswlib  # noqa: F401
+        except ImportError:
+            print("警告: hnswlib がインストールされていないため ivf で探索します。")
+            ann = 'ivf'
+    if ann == 'hnsw':
+        found = _hnsw_embedding_pairs(vectors, args.embedding_threshold, args.ann_neighbors, args.workers)
+    elif ann == 'ivf':
+        found = _ivf_embedding_pairs(vectors, args.embedding_threshold, args.ivf_nprobe, args.max_memory)
+    else:
+        found = _exact_embedding_pairs(vectors, args.embedding_threshold, args.max_memory)
+    
+    pairs = np.concatenate(found) if found else np.empty((0, 2), dtype=np.int64)
+    pairs = np.unique(np.sort(pairs.astype(np.int64), axis=1), axis=0) if len(pairs) else pairs.reshape(0, 2)
+    if args.verify != 'none':
+        pairs = verify_candidate_pairs(image_paths, pairs, args.verify, args.verify_threshold, args.workers, hash_cache)
+    return groups_from_labels(connected_components(n, pairs))
+
+class SequentialDeduplicator:
+    """
+    自然順に並んだ画像を直前 window 枚とだけ比較して重複を判定する（O(N·W)）
+    直前 window 枚のいずれかと距離 threshold 以内なら重複とし、先に現れた画像を残す
+    判定済みの画像は window 枚分しか保持しないため、フォルダ全体を保持せずに逐次処理できる
+    """
+
+    def __init__(self, window, threshold, verify='none', verify_threshold=None, workers=1, hash_cache=None):
+        self.window = window
+        self.threshold = threshold
+        self.verify = verify
+        self.verify_threshold = verify_threshold
+        self.workers = workers
+        self.hash_cache = hash_cache
+        self.recent_paths = []
+        self.recent_hashes = np.empty(0, dtype=np.uint64)
+
+    def push(self, image_paths, image_hashes):
+        """次の画像群を判定し、各画像が重複かどうかの真偽値配列を返す"""
+        paths = self.recent_paths + list(image_paths)
+        hashes = np.concatenate([self.recent_hashes, np.asarray(image_hashes, dtype=np.uint64)])
+        offset = len(self.recent_paths)
+        
+        # 距離 d だけ前の画像との比較を d = 1..window についてまとめて行う
+        found = []
+        for d in range(1, self.window + 1):
+            later = np.arange(max(offset, d), len(hashes))
+            if len(later) == 0:
+                break
+            close = later[popcount64(hashes[later] ^ hashes[later - d]) <= self.threshold]
+            found.append(np.stack([close - d, close], axis=1))
+        pairs = np.concatenate(found) if found else np.empty((0, 2), dtype=np.int64)
+        
+        if self.verify != 'none':
+            pairs = verify_candidate_pairs(
+                paths, pairs, self.verify, self.verify_threshold, self.workers, self.hash_cache, verbose=False
+            )
+        
+        duplicate = np.zeros(len(paths), dtype=bool)
+        duplicate[pairs[:, 1]] = True
+        
+        # 重複と判定した画像も連続フレームの比較相手として窓に残す
+        self.recent_paths = paths[max(0, len(paths) - self.window):]
+        self.recent_hashes = hashes[max(0, len(hashes) - self.window):]
+        return duplicate[offset:]
+
+def _settled_files(image_files, wait):
+    """新しいファイルを待つ場合は、書き込み途中の可能性がある直近に更新されたファイルを除く"""
+    if wait <= 0:
+        return image_files
+    settled_before = time.time() - SEQUENTIAL_SETTLE_SEC
+    settled = []
+    for img_path in image_files:
+        try:
+            if os.path.getmtime(img_path) <= settled_before:
+                settled.append(img_path)
+        except OSError:
+            continue
+    return settled
+
+def process_sequential(current_dir, image_files, args, hash_cache=None):
+    """
+    --sequential_window: 自然順に並べた画像をチャンクごとにハッシュ化し、直前 W 枚との比較だけで判定して逐次保存する
+    --sequential_wait 秒が経過しても新しいファイルが現れなくなるまでフォルダを再走査する（ダウンロード中のフォルダ用）
+    戻り値: (処理した画像数, 重複画像数)
+    """
+    dedup = SequentialDeduplicator(
+        args.sequential_window, args.threshold, args.verify, args.verify_threshold, args.workers, hash_cache
+    )
+    extensions = args.extension.split()
+    seen = set()
+    total_processed = 0
+    total_duplicates = 0
+    last_found = time.time()
+    pbar = tqdm(desc="逐次重複判定", unit="枚")
+    
+    while True:
+        pending = sorted(_settled_files([p for p in image_files if p not in seen], args.sequential_wait), key=natural_sort_key)
+        for start in range(0, len(pending), SEQUENTIAL_CHUNK_SIZE):
+            chunk = pending[start:start + SEQUENTIAL_CHUNK_SIZE]
+            seen.update(chunk)
+            cache_images = {}  # メモリキャッシュ用（チャンクごとに破棄する）
+            image_paths, image_hashes = compute_image_hashes(chunk, args, cache_images, hash_cache, desc=None)
+            duplicate = dedup.push(image_paths, image_hashes)
+            
+            if args.debug:
+                print(f"デバッグモード: {len(image_paths)} 枚中 {int(duplicate.sum())} 枚を重複と判定")
+            else:
+                for img_path, is_duplicate in zip(image_paths, duplicate):
+                    if is_duplicate and not args.save_dir_duplicate:
+                        continue
+                    save_path = get_save_path(
+                        img_path, current_dir, args.save_dir_duplicate if is_duplicate else args.save_dir,
+                        args.preserve_structure, args.preserve_own_folder
+                    )
+                    save_image(img_path, save_path, cache_images, args.mem_cache, args.output_mode)
+            
+            total_processed += len(chunk)
+            total_duplicates += int(duplicate.sum())
+            pbar.update(len(chunk))
+            pbar.set_postfix(重複=total_duplicates)
+        
+        if args.sequential_wait <= 0:
+            break
+        if pending:
+            last_found = time.time()
+        elif time.time() - last_found >= args.sequential_wait:
+            break
+        else:
+            time.sleep(1)
+        image_files = get_image_files(current_dir, extensions, args.recursive)
+    
+    pbar.close()
+    return total_processed, total_duplicates
+
+def order_groups(groups, image_paths, args):
+    """
+    各重複グループ（画像インデックスの配列）を残す優先順に並べ替える（先頭の画像を残す）
+    folder: 処理順（フォルダ順・ファイル名順）で最初の画像、mtime: 更新日時が最も古い画像、
+    resolution: 画素数が最も多い画像、filesize: ファイルサイズが最も大きい画像
+    resolution/filesize はグループ内の画像のヘッダーだけを並列に読んで判定する（画素データはデコードしない）
+    """
+    if args.keep_priority == 'folder' or not groups:
+        return [list(group) for group in groups]
+    
+    members = np.concatenate(groups)
+    # 優先するものほど小さくなるキーを、精度を落とさないよう Python の整数のタプルで作る
+    # （ナノ秒のmtimeや「画素数, ファイルサイズ」を1つの float64 にまとめると下位の桁が失われる）
+    if args.keep_priority == 'mtime':
+        def mtime(i):
+            try:
+                return os.stat(image_paths[i]).st_mtime_ns
+            except OSError:
+                return np.iinfo(np.int64).max
+        # 古いものを優先する
+        ranks = [(mtime(i),) for i in members.tolist()]
+    else:
+        probe_cache = ProbeCache(args.probe_cache_path) if args.hash_cache == "ON" else None
+        probes = probe_images([image_paths[i] for i in members], args.workers, probe_cache, desc="ヘッダーの読み込み")
+        if probe_cache is not None:
+            probe_cache.close()
+        pixels = [width * height for width, height in zip(probes['width'].tolist(), probes['height'].tolist())]
+        file_sizes = probes['file_size'].tolist()
+        if args.keep_priority == 'resolution':
+            # 画素数が同じならファイルサイズの大きい方を優先する
+            ranks = [(-p, -size) for p, size in zip(pixels, file_sizes)]
+        else:
+            ranks = [(-size,) for size in file_sizes]
+    
+    rank_of = dict(zip(members.tolist(), ranks))
+    return [sorted(group, key=lambda i: (rank_of[i], i)) for group in groups]
+
+def save_dedup_results(image_paths, groups, src_dirs, folder_ids, args, cache_images=None, known=None):
+    """
+    非重複画像と各グループの先頭を save_dir に、残りを save_dir_duplicate に保存する
+    画像 i の保存先は、その画像が属するフォルダ src_dirs[folder_ids[i]] を基準に決める
+    known が True の画像（整理済みデータセットに既にある画像）は重複として扱う
+    戻り値: save_dir に保存した画像の (インデックス, 保存先パス) のリスト
+    """
+    kept = []
+    
+    def save_to(i, save_dir):
+        img_path = image_paths[i]
+        save_path = get_save_path(
+            img_path, src_dirs[folder_ids[i]], save_dir,
+            args.preserve_structure, args.preserve_own_folder
+        )
+        if save_image(img_path, save_path, cache_images, args.mem_cache, args.output_mode) and save_dir == args.save_dir:
+            kept.append((i, save_path))
+    
+    # 非重複画像の保存
+    in_group = np.zeros(len(image_paths), dtype=bool) if known is None else known.copy()
+    for group in groups:
+        in_group[group] = True
+    non_duplicate_images = np.flatnonzero(~in_group)
+    
+    print(f"\n非重複画像 {len(non_duplicate_images)} 枚を保存中...")
+    for i in tqdm(non_duplicate_images, desc="非重複画像の保存"):
+        save_to(i, args.save_dir)
+    
+    # 重複グループの処理
+    print(f"\n重複グループ {len(groups)} 個を処理中...")
+    for group in tqdm(order_groups(groups, image_paths, args), desc="重複グループの処理"):
+        # 優先順位が最も高い1枚を保存
+        save_to(group[0], args.save_dir)
+        
+        # 残りの画像を重複ディレクトリに保存（オプション）
+        if args.save_dir_duplicate:
+            for i in group[1:]:
+                save_to(i, args.save_dir_duplicate)
+    
+    # 整理済みデータセットと重複する画像を重複ディレクトリに保存（オプション）
+    if known is not None and args.save_dir_duplicate and known.any():
+        print(f"\n整理済みデータセットと重複する画像 {int(known.sum())} 枚を保存中...")
+        for i in tqdm(np.flatnonzero(known), desc="既存画像との重複の保存"):
+            save_to(i, args.save_dir_duplicate)
+    
+    return kept
+
+def dedup_and_save(image_paths, image_hashes, src_dirs, folder_ids, args, hash_cache=None, cache_images=None, reference=None, plan=None):
+    """
+    類似画像をグループ化して保存する
+    reference があれば、先に整理済みデータセットの索引と照合して既にある画像を除き、
+    残りだけでグループ化したうえで、新たに保存した画像を索引に追記する
+    plan（DedupPlanWriter）があれば、保存せずに判定結果を計画ファイルに書き出す
+    戻り値: (重複と判定した画像数, グループのリスト)
+    """
+    known = None
+    candidates = np.arange(len(image_paths))
+    if reference is not None:
+        known = reference.match(image_hashes) >= 0
+        candidates = np.flatnonzero(~known)
+        print(f"整理済みデータセット（{len(reference)} 枚）と照合: {len(image_paths)} 枚中 {int(known.sum())} 枚が既存画像と重複")
+    
+    if args.method == 'embedding':
+        groups = find_embedding_groups([image_paths[i] for i in candidates], image_hashes[candidates], args, hash_cache)
+    else:
+        graph = similarity_graph(
+            [image_paths[i] for i in candidates], image_hashes[candidates], args.threshold, args.process_group,
+            args.search, args.max_memory, args.workers,
+            args.verify, args.verify_threshold, hash_cache
+        )
+        n_nodes, pairs, node_of_image = graph
+        groups = groups_from_labels(connected_components(n_nodes, pairs)[node_of_image])
+    groups = [candidates[group] for group in groups]
+    
+    if plan is not None:
+        plan.add(image_paths, image_hashes, src_dirs, folder_ids, graph, groups)
+        return sum(len(group) - 1 for group in groups), groups
+    
+    kept = save_dedup_results(image_paths, groups, src_dirs, folder_ids, args, cache_images, known)
+    
+    if reference is not None:
+        kept_indices = np.array([i for i, _ in kept], dtype=np.int64)
+        reference.append(image_hashes[kept_indices], [os.path.abspath(save_path) for _, save_path in kept])
+        print(f"整理済みデータセットの索引に {len(kept)} 枚を追記しました（合計 {len(reference)} 枚）")
+    
+    duplicates = sum(len(group) - 1 for group in groups)
+    if known is not None:
+        duplicates += int(known.sum())
+    return duplicates, groups
+
+class DedupPlanWriter:
+    """
+    --plan: 重複判定の結果を画像をデコードせずに再利用できる計画ファイル（JSONL）に書き出す
+    1行目はヘッダーで、以降にフォルダ（dir）、画像（image: パス・フォルダ番号・ハッシュ）、
+    ペア（pairs: 画像番号の組とハミング距離を配列でまとめたもの）、グループ（group）の行が続く
+    pair_level が hash の場合、ペアは各ハッシュの代表画像同士のもので、同じハッシュを持つ画像同士は距離0として扱う
+    """
+
+    # 1行に書き出すペア数
+    PAIRS_PER_LINE = 100000
+
+    def __init__(self, path, args):
+        create_directory(os.path.dirname(os.path.abspath(path)))
+        self.path = path
+        self.file = open(path, 'w', encoding='utf-8')
+        self.image_count = 0
+        self.dir_count = 0
+        self._write({
+            'type': 'header',
+            'version': 1,
+            'threshold': args.threshold,
+            'pair_level': 'image' if args.verify != 'none' else 'hash',
+            'verify': args.verify,
+            'scope': 'global' if args.global_dedup else 'folder',
+        })
+
+    def _write(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def add(self, image_paths, image_hashes, src_dirs, folder_ids, graph, groups):
+        """1回のグループ化の結果（similarity_graph の戻り値とグループ）を追記する"""
+        image_offset = self.image_count
+        dir_offset = self.dir_count
+        for src_dir in src_dirs:
+            self._write({'type': 'dir', 'id': self.dir_count, 'path': src_dir})
+            self.dir_count += 1
+        for i, (img_path, image_hash, folder_id) in enumerate(zip(image_paths, image_hashes.tolist(), folder_ids.tolist())):
+            self._write({'type': 'image', 'id': image_offset + i, 'dir': dir_offset + folder_id, 'path': img_path, 'hash': f"{image_hash:016x}"})
+        
+        # 頂点ペアを各頂点の代表画像（その頂点に属する最初の画像）同士のペアにして距離を添える
+        n_nodes, pairs, node_of_image = graph
+        representative = np.empty(n_nodes, dtype=np.int64)
+        representative[node_of_image[::-1]] = np.arange(len(node_of_image))[::-1]
+        left = representative[pairs[:, 0]]
+        right = representative[pairs[:, 1]]
+        distances = popcount64(image_hashes[left] ^ image_hashes[right])
+        for start in range(0, len(pairs), self.PAIRS_PER_LINE):
+            end = start + self.PAIRS_PER_LINE
+            self._write({
+                'type': 'pairs',
+                'i': (left[start:end] + image_offset).tolist(),
+                'j': (right[start:end] + image_offset).tolist(),
+                'd': distances[start:end].tolist(),
+            })
+        for group in groups:
+            self._write({'type': 'group', 'ids': (np.asarray(group) + image_offset).tolist()})
+        self.image_count += len(image_paths)
+
+    def close(self):
+        self.file.close()
+
+def load_dedup_plan(path):
+    """DedupPlanWriter で書き出した計画ファイルを読み込む"""
+    header = None
+    dirs = []
+    image_paths = []
+    folder_ids = []
+    hashes = []
+    left, right, distances = [], [], []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            kind = record['type']
+            if kind == 'image':
+                image_paths.append(record['path'])
+                folder_ids.append(record['dir'])
+                hashes.append(int(record['hash'], 16))
+            elif kind == 'pairs':
+                left.append(np.array(record['i'], dtype=np.int64))
+                right.append(np.array(record['j'], dtype=np.int64))
+                distances.append(np.array(record['d'], dtype=np.int64))
+            elif kind == 'dir':
+                dirs.append(record['path'])
+            elif kind == 'header':
+                header = record
+    if header is None:
+        raise ValueError(f"{path} は計画ファイルではありません（ヘッダーがありません）")
+    empty = np.empty(0, dtype=np.int64)
+    return {
+        'header': header,
+        'dirs': dirs,
+        'image_paths': image_paths,
+        'folder_ids': np.array(folder_ids, dtype=np.int32),
+        'hashes': np.array(hashes, dtype=np.uint64),
+        'pairs': np.stack([np.concatenate(left or [empty]), np.concatenate(right or [empty])], axis=1),
+        'distances': np.concatenate(distances or [empty]),
+    }
+
+def apply_dedup_plan(args):
+    """
+    --apply: 計画ファイルのペアと距離から --threshold でグループを作り直し、画像をデコードせずにファイルを配置する
+    計画のしきい値より大きい値を指定した場合は、保存済みのハッシュから類似ペアを探索し直す（検証付きの計画は不可）
+    戻り値: (処理した画像数, 重複画像数)
+    """
+    start_time = time.time()
+    plan = load_dedup_plan(args.apply)
+    header = plan['header']
+    image_paths = plan['image_paths']
+    hashes = plan['hashes']
+    folder_ids = plan['folder_ids']
+    n = len(image_paths)
+    print(f"計画ファイルを読み込みました: {n} 枚、{len(plan['pairs'])} ペア（計画のしきい値 {header['threshold']}、{time.time() - start_time:.1f} 秒）")
+    
+    # 同じハッシュでも別のフォルダの画像はフォルダごとの計画では別の頂点にする
+    scopes = folder_ids.astype(np.int64) if header['scope'] == 'folder' else np.zeros(n, dtype=np.int64)
+    
+    if args.threshold > header['threshold']:
+        if header['pair_level'] != 'hash':
+            print(f"エラー: 検証付きの計画は計画時のしきい値 {header['threshold']} より大きいしきい値では適用できません。")
+            return 0, 0
+        # 保存済みのハッシュから探索し直す（画像はデコードしない）
+        print(f"しきい値 {args.threshold} が計画のしきい値より大きいため、保存済みのハッシュから類似ペアを探索し直します。")
+        labels = np.empty(n, dtype=np.int64)
+        label_offset = 0
+        for scope in np.unique(scopes):
+            members = np.flatnonzero(scopes == scope)
+            unique_hashes, inverse = np.unique(hashes[members], return_inverse=True)
+            pairs = find_similar_pairs(unique_hashes, args.threshold, args.search, args.process_group, args.max_memory, args.workers)
+            labels[members] = connected_components(len(unique_hashes), pairs)[inverse.reshape(-1)] + label_offset
+            label_offset += len(unique_hashes)
+    else:
+        pairs = plan['pairs'][plan['distances'] <= args.threshold]
+        if header['pair_level'] == 'hash':
+            # (範囲, ハッシュ) が同じ画像を1つの頂点にまとめる
+            order = np.lexsort((hashes, scopes))
+            is_new = np.ones(n, dtype=bool)
+            is_new[1:] = (np.diff(hashes[order].astype(np.int64)) != 0) | (np.diff(scopes[order]) != 0)
+            inverse = np.empty(n, dtype=np.int64)
+            inverse[order] = np.cumsum(is_new) - 1
+            n_nodes = int(is_new.sum())
+            labels = connected_components(n_nodes, inverse[pairs])[inverse]
+        else:
+            labels = connected_components(n, pairs)
+    
+    groups = groups_from_labels(labels)
+    print(f"しきい値 {args.threshold} で重複グループ {len(groups)} 個を作成しました（{time.time() - start_time:.1f} 秒）")
+    
+    if args.debug:
+        print("デバッグモード: 画像の保存処理をシミュレート")
+    else:
+        save_dedup_results(image_paths, groups, plan['dirs'], folder_ids, args)
+    return n, sum(len(group) - 1 for group in groups)
+
+def process_global(dirs_to_process, args, hash_cache=None, reference=None, plan=None):
+    """
+    --global_dedup: 全フォルダのハッシュを1つの索引にまとめ、フォルダをまたいだ重複を判定する
+    画像ごとに保持するのはパスのほかハッシュ（uint64）とフォルダ番号（int32）の配列要素だけで、
+    保存先は各画像の元のフォルダを基準に決める
+    戻り値: (処理した画像数, 重複画像数)
+    """
+    extensions = args.extension.split()
+    image_paths = []
+    hash_parts = []
+    folder_parts = []
+    total_files = 0
+    
+    for folder_id, current_dir in enumerate(dirs_to_process):
+        image_files = sorted(get_image_files(current_dir, extensions, args.recursive), key=natural_sort_key)
+        if not image_files:
+            print(f"警告: {current_dir} に処理対象の画像ファイルが見つかりませんでした。")
+            continue
+        
+        print(f"\n{current_dir} 内の {len(image_files)} 枚の画像のハッシュ値を計算中...")
+        paths, hashes = compute_image_features(image_files, args, {}, hash_cache)
+        image_paths.extend(paths)
+        hash_parts.append(hashes)
+        folder_parts.append(np.full(len(paths), folder_id, dtype=np.int32))
+        total_files += len(image_files)
+    
+    if not image_paths:
+        return total_files, 0
+    image_hashes = np.concatenate(hash_parts)
+    folder_ids = np.concatenate(folder_parts)
+    del hash_parts, folder_parts
+    
+    if args.debug:
+        print(f"デバッグモード: {len(dirs_to_process)} フォルダ・{len(image_paths)} 枚の横断的なグループ化と保存をシミュレート")
+        return total_files, 0
+    
+    print(f"\n{len(dirs_to_process)} フォルダを横断して類似画像のグループ化を実行中...")
+    duplicates, groups = dedup_and_save(
+        image_paths, image_hashes, dirs_to_process, folder_ids, args, hash_cache, reference=reference, plan=plan
+    )
+    cross_folder = sum(len(np.unique(folder_ids[group])) > 1 for group in groups)
+    print(f"フォルダをまたぐ重複グループ: {cross_folder} / {len(groups)} 個")
+    return total_files, duplicates
+
+def build_reference_index(reference, dirs_to_process, args, hash_cache=None):
+    """--build_reference: 整理済みデータセットの画像をそのまま（重複判定・保存をせずに）索引に追記する"""
+    extensions = args.extension.split()
+    indexed = set(reference.paths())
+    for current_dir in dirs_to_process:
+        image_files = sorted(get_image_files(current_dir, extensions, args.recursive), key=natural_sort_key)
+        image_files = [p for p in image_files if os.path.abspath(p) not in indexed]
+        if not image_files:
+            print(f"{current_dir} に索引へ追加する画像はありません。")
+            continue
+        print(f"\n{current_dir} 内の {len(image_files)} 枚の画像を索引に追加中...")
+        image_paths, image_hashes = compute_image_hashes(image_files, args, {}, hash_cache)
+        reference.append(image_hashes, [os.path.abspath(p) for p in image_paths])
+    print(f"\n索引の画像数: {len(reference)}")
+
 def process_images(args):
     """画像処理のメイン関数"""
     # ガベージコレクションの無効化
@@ -203,7 +1838,10 @@ def process_images(args):
     
     # 処理対象ディレクトリのリストを取得
     dirs_to_process = []
-    if args.by_folder:
+    if args.apply:
+        # 計画ファイルを適用する場合はディレクトリを走査しない
+        pass
+    elif args.by_folder:
         # フォルダごとに処理
         for item in os.listdir(args.dir):
             item_path = os.path.join(args.dir, item)
@@ -219,6 +1857,39 @@ def process_images(args):
     total_processed = 0
     total_duplicates = 0
     
+    # ハッシュ値の永続キャッシュ
+    hash_cache = None
+    if args.hash_cache == "ON" and not args.debug and not args.apply:
+        hash_cache = HashCache(args.hash_cache_path, rebuild=args.rebuild_cache)
+    
+    # 整理済みデータセットの索引
+    reference = None
+    if args.reference_index and not args.debug:
+        try:
+            reference = ReferenceIndex(args.reference_index, args.threshold)
+        except ValueError as e:
+            print(f"エラー: {e}")
+            sys.exit(1)
+        print(f"整理済みデータセットの索引を読み込みました: {args.reference_index}（{len(reference)} 枚）")
+        if args.build_reference:
+            build_reference_index(reference, dirs_to_process, args, hash_cache)
+            if hash_cache is not None:
+                hash_cache.close()
+            return
+    
+    # 計画ファイルの書き出し（ファイルは配置しない）
+    plan = DedupPlanWriter(args.plan, args) if args.plan and not args.debug else None
+    
+    # 計画ファイルの適用: 画像をデコードせずにファイルを配置する
+    if args.apply:
+        total_processed, total_duplicates = apply_dedup_plan(args)
+    
+    # フォルダ横断モード: 全フォルダを1つの索引で判定する（フォルダ順が優先順位になる）
+    if args.global_dedup and dirs_to_process:
+        dirs_to_process.sort(key=natural_sort_key)
+        total_processed, total_duplicates = process_global(dirs_to_process, args, hash_cache, reference, plan)
+        dirs_to_process = []
+    
     # 各ディレクトリを処理
     for current_dir in dirs_to_process:
         if args.debug:
@@ -228,105 +1899,33 @@ def process_images(args):
         extensions = args.extension.split()
         image_files = get_image_files(current_dir, extensions, args.recursive)
         
-        if not image_files:
+        if not image_files and not (args.sequential_window > 0 and args.sequential_wait > 0):
             print(f"警告: {current_dir} に処理対象の画像ファイルが見つかりませんでした。")
             continue
         
         print(f"\n{current_dir} 内の {len(image_files)} 枚の画像を処理中...")
         
+        # 逐次モード: 直前 W 枚とだけ比較しながらストリーミングで処理する
+        if args.sequential_window > 0:
+            processed, duplicates = process_sequential(current_dir, image_files, args, hash_cache)
+            total_processed += processed
+            total_duplicates += duplicates
+            continue
+        
         # 画像のハッシュ値を計算
-        image_hashes = {}
         cache_images = {}  # メモリキャッシュ用
+        image_paths, image_hashes = compute_image_features(image_files, args, cache_images, hash_cache)
         
-        for img_path in tqdm(image_files, desc="ハッシュ値の計算"):
-            try:
-                # デバッグモードの場合はハッシュ計算をスキップ
-                if args.debug:
-                    image_hashes[img_path] = hash(img_path)  # 仮のハッシュ値
-                    continue
-                
-                image = cv2.imread(img_path)
-                if image is None:
-                    print(f"警告: {img_path} を読み込めませんでした。スキップします。")
-                    continue
-                
-                hash_value = calculate_dhash(image)
-                image_hashes[img_path] = hash_value
-                
-                # メモリキャッシュが有効な場合は画像を保存
-                if args.mem_cache == "ON":
-                    cache_images[img_path] = image
-                
-            except Exception as e:
-                print(f"エラー: {img_path} の処理中に例外が発生しました: {e}")
-                # リトライ処理
-                max_retries = 3
-                for retry in range(max_retries):
-                    try:
-                        print(f"リトライ {retry+1}/{max_retries}...")
-                        time.sleep(1)  # 少し待機
-                        image = cv2.imread(img_path)
-                        if image is None:
-                            continue
-                        hash_value = calculate_dhash(image)
-                        image_hashes[img_path] = hash_value
-                        if args.mem_cache == "ON":
-                            cache_images[img_path] = image
-                        print("リトライ成功")
-                        break
-                    except Exception as e:
-                        print(f"リトライ失敗: {e}")
-                        if retry == max_retries - 1:
-                            print(f"{img_path} の処理をスキップします。")
-        
-        # 類似画像のグループ化
+        # 類似画像のグループ化と保存
         if args.debug:
-            print("デバッグモード: 類似画像のグループ化をシミュレート")
-            similar_groups = [['img1.jpg', 'img2.jpg'], ['img3.jpg', 'img4.jpg']]
-            processed_images = set(['img1.jpg', 'img2.jpg', 'img3.jpg', 'img4.jpg'])
+            print("デバッグモード: 類似画像のグループ化と画像の保存処理をシミュレート")
+            duplicates = 0
         else:
             print("\n類似画像のグループ化を実行中...")
-            similar_groups, processed_images = find_similar_images(
-                image_hashes, args.threshold, args.process_group
+            folder_ids = np.zeros(len(image_paths), dtype=np.int32)
+            duplicates, _ = dedup_and_save(
+                image_paths, image_hashes, [current_dir], folder_ids, args, hash_cache, cache_images, reference, plan
             )
-        
-        # 画像の保存処理
-        if args.debug:
-            print("デバッグモード: 画像の保存処理をシミュレート")
-        else:
-            # 非重複画像の保存
-            non_duplicate_images = set(image_hashes.keys()) - processed_images
-            
-            print(f"\n非重複画像 {len(non_duplicate_images)} 枚を保存中...")
-            for img_path in tqdm(non_duplicate_images, desc="非重複画像の保存"):
-                save_path = get_save_path(
-                    img_path, current_dir, args.save_dir, 
-                    args.preserve_structure, args.preserve_own_folder
-                )
-                
-                save_image(img_path, save_path, cache_images, args.mem_cache)
-            
-            # 重複グループの処理
-            print(f"\n重複グループ {len(similar_groups)} 個を処理中...")
-            for group in tqdm(similar_groups, desc="重複グループの処理"):
-                # 各グループから1枚を選択して保存
-                selected_img = group[0]
-                save_path = get_save_path(
-                    selected_img, current_dir, args.save_dir, 
-                    args.preserve_structure, args.preserve_own_folder
-                )
-                
-                save_image(selected_img, save_path, cache_images, args.mem_cache)
-                
-                # 残りの画像を重複ディレクトリに保存（オプション）
-                if args.save_dir_duplicate:
-                    for dup_img in group[1:]:
-                        dup_save_path = get_save_path(
-                            dup_img, current_dir, args.save_dir_duplicate, 
-                            args.preserve_structure, args.preserve_own_folder
-                        )
-                        
-                        save_image(dup_img, dup_save_path, cache_images, args.mem_cache)
             
             # メモリキャッシュのクリア
             if args.mem_cache == "ON":
@@ -334,13 +1933,20 @@ def process_images(args):
         
         # 統計情報の更新
         total_processed += len(image_files)
-        total_duplicates += sum(len(group) - 1 for group in similar_groups)
+        total_duplicates += duplicates
+    
+    if plan is not None:
+        plan.close()
+        print(f"\n計画ファイルを書き出しました: {args.plan}（ファイルは配置していません。--apply で適用します）")
     
     # 処理結果の表示
     print("\n処理完了!")
     print(f"合計処理画像数: {total_processed}")
     print(f"検出された重複画像数: {total_duplicates}")
     print(f"保存された一意の画像数: {total_processed - total_duplicates}")
+    if hash_cache is not None:
+        print(hash_cache.stats_line())
+        hash_cache.close()
     
     # ガベージコレクションの再有効化
     if args.gc_disable:
@@ -349,30 +1955,105 @@ def process_images(args):
 def main():
     parser = argparse.ArgumentParser(description='画像の重複を検出して削減するツール')
     
-    parser.add_argument('--dir', required=True, help='処理対象ディレクトリ')
+    parser.add_argument('--dir', help='処理対象ディレクトリ（--apply 以外では必須）')
     parser.add_argument('--save_dir', default='output/', help='出力ディレクトリ（デフォルト: output/）')
     parser.add_argument('--extension', default='jpg png webp', help='処理対象の拡張子（スペース区切り、デフォルト: jpg png webp）')
     parser.add_argument('--recursive', action='store_true', help='サブディレクトリも探索する')
     parser.add_argument('--debug', action='store_true', help='デバッグモード')
     parser.add_argument('--threshold', type=int, default=10, help='類似度判定のしきい値（ハミング距離、デフォルト: 10）')
+    parser.add_argument('--method', default='dhash', choices=['dhash', 'embedding'], help='重複判定の方法（dhash: 知覚ハッシュ、embedding: WD14タガーの特徴量、デフォルト: dhash）')
+    parser.add_argument('--embedding_threshold', type=float, default=0.95, help='--method embedding のコサイン類似度のしきい値（デフォルト: 0.95）')
+    parser.add_argument('--ann', default='ivf', choices=['ivf', 'hnsw', 'exact'], help='埋め込みの近傍探索方法（ivf: 転置ファイル索引、hnsw: hnswlib、exact: 総当たり、デフォルト: ivf）')
+    parser.add_argument('--ivf_nprobe', type=int, default=8, help='ivf で各ベクトルが探索するリスト数（デフォルト: 8）')
+    parser.add_argument('--ann_neighbors', type=int, default=16, help='hnsw で各ベクトルについて調べる近傍数（デフォルト: 16）')
+    parser.add_argument('--repo_id', default=DEFAULT_WD14_TAGGER_REPO, help=f'埋め込みに使うWD14タガーのリポジトリ（デフォルト: {DEFAULT_WD14_TAGGER_REPO}）')
+    parser.add_argument('--model_dir', default='./models', help='WD14タガーのモデルの保存先（tagger_v3.py と共通、デフォルト: ./models）')
+    parser.add_argument('--embedding_batch_size', type=int, default=32, help='埋め込みの推論のバッチサイズ（デフォルト: 32）')
+    parser.add_argument('--embedding_store', help=f'埋め込みを保存するfloat16ファイル（デフォルト: {DEFAULT_EMBEDDING_DIR} 以下にリポジトリ名で作成）')
     parser.add_argument('--preserve_own_folder', action='store_true', help='元ディレクトリ名を保持する')
     parser.add_argument('--preserve_structure', action='store_true', help='ディレクトリ構造を保持する')
     parser.add_argument('--gc_disable', action='store_true', help='ガベージコレクションを無効化する')
     parser.add_argument('--by_folder', action='store_true', help='フォルダごとに処理する')
-    parser.add_argument('--process_group', type=int, default=1000, help='類似判定をグループ化する画像数（デフォルト: 1000）')
+    parser.add_argument('--global_dedup', action='store_true', help='--by_folder 時に全フォルダを1つの索引で判定し、フォルダをまたいだ重複も検出する（保存先はフォルダごとの構成のまま）')
+    parser.add_argument('--reference_index', help='整理済みデータセットのハッシュ索引ディレクトリ。指定すると既存画像と重複しない新しい画像だけを保存し、保存した画像を索引に追記する')
+    parser.add_argument('--build_reference', action='store_true', help='--dir の画像を重複判定・保存せずに --reference_index に追加する（索引の初回作成用）')
+    parser.add_argument('--keep_priority', default='folder', choices=['folder', 'mtime', 'resolution', 'filesize'], help='重複グループで残す画像の優先順位（folder: フォルダ順・ファイル名順で最初、mtime: 最も古いファイル、resolution: 画素数が最大、filesize: ファイルサイズが最大、デフォルト: folder）')
+    parser.add_argument('--process_group', type=int, default=1000, help='類似ペア探索で一度に問い合わせる画像数（デフォルト: 1000）')
+    parser.add_argument('--search', default='index', choices=['index', 'bruteforce'], help='類似ペアの探索方法（index: MIH索引、bruteforce: 総当たり、デフォルト: index）')
+    parser.add_argument('--max_memory', type=int, default=512, help='総当たり探索で1度に比較するタイルのメモリ上限（MB、デフォルト: 512）')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='並列処理に使うプロセス数（デフォルト: CPUコア数）')
+    parser.add_argument('--sequential_window', type=int, default=0, help='自然順で直前のW枚とだけ比較する逐次モード（連番フレーム用、0で無効、デフォルト: 0）')
+    parser.add_argument('--sequential_wait', type=float, default=0, help='逐次モードで新しいファイルが現れなくなってから終了するまでの秒数（ダウンロード中のフォルダ用、デフォルト: 0）')
+    parser.add_argument('--verify', default='none', choices=['none'] + list(VERIFY_METHODS), help='dhashで見つけた候補ペアを検証する特徴量（phash / dhash256 / mse、デフォルト: none）')
+    parser.add_argument('--verify_threshold', type=float, help='検証のしきい値（デフォルト: phash 10、dhash256 40、mse 100）')
+    parser.add_argument('--plan', help='ファイルを配置せずに、グループ・各画像のハッシュ・ペアの距離を計画ファイル（JSONL）に書き出す')
+    parser.add_argument('--apply', help='--plan で書き出した計画ファイルを --threshold で適用してファイルを配置する（画像はデコードしない）')
     parser.add_argument('--save_dir_duplicate', help='重複画像の保存先ディレクトリ')
-    parser.add_argument('--mem_cache', default='ON', choices=['ON', 'OFF'], help='メモリキャッシュを使用する（デフォルト: ON）')
+    parser.add_argument('--output_mode', default='copy', choices=['copy', 'hardlink', 'reflink', 'symlink', 'move'], help='出力ファイルの配置方法（コピー以外は画素データを再エンコードしない、デフォルト: copy）')
+    parser.add_argument('--hash_cache', default='ON', choices=['ON', 'OFF'], help='ハッシュ値の永続キャッシュを使用する（デフォルト: ON）')
+    parser.add_argument('--hash_cache_path', default=DEFAULT_HASH_CACHE_PATH, help=f'ハッシュキャッシュのSQLiteファイル（デフォルト: {DEFAULT_HASH_CACHE_PATH}）')
+    parser.add_argument('--probe_cache_path', default=DEFAULT_PROBE_CACHE_PATH, help=f'画像ヘッダー情報のキャッシュのSQLiteファイル（--hash_cache ON のとき使用、デフォルト: {DEFAULT_PROBE_CACHE_PATH}）')
+    parser.add_argument('--rebuild_cache', action='store_true', help='保存済みのハッシュを使わずに全画像を再計算してキャッシュを作り直す')
+    parser.add_argument('--mem_cache', default='ON', choices=['ON', 'OFF'], help='メモリキャッシュを使用する（--output_mode copy のときのみ有効、デフォルト: ON）')
     
     args = parser.parse_args()
     
     print("画像重複検出ツール")
-    print(f"処理対象ディレクトリ: {args.dir}")
+    if args.apply:
+        print(f"計画ファイル: {args.apply}")
+    else:
+        print(f"処理対象ディレクトリ: {args.dir}")
     print(f"保存先ディレクトリ: {args.save_dir}")
     print(f"対象拡張子: {args.extension}")
     print(f"類似度しきい値: {args.threshold}")
     
+    if args.method == 'embedding' and (args.reference_index or args.sequential_window > 0):
+        print("エラー: --method embedding は --reference_index・--sequential_window と同時に指定できません。")
+        sys.exit(1)
+    if args.method == 'embedding':
+        print(f"判定方法: WD14埋め込み（{args.repo_id}、コサイン類似度 {args.embedding_threshold} 以上）")
+        args.mem_cache = 'OFF'
+    
+    if args.reference_index and args.sequential_window > 0:
+        print("エラー: --reference_index と --sequential_window は同時に指定できません。")
+        sys.exit(1)
+    if args.build_reference and not args.reference_index:
+        print("エラー: --build_reference には --reference_index が必要です。")
+        sys.exit(1)
+    
+    # 索引の作成時は画像を保存しないため、デコード済み画像を保持する必要がない
+    if args.build_reference:
+        args.mem_cache = 'OFF'
+    
+    # フォルダ横断モードでは全フォルダのデコード済み画像を保持するとメモリが足りなくなる
+    if args.global_dedup and args.mem_cache == 'ON':
+        print("フォルダ横断モードではメモリキャッシュを使用しません。")
+        args.mem_cache = 'OFF'
+    
+    # ファイルを直接配置するモードではデコード済み画像を保持する必要がない
+    if args.output_mode != 'copy' and args.mem_cache == 'ON':
+        print(f"出力モード {args.output_mode} ではメモリキャッシュを使用しません。")
+        args.mem_cache = 'OFF'
+    
+    if args.plan and args.apply:
+        print("エラー: --plan と --apply は同時に指定できません。")
+        sys.exit(1)
+    if (args.plan or args.apply) and (args.method == 'embedding' or args.reference_index or args.sequential_window > 0):
+        print("エラー: --plan / --apply は --method embedding・--reference_index・--sequential_window と同時に指定できません。")
+        sys.exit(1)
+    
+    # 計画ファイルの適用
+    if args.apply:
+        if not os.path.exists(args.apply):
+            print(f"エラー: 指定された計画ファイル {args.apply} が存在しません。")
+            sys.exit(1)
+        # 画像をデコードしないのでメモリキャッシュは使わない
+        args.mem_cache = 'OFF'
     # 入力ディレクトリの存在確認
-    if not os.path.exists(args.dir):
+    elif not args.dir:
+        print("エラー: --dir を指定してください。")
+        sys.exit(1)
+    elif not os.path.exists(args.dir):
         print(f"エラー: 指定されたディレクトリ {args.dir} が存在しません。")
         sys.exit(1)
     
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import argparse
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+# 画素データをデコードせず、ヘッダーだけを読んで画像の情報を取得する
+# （他のスクリプトからは probe_images / ProbeCache を import して使う）
+
+# プローブキャッシュの既定の保存先
+DEFAULT_PROBE_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'data-kitchen', 'image_probe.sqlite')
+
+# モードごとの1画素あたりのビット数
+MODE_BITS = {
+    '1': 1, 'L': 8, 'P': 8, 'LA': 16, 'PA': 16, 'RGB': 24, 'YCbCr': 24, 'LAB': 24, 'HSV': 24,
+    'RGBA': 32, 'RGBX': 32, 'CMYK': 32, 'I': 32, 'F': 32, 'I;16': 16, 'I;16B': 16, 'I;16L': 16,
+}
+
+# probe_images の戻り値の要素型（読み込めなかった画像は width = height = -1）
+PROBE_DTYPE = np.dtype([
+    ('width', np.int32),
+    ('height', np.int32),
+    ('bits', np.int16),
+    ('file_size', np.int64),
+    ('format', 'U8'),
+])
+
+def probe_image(img_path):
+    """
+    画像のヘッダーだけを読んで (幅, 高さ, 1画素あたりのビット数, ファイルサイズ, 形式) を返す
+    Image.open は遅延読み込みのため、load() を呼ばない限り画素データはデコードされない
+    """
+    file_size = os.path.getsize(img_path)
+    try:
+        with Image.open(img_path) as img:
+            return img.width, img.height, MODE_BITS.get(img.mode, 0), file_size, img.format or ''
+    except Exception:
+        return -1, -1, 0, file_size, ''
+
+class ProbeCache:
+    """
+    画像ヘッダー情報の永続キャッシュ（SQLite）
+    (絶対パス, ファイルサイズ, mtime_ns) が一致する場合だけ保存済みの値を再利用する
+    """
+
+    def __init__(self, db_path=DEFAULT_PROBE_CACHE_PATH):
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS probes ('
+            'path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, '
+            'width INTEGER NOT NULL, height INTEGER NOT NULL, bits INTEGER NOT NULL, format TEXT NOT NULL)'
+        )
+        self.conn.commit()
+
+    def lookup(self, keys):
+        """(絶対パス, サイズ, mtime_ns) のリストに対応する保存済みの値を返す（無効な場合は None）"""
+        values = [None] * len(keys)
+        positions = {key[0]: i for i, key in enumerate(keys) if key is not None}
+        paths = list(positions)
+        # SQLiteのプレースホルダ数の上限に収まるよう分割して問い合わせる
+        for start in range(0, len(paths), 900):
+            chunk = paths[start:start + 900]
+            rows = self.conn.execute(
+                f'SELECT path, size, mtime_ns, width, height, bits, format FROM probes '
+                f'WHERE path IN ({",".join("?" * len(chunk))})',
+                chunk,
+            )
+            for path, size, mtime_ns, width, height, bits, fmt in rows:
+                i = positions[path]
+                if keys[i][1] == size and keys[i][2] == mtime_ns:
+                    values[i] = (width, height, bits, size, fmt)
+        return values
+
+    def store(self, entries):
+        """(キー, probe_image の戻り値) のリストを保存（既存の行は置き換える）"""
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO probes (path, size, mtime_ns, width, height, bits, format) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [(key[0], key[1], key[2], value[0], value[1], value[2], value[4]) for key, value in entries if key is not None],
+        )
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+def _file_key(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return os.path.abspath(path), st.st_size, st.st_mtime_ns
+
+def probe_images(img_paths, workers=8, cache=None, desc=None):
+    """
+    画像のヘッダー情報をスレッドで並列に取得する
+    cache（ProbeCache）があれば未変更のファイルは保存済みの値を使う
+    戻り値: PROBE_DTYPE の構造化配列（img_paths と同じ順序）
+    """
+    probes = np.zeros(len(img_paths), dtype=PROBE_DTYPE)
+    probes['width'] = -1
+    probes['height'] = -1
+
+    keys = [_file_key(p) for p in img_paths]
+    values = cache.lookup(keys) if cache is not None else [None] * len(img_paths)
+    pending = [i for i, (key, value) in enumerate(zip(keys, values)) if value is None and key is not None]
+
+    def probe(i):
+        try:
+            return probe_image(img_paths[i])
+        except OSError:
+            return None
+
+    if pending:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            for i, value in zip(pending, tqdm(executor.map(probe, pending), total=len(pending), desc=desc, disable=desc is None)):
+                values[i] = value
+        if cache is not None:
+            cache.store([(keys[i], values[i]) for i in pending if values[i] is not None])
+
+    for i, value in enumerate(values):
+        if value is not None:
+            probes[i] = value
+    return probes
+
+def filter_probes(probes, min_width=0, min_height=0, min_pixels=0, max_width=0, max_height=0, formats=None):
+    """ヘッダー情報の条件に合う画像の真偽値配列を返す（0 の条件は使わない）"""
+    width = probes['width'].astype(np.int64)
+    height = probes['height'].astype(np.int64)
+    keep = width >= 0
+    keep &= (width >= min_width) & (height >= min_height) & (width * height >= min_pixels)
+    if max_width:
+        keep &= width <= max_width
+    if max_height:
+        keep &= height <= max_height
+    if formats:
+        keep &= np.isin(np.char.upper(probes['format']), [f.upper() for f in formats])
+    return keep
+
+def main():
+    parser = argparse.ArgumentParser(description='画像をデコードせずにヘッダーの情報で絞り込むツール')
+    parser.add_argument('--dir', required=True, help='処理対象ディレクトリ')
+    parser.add_argument('--extension', default='jpg jpeg png webp', help='処理対象の拡張子（スペース区切り、デフォルト: jpg jpeg png webp）')
+    parser.add_argument('--recursive', action='store_true', help='サブディレクトリも探索する')
+    parser.add_argument('--min_width', type=int, default=0, help='最小の幅')
+    parser.add_argument('--min_height', type=int, default=0, help='最小の高さ')
+    parser.add_argument('--min_pixels', type=int, default=0, help='最小の画素数（幅x高さ）')
+    parser.add_argument('--max_width', type=int, default=0, help='最大の幅（0で無制限）')
+    parser.add_argument('--max_height', type=int, default=0, help='最大の高さ（0で無制限）')
+    parser.add_argument('--format', nargs='+', help='対象とする画像形式（例: JPEG PNG）')
+    parser.add_argument('--invert', action='store_true', help='条件に合わない画像を出力する')
+    parser.add_argument('--output', help='条件に合う画像のパスを書き出すファイル（省略時は標準出力）')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='並列に読むスレッド数（デフォルト: CPUコア数）')
+    parser.add_argument('--probe_cache', default='ON', choices=['ON', 'OFF'], help='ヘッダー情報の永続キャッシュを使用する（デフォルト: ON）')
+    parser.add_argument('--probe_cache_path', default=DEFAULT_PROBE_CACHE_PATH, help=f'キャッシュのSQLiteファイル（デフォルト: {DEFAULT_PROBE_CACHE_PATH}）')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.dir):
+        print(f"エラー: 指定されたディレクトリ {args.dir} が存在しません。", file=sys.stderr)
+        sys.exit(1)
+
+    extensions = tuple(f".{ext.lower()}" for ext in args.extension.split())
+    img_paths = []
+    for root, _, files in os.walk(args.dir):
+        img_paths.extend(os.path.join(root, f) for f in sorted(files) if f.lower().endswith(extensions))
+        if not args.recursive:
+            break
+
+    cache = ProbeCache(args.probe_cache_path) if args.probe_cache == 'ON' else None
+    probes = probe_images(img_paths, args.workers, cache, desc="ヘッダーの読み込み")
+    if cache is not None:
+        cache.close()
+
+    keep = filter_probes(probes, args.min_width, args.min_height, args.min_pixels, args.max_width, args.max_height, args.format)
+    if args.invert:
+        keep = ~keep & (probes['width'] >= 0)
+    selected = [p for p, ok in zip(img_paths, keep) if ok]
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            for path in selected:
+                f.write(f"{path}\n")
+    else:
+        for path in selected:
+            print(path)
+    print(f"{len(img_paths)} 枚中 {len(selected)} 枚が条件に合いました。", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
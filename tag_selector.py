@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+# WD14タガーの確率行列からキャプションのタグを選ぶ
+# （tagger / tagger_v3 から import して使う。args は各スクリプトの parse_arguments の結果）
+
+class TagSelector:
+    """
+    バッチ全体の確率行列 (N, 4 + タグ数) からまとめてタグを選ぶ
+    列ごとのしきい値ベクトルと不要タグのマスクを先に作っておき、しきい値判定とタグ頻度の集計を配列演算で行う
+    Python のループは最後のタグ文字列の結合だけに残す
+    """
+
+    def __init__(self, args, rating_tags, general_tags, character_tags):
+        self.args = args
+        self.tag_names = general_tags + character_tags
+        self.tag_name_array = np.array(self.tag_names, dtype=object)
+        self.thresholds = np.concatenate([
+            np.full(len(general_tags), args.general_threshold, dtype=np.float32),
+            np.full(len(character_tags), args.character_threshold, dtype=np.float32),
+        ])
+        # float16 で保存した確率（0以上）は、ビット列を uint16 として比べても大小関係が変わらない
+        # p >= しきい値 と同じ判定になるよう、しきい値以上で最小の float16 に切り上げておく
+        thresholds16 = self.thresholds.astype(np.float16)
+        thresholds16 = np.where(thresholds16.astype(np.float32) < self.thresholds, np.nextafter(thresholds16, np.float16(np.inf)), thresholds16)
+        self.thresholds_bits = thresholds16.view(np.uint16)
+        self.wanted = np.array([tag not in args.undesired_tags for tag in self.tag_names], dtype=bool)
+        self.is_character = np.arange(len(self.tag_names)) >= len(general_tags)
+        self.rating_names = [f"rating_{tag}" for tag in rating_tags]
+        self.rating_wanted = np.array([tag not in args.undesired_tags for tag in rating_tags], dtype=bool)
+        self.use_rating = args.use_rating_tags or args.use_rating_tags_as_last_tag
+        # --add_tag / --add_tag_position は tagger_v3.py だけのオプション
+        self.add_tags = args.add_tag.split(",") if getattr(args, "add_tag", None) else []
+        self.add_tag_position = getattr(args, "add_tag_position", "first")
+        self.tag_counts = np.zeros(len(self.tag_names), dtype=np.int64)
+        self.rating_counts = np.zeros(len(rating_tags), dtype=np.int64)
+
+    def select(self, probs):
+        """確率行列から画像ごとのキャプション文字列のリストを返す"""
+        args = self.args
+        tag_probs = probs[:, 4:4 + len(self.tag_names)]
+        if tag_probs.dtype == np.float16:
+            mask = (tag_probs.view(np.uint16) >= self.thresholds_bits) & self.wanted
+        else:
+            mask = (tag_probs >= self.thresholds) & self.wanted
+        self.tag_counts += np.add.reduce(mask, axis=0)
+
+        rows, cols = np.nonzero(mask)
+        if args.character_tags_first:
+            # キャラクタータグは1つずつ先頭に挿入していた従来の並び（後ろの列ほど前）に合わせる
+            is_character = self.is_character[cols]
+            order = np.lexsort((np.where(is_character, -cols, cols), ~is_character, rows))
+            rows, cols = rows[order], cols[order]
+        bounds = np.searchsorted(rows, np.arange(len(probs) + 1))
+        selected = self.tag_name_array[cols].tolist()
+
+        if self.use_rating:
+            ratings = probs[:, :4].argmax(axis=1)
+            has_rating = self.rating_wanted[ratings]
+            self.rating_counts += np.bincount(ratings[has_rating], minlength=len(self.rating_counts))
+
+        captions = []
+        for i in range(len(probs)):
+            combined_tags = selected[bounds[i]:bounds[i + 1]]
+
+            if self.use_rating and has_rating[i]:
+                prefixed_rating = self.rating_names[ratings[i]]
+                combined_tags.insert(0, prefixed_rating) if args.use_rating_tags else combined_tags.append(prefixed_rating)
+
+            if args.always_first_tags:
+                for tag in reversed(args.always_first_tags):
+                    if tag in combined_tags:
+                        combined_tags.remove(tag)
+                        combined_tags.insert(0, tag)
+
+            # 追加タグの処理
+            if self.add_tags:
+                # 位置に応じて追加
+                if self.add_tag_position == "last":
+                    combined_tags.extend(self.add_tags)
+                else:  # "first" または未指定の場合
+                    for tag in reversed(self.add_tags):
+                        combined_tags.insert(0, tag)
+            captions.append(args.caption_separator.join(combined_tags))
+        return captions
+
+    def tag_frequencies(self):
+        """これまでに選んだタグの出現回数"""
+        tag_freq = {}
+        for i in np.flatnonzero(self.tag_counts):
+            tag_freq[self.tag_names[i]] = tag_freq.get(self.tag_names[i], 0) + int(self.tag_counts[i])
+        for i in np.flatnonzero(self.rating_counts):
+            tag_freq[self.rating_names[i]] = int(self.rating_counts[i])
+        return tag_freq
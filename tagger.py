@@ -8,11 +8,9 @@ import threading
 import queue
 import multiprocessing
 
-import cv2
 import numpy as np
 import torch
 from huggingface_hub import hf_hub_download
-from PIL import Image
 from tqdm import tqdm
 
 import logging
@@ -20,13 +18,13 @@ import traceback
 import time
 import shutil
 
+from wd14_preprocess import IMAGE_SIZE, load_image
+from tag_selector import TagSelector
+
 # ロギングの設定
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# 画像サイズの定義
-IMAGE_SIZE = 448
-
 # デフォルトのwd14 taggerリポジトリ
 DEFAULT_WD14_TAGGER_REPO = "SmilingWolf/wd-v1-4-convnext-tagger-v2"
 FILES = ["keras_metadata.pb", "saved_model.pb", "selected_tags.csv"]
@@ -41,27 +39,10 @@ def signal_handler(signum, frame):
 
 signal.signal(signal.SIGINT, signal_handler)
 
-def preprocess_image(image):
-    image = np.array(image)
-    image = image[:, :, ::-1]  # RGB->BGR
-
-    # パディングを正方形に
-    size = max(image.shape[0:2])
-    pad_x = size - image.shape[1]
-    pad_y = size - image.shape[0]
-    pad_l = pad_x // 2
-    pad_t = pad_y // 2
-    image = np.pad(image, ((pad_t, pad_y - pad_t), (pad_l, pad_x - pad_l), (0, 0)), mode="constant", constant_values=255)
-
-    interp = cv2.INTER_AREA if size > IMAGE_SIZE else cv2.INTER_LANCZOS4
-    image = cv2.resize(image, (IMAGE_SIZE, IMAGE_SIZE), interpolation=interp)
-
-    image = image.astype(np.float32)
-    return image
-
 class ImageLoadingPrepDataset(torch.utils.data.Dataset):
-    def __init__(self, image_paths):
+    def __init__(self, image_paths, exact=False):
         self.images = image_paths
+        self.exact = exact
 
     def __len__(self):
         return len(self.images)
@@ -70,8 +51,7 @@ class ImageLoadingPrepDataset(torch.utils.data.Dataset):
         img_path = str(self.images[idx])
 
         try:
-            image = Image.open(img_path).convert("RGB")
-            image = preprocess_image(image)
+            image = load_image(img_path, self.exact)
         except Exception as e:
             logger.error(f"Could not load image path: {img_path}, error: {e}")
             return None
@@ -82,6 +62,25 @@ def collate_fn_remove_corrupted(batch):
     batch = list(filter(lambda x: x is not None, batch))
     return batch
 
+def make_data_loader(image_paths, args):
+    """
+    ワーカープロセスで画像の読み込みと前処理を行う DataLoader を作る
+    読み込めなかった画像は collate_fn_remove_corrupted でバッチから除外される
+    """
+    loader_args = {}
+    if args.max_data_loader_n_workers > 0:
+        # 推論中も次のバッチを先読みしておく
+        loader_args["prefetch_factor"] = 2
+    return torch.utils.data.DataLoader(
+        ImageLoadingPrepDataset(image_paths, args.exact_preprocess),
+        batch_size=args.batch_size,
+        shuffle=False,
+        num_workers=args.max_data_loader_n_workers,
+        collate_fn=collate_fn_remove_corrupted,
+        drop_last=False,
+        **loader_args,
+    )
+
 def load_model(args):
     model_location = os.path.join(args.model_dir, args.repo_id.replace("/", "_"))
 
@@ -155,55 +154,38 @@ def process_images(args, model, input_name, rating_tags, general_tags, character
 
     logger.info(f"Found {len(image_paths)} images.")
 
-    tag_freq = {}
+    selector = TagSelector(args, rating_tags, general_tags, character_tags)
     results = []
+    # バッチは使い回す float32 のバッファにまとめる（uint8 の画像はそこで float32 に変換される）
+    buffer = np.empty((args.batch_size, IMAGE_SIZE, IMAGE_SIZE, 3), dtype=np.float32)
 
     def process_batch(batch):
-        nonlocal tag_freq, results
-        imgs = np.array([im for _, im in batch])
+        imgs = buffer[:len(batch)]
+        for i, (_, im) in enumerate(batch):
+            imgs[i] = im
 
         if args.onnx:
             probs = model.run(None, {input_name: imgs})[0]
         else:
             probs = model(imgs, training=False).numpy()
 
-        for (image_path, _), prob in zip(batch, probs):
-            combined_tags = []
-            
-            for i, p in enumerate(prob[4:]):
-                if i < len(general_tags) and p >= args.general_threshold:
-                    tag_name = general_tags[i]
-                    if tag_name not in args.undesired_tags:
-                        tag_freq[tag_name] = tag_freq.get(tag_name, 0) + 1
-                        combined_tags.append(tag_name)
-                elif i >= len(general_tags) and p >= args.character_threshold:
-                    tag_name = character_tags[i - len(general_tags)]
-                    if tag_name not in args.undesired_tags:
-                        tag_freq[tag_name] = tag_freq.get(tag_name, 0) + 1
-                        combined_tags.insert(0, tag_name) if args.character_tags_first else combined_tags.append(tag_name)
-
-            if args.use_rating_tags or args.use_rating_tags_as_last_tag:
-                rating_index = prob[:4].argmax()
-                found_rating = rating_tags[rating_index]
-                if found_rating not in args.undesired_tags:
-                    # プレフィックスを追加
-                    prefixed_rating = f"rating_{found_rating}"
-                    tag_freq[prefixed_rating] = tag_freq.get(prefixed_rating, 0) + 1
-                    combined_tags.insert(0, prefixed_rating) if args.use_rating_tags else combined_tags.append(prefixed_rating)
-
-            if args.always_first_tags:
-                for tag in reversed(args.always_first_tags):
-                    if tag in combined_tags:
-                        combined_tags.remove(tag)
-                        combined_tags.insert(0, tag)
-
-            tag_text = args.caption_separator.join(combined_tags)
+        for (image_path, _), tag_text in zip(batch, selector.select(probs)):
             results.append((image_path, tag_text))
 
     batch_size = args.batch_size
-    for i in tqdm(range(0, len(image_paths), batch_size), desc="Processing images"):
-        batch = [(path, preprocess_image(Image.open(path).convert("RGB"))) for path in image_paths[i:i+batch_size]]
-        process_batch(batch)
+    if args.max_data_loader_n_workers is not None:
+        # 読み込みと前処理をワーカープロセスに任せ、推論と並行させる
+        for batch in tqdm(make_data_loader(image_paths, args), desc="Processing images"):
+            if batch:
+                process_batch([(path, image) for image, path in batch])
+    else:
+        for i in tqdm(range(0, len(image_paths), batch_size), desc="Processing images"):
+            batch = [(path, load_image(path, args.exact_preprocess)) for path in image_paths[i:i+batch_size]]
+            process_batch(batch)
+
+    if args.debug:
+        tag_freq = selector.tag_frequencies()
+        logger.info(f"Most frequent tags: {sorted(tag_freq.items(), key=lambda x: -x[1])[:20]}")
 
     return results
 
@@ -272,6 +254,8 @@ def main():
     parser.add_argument("--batch_size", type=int, default=1, help="Batch size for processing")
     parser.add_argument("--mem_cache", type=bool, default=True, help="Use memory cache")
     parser.add_argument("--threads", type=int, default=multiprocessing.cpu_count(), help="Number of threads to use")
+    parser.add_argument("--max_data_loader_n_workers", type=int, default=None, help="Load and preprocess images in this many DataLoader worker processes (default: disabled)")
+    parser.add_argument("--exact_preprocess", action="store_true", help="Pad at full resolution and then resize, as earlier versions did (slower and uses more memory than the default reduced-scale decode)")
 
     args = parser.parse_args()
 
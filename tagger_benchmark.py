@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import psutil
+from PIL import Image
+
+import tagger_v3
+from image_cleaner_benchmark import PeakRssSampler
+
+
+def make_random_images(directory, count, seed=0, min_size=512, max_size=1536):
+    """ベンチマーク用のさまざまなサイズ・縦横比の画像を生成する"""
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    for i in range(count):
+        height, width = rng.integers(min_size, max_size, 2)
+        small = rng.integers(0, 256, (12, 16, 3), dtype=np.uint8)
+        image = cv2.resize(small, (int(width), int(height)), interpolation=cv2.INTER_CUBIC)
+        cv2.imwrite(os.path.join(directory, f"bench_{i:05d}.jpg"), image, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    return directory
+
+
+def load_tagger(args, extra_args=()):
+    """tagger_v3 と同じ引数の解釈でモデルとタグを読み込む"""
+    tagger_args = tagger_v3.parse_arguments([
+        "--dir_image", args.dir_image,
+        "--repo_id", args.repo_id,
+        "--model_dir", args.model_dir,
+        "--threads", str(args.threads),
+        *extra_args,
+    ])
+    model, input_name = tagger_v3.load_model(tagger_args)
+    tags = tagger_v3.load_tags(os.path.join(tagger_args.model_dir, tagger_args.repo_id.replace("/", "_")))
+    return tagger_args, model, input_name, tags
+
+
+def bench_batch(args):
+    """バッチサイズごとに、推論だけの速度と読み込みから推論までの全体の速度を計測する"""
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        if not args.dir_image:
+            args.dir_image = make_random_images(os.path.join(work_dir, "images"), args.count, args.seed)
+        tagger_args, model, input_name, tags = load_tagger(args)
+        run_batch = tagger_v3.make_batch_runner(tagger_args, model, input_name)
+        providers = model.get_providers() if tagger_args.onnx else []
+
+        rng = np.random.default_rng(args.seed)
+        for batch_size in args.batch_sizes:
+            # 推論のみ: 前処理済みの配列を同じバッチサイズで繰り返し実行する
+            images = rng.uniform(0, 255, (batch_size, tagger_v3.IMAGE_SIZE, tagger_v3.IMAGE_SIZE, 3)).astype(np.float32)
+            run_batch(images)  # ウォームアップ
+            batches = max(1, args.inference_images // batch_size)
+            start = time.perf_counter()
+            for _ in range(batches):
+                run_batch(images)
+            inference_sec = time.perf_counter() - start
+
+            # 全体: process_images で読み込み・前処理・バッチ推論・タグ付けを通して実行する
+            tagger_args.batch_size = batch_size
+            start = time.perf_counter()
+            processed = tagger_v3.process_images(tagger_args, model, input_name, *tags)
+            total_sec = time.perf_counter() - start
+
+            result = {
+                "batch_size": batch_size,
+                "threads": tagger_args.threads,
+                "providers": providers,
+                "inference_images_per_sec": round(batches * batch_size / inference_sec, 2),
+                "images": len(processed),
+                "end_to_end_images_per_sec": round(len(processed) / total_sec, 2),
+            }
+            print(json.dumps(result, ensure_ascii=False))
+            results.append(result)
+    return results
+
+
+def bench_quantize(args):
+    """
+    fp32モデルとINT8動的量子化モデルを同じ画像で実行し、速度とタグ判定の一致度を比べる
+    一致度はしきい値（--general_threshold / --character_threshold）で2値化したタグごとの判定で求める
+    """
+    with tempfile.TemporaryDirectory() as work_dir:
+        if not args.dir_image:
+            args.dir_image = make_random_images(os.path.join(work_dir, "images"), args.count, args.seed)
+        threshold_args = ["--general_threshold", str(args.general_threshold), "--character_threshold", str(args.character_threshold)]
+        tagger_args, fp32_model, input_name, (rating_tags, general_tags, character_tags) = load_tagger(args, threshold_args)
+        _, int8_model, _, _ = load_tagger(args, threshold_args + ["--quantize", "dynamic"])
+
+        image_paths = sorted(
+            os.path.join(root, f) for root, _, files in os.walk(args.dir_image) for f in files
+            if f.lower().endswith(('.png', '.jpg', '.jpeg', '.webp', '.bmp'))
+        )
+        rng = np.random.default_rng(args.seed)
+        if len(image_paths) > args.count:
+            image_paths = [image_paths[i] for i in sorted(rng.choice(len(image_paths), args.count, replace=False))]
+
+        # 前処理は1回だけ行い、同じバッチを両方のモデルで実行する
+        runners = {
+            "fp32": tagger_v3.make_batch_runner(tagger_args, fp32_model, input_name),
+            "int8": tagger_v3.make_batch_runner(tagger_args, int8_model, input_name),
+        }
+        elapsed = {name: 0.0 for name in runners}
+        probs = {name: [] for name in runners}
+        for name, run_batch in runners.items():
+            run_batch(np.zeros((1, tagger_v3.IMAGE_SIZE, tagger_v3.IMAGE_SIZE, 3), dtype=np.float32))  # ウォームアップ
+        for start in range(0, len(image_paths), args.batch_size):
+            images = np.stack([
+                tagger_v3.preprocess_image(Image.open(path).convert("RGB"))
+                for path in image_paths[start:start + args.batch_size]
+            ])
+            for name, run_batch in runners.items():
+                begin = time.perf_counter()
+                probs[name].append(run_batch(images))
+                elapsed[name] += time.perf_counter() - begin
+        probs = {name: np.concatenate(chunks) for name, chunks in probs.items()}
+
+    tag_names = np.array(general_tags + character_tags)
+    thresholds = np.concatenate([
+        np.full(len(general_tags), args.general_threshold, dtype=np.float32),
+        np.full(len(character_tags), args.character_threshold, dtype=np.float32),
+    ])
+    fp32_tags = probs["fp32"][:, 4:4 + len(tag_names)] >= thresholds
+    int8_tags = probs["int8"][:, 4:4 + len(tag_names)] >= thresholds
+    agree = fp32_tags == int8_tags
+    both = np.add.reduce(fp32_tags & int8_tags, axis=None)
+
+    # 判定が食い違った回数の多いタグ
+    disagreements = np.add.reduce(~agree, axis=0)
+    worst = np.argsort(-disagreements, kind="stable")[:10]
+
+    n = len(image_paths)
+    result = {
+        "images": n,
+        "batch_size": args.batch_size,
+        "fp32_images_per_sec": round(n / elapsed["fp32"], 2),
+        "int8_images_per_sec": round(n / elapsed["int8"], 2),
+        "speedup": round(elapsed["fp32"] / elapsed["int8"], 3),
+        "tag_agreement": round(float(agree.mean()), 6),
+        "caption_exact_match": round(float(agree.all(axis=1).mean()), 4),
+        "int8_tag_precision": round(float(both / max(1, int8_tags.sum())), 4),
+        "int8_tag_recall": round(float(both / max(1, fp32_tags.sum())), 4),
+        "rating_agreement": round(float(np.mean(probs["fp32"][:, :4].argmax(1) == probs["int8"][:, :4].argmax(1))), 4),
+        "max_abs_prob_diff": round(float(np.abs(probs["fp32"] - probs["int8"]).max()), 4),
+        "most_disagreeing_tags": {str(tag_names[i]): int(disagreements[i]) for i in worst if disagreements[i] > 0},
+    }
+    print(json.dumps(result, ensure_ascii=False))
+    return [result]
+
+
+def _run_preprocess(image_paths, exact, threads):
+    """
+    新しいプロセスで前処理だけを実行する（前の計測のメモリ使用量が混ざらないように）
+    1スレッドでの1枚あたりの時間と、threads スレッドで並列に処理したときの速度・ピークRSSを返す
+    """
+    for path in image_paths[:2]:
+        tagger_v3.load_image(path, exact)  # ウォームアップ
+    start = time.perf_counter()
+    for path in image_paths:
+        tagger_v3.load_image(path, exact)
+    serial_sec = time.perf_counter() - start
+
+    rss_before = psutil.Process().memory_info().rss
+    with PeakRssSampler(interval=0.01) as sampler:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for _ in executor.map(lambda path: tagger_v3.load_image(path, exact), image_paths):
+                pass
+        parallel_sec = time.perf_counter() - start
+    return {
+        "preprocess": "exact" if exact else "fast",
+        "images": len(image_paths),
+        "threads": threads,
+        "ms_per_image": round(serial_sec / len(image_paths) * 1000, 2),
+        "parallel_images_per_sec": round(len(image_paths) / parallel_sec, 2),
+        "peak_rss_mb": round(sampler.peak / 2**20, 1),
+        "peak_rss_increase_mb": round((sampler.peak - rss_before) / 2**20, 1),
+    }
+
+
+def bench_preprocess(args):
+    """
+    従来の前処理（元の解像度でパディングしてから縮小）と、縮小デコードしてからキャンバスに貼り付ける前処理を比べる
+    速度とピークRSSに加え、2つの前処理の画素値の差も報告する
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        if not args.dir_image:
+            args.dir_image = make_random_images(os.path.join(work_dir, "images"), args.count, args.seed, args.min_size, args.max_size)
+        image_paths = sorted(
+            os.path.join(root, f) for root, _, files in os.walk(args.dir_image) for f in files
+            if f.lower().endswith(('.png', '.jpg', '.jpeg', '.webp', '.bmp'))
+        )[:args.count]
+
+        context = multiprocessing.get_context("spawn")
+        for exact in (True, False):
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                result = executor.submit(_run_preprocess, image_paths, exact, args.threads).result()
+            print(json.dumps(result, ensure_ascii=False))
+            results.append(result)
+
+        diffs = [
+            np.abs(tagger_v3.load_image(path, True) - tagger_v3.load_image(path).astype(np.float32)).mean()
+            for path in image_paths
+        ]
+    comparison = {
+        "speedup": round(results[0]["ms_per_image"] / results[1]["ms_per_image"], 2),
+        "peak_rss_increase_ratio": round(results[1]["peak_rss_increase_mb"] / max(0.1, results[0]["peak_rss_increase_mb"]), 3),
+        "mean_abs_pixel_diff": round(float(np.mean(diffs)), 3),
+    }
+    print(json.dumps(comparison, ensure_ascii=False))
+    results.append(comparison)
+    return results
+
+
+def _read_captions(directory):
+    """ディレクトリ以下のキャプションファイルを {相対パス: 内容} にする（ジャーナルなどは除く）"""
+    captions = {}
+    for root, _, files in os.walk(directory):
+        for f in files:
+            if f.endswith(".txt"):
+                path = os.path.join(root, f)
+                with open(path, 'r', encoding='utf-8') as fp:
+                    captions[os.path.relpath(path, directory).replace(os.sep, '/')] = fp.read()
+    return captions
+
+
+def bench_serve(args):
+    """
+    同じ引数でローカル実行と --server 経由の実行を行い、書き出したキャプションファイル（パスと内容）が一致するかを確かめる
+    --dir_image は相対パス・末尾に / を付けた相対パス・絶対パスの3通りで指定する（--preserve_own_folder の結果が書き方に依存するため）
+    """
+    tagger_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tagger_v3.py")
+    model_dir = os.path.abspath(args.model_dir)
+    model_args = ["--repo_id", args.repo_id, "--model_dir", model_dir, "--batch_size", str(args.batch_size)]
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        image_dir = os.path.join(work_dir, "images")
+        if args.dir_image:
+            os.symlink(os.path.abspath(args.dir_image), image_dir)
+        else:
+            make_random_images(image_dir, args.count, args.seed)
+
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        server_url = f"http://127.0.0.1:{port}"
+        server = subprocess.Popen(
+            [sys.executable, tagger_script, "serve", "--port", str(port), *model_args],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            # モデルを読み込み終えて /health に応答するまで待つ
+            deadline = time.perf_counter() + args.startup_timeout
+            while True:
+                try:
+                    with urllib.request.urlopen(server_url + "/health"):
+                        break
+                except (urllib.error.URLError, ConnectionError):
+                    if server.poll() is not None or time.perf_counter() > deadline:
+                        raise RuntimeError("tagger_v3.py serve did not start")
+                    time.sleep(0.5)
+
+            for dir_image in ("images", "images/", image_dir):
+                timings = {}
+                for mode in ("local", "server"):
+                    dir_save = f"out_{mode}"
+                    command = [sys.executable, tagger_script, "--dir_image", dir_image, "--dir_save", dir_save, *model_args]
+                    if mode == "server":
+                        command += ["--server", server_url]
+                    start = time.perf_counter()
+                    subprocess.run(command, cwd=work_dir, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                    timings[mode] = time.perf_counter() - start
+                local = _read_captions(os.path.join(work_dir, "out_local"))
+                served = _read_captions(os.path.join(work_dir, "out_server"))
+                result = {
+                    "dir_image": "(absolute path)" if os.path.isabs(dir_image) else dir_image,
+                    "captions": len(local),
+                    "identical": local == served,
+                    "mismatched_paths": sorted(set(local) ^ set(served))[:5],
+                    "local_seconds": round(timings["local"], 3),
+                    "server_seconds": round(timings["server"], 3),
+                }
+                print(json.dumps(result, ensure_ascii=False))
+                results.append(result)
+                for mode in ("local", "server"):
+                    shutil.rmtree(os.path.join(work_dir, f"out_{mode}"))
+        finally:
+            server.terminate()
+            server.wait()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='tagger_v3 のベンチマーク')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_batch = subparsers.add_parser('batch', help='バッチサイズごとの推論速度を計測する')
+    parser_batch.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 8, 32], help='計測するバッチサイズ（デフォルト: 1 8 32）')
+    parser_batch.add_argument('--dir_image', help='計測に使う画像ディレクトリ（省略時はランダムな画像を生成する）')
+    parser_batch.add_argument('--count', type=int, default=256, help='生成する画像数（デフォルト: 256）')
+    parser_batch.add_argument('--inference_images', type=int, default=256, help='推論のみの計測で処理する画像数（デフォルト: 256）')
+    parser_batch.add_argument('--repo_id', default=tagger_v3.DEFAULT_WD14_TAGGER_REPO, help='wd14 tagger のリポジトリID')
+    parser_batch.add_argument('--model_dir', default='./models', help='モデルの保存先')
+    parser_batch.add_argument('--threads', type=int, default=os.cpu_count() or 1, help='前処理のスレッド数（デフォルト: CPUコア数）')
+    parser_batch.add_argument('--seed', type=int, default=0, help='乱数シード')
+    parser_batch.add_argument('--output', help='結果を書き出すJSONファイル')
+
+    parser_quantize = subparsers.add_parser('quantize', help='fp32モデルとINT8動的量子化モデルの速度とタグの一致度を比べる')
+    parser_quantize.add_argument('--dir_image', help='比較に使う画像ディレクトリ（省略時はランダムな画像を生成する）')
+    parser_quantize.add_argument('--count', type=int, default=128, help='比較する画像数（多い場合はランダムに抽出、デフォルト: 128）')
+    parser_quantize.add_argument('--batch_size', type=int, default=8, help='バッチサイズ（デフォルト: 8）')
+    parser_quantize.add_argument('--general_threshold', type=float, default=0.35, help='一般タグのしきい値（デフォルト: 0.35）')
+    parser_quantize.add_argument('--character_threshold', type=float, default=0.35, help='キャラクタータグのしきい値（デフォルト: 0.35）')
+    parser_quantize.add_argument('--repo_id', default=tagger_v3.DEFAULT_WD14_TAGGER_REPO, help='wd14 tagger のリポジトリID')
+    parser_quantize.add_argument('--model_dir', default='./models', help='モデルの保存先')
+    parser_quantize.add_argument('--threads', type=int, default=os.cpu_count() or 1, help='スレッド数（デフォルト: CPUコア数）')
+    parser_quantize.add_argument('--seed', type=int, default=0, help='乱数シード')
+    parser_quantize.add_argument('--output', help='結果を書き出すJSONファイル')
+
+    parser_preprocess = subparsers.add_parser('preprocess', help='従来の前処理と縮小デコードによる前処理の速度・ピークRSSを比べる')
+    parser_preprocess.add_argument('--dir_image', help='計測に使う画像ディレクトリ（省略時は大きなランダム画像を生成する）')
+    parser_preprocess.add_argument('--count', type=int, default=16, help='計測する画像数（デフォルト: 16）')
+    parser_preprocess.add_argument('--min_size', type=int, default=3000, help='生成する画像の辺の最小値（デフォルト: 3000）')
+    parser_preprocess.add_argument('--max_size', type=int, default=6000, help='生成する画像の辺の最大値（デフォルト: 6000）')
+    parser_preprocess.add_argument('--threads', type=int, default=os.cpu_count() or 1, help='並列計測のスレッド数（デフォルト: CPUコア数）')
+    parser_preprocess.add_argument('--seed', type=int, default=0, help='乱数シード')
+    parser_preprocess.add_argument('--output', help='結果を書き出すJSONファイル')
+
+    parser_serve = subparsers.add_parser('serve', help='ローカル実行と --server 経由の実行で同じキャプションファイルが書き出されるかを確かめ、所要時間を比べる')
+    parser_serve.add_argument('--dir_image', help='比較に使う画像ディレクトリ（省略時はランダムな画像を生成する）')
+    parser_serve.add_argument('--count', type=int, default=32, help='生成する画像数（デフォルト: 32）')
+    parser_serve.add_argument('--batch_size', type=int, default=8, help='バッチサイズ（デフォルト: 8）')
+    parser_serve.add_argument('--repo_id', default=tagger_v3.DEFAULT_WD14_TAGGER_REPO, help='wd14 tagger のリポジトリID')
+    parser_serve.add_argument('--model_dir', default='./models', help='モデルの保存先')
+    parser_serve.add_argument('--startup_timeout', type=float, default=300, help='サーバーの起動を待つ秒数（デフォルト: 300）')
+    parser_serve.add_argument('--seed', type=int, default=0, help='乱数シード')
+    parser_serve.add_argument('--output', help='結果を書き出すJSONファイル')
+
+    args = parser.parse_args()
+
+    if args.command == 'batch':
+        results = bench_batch(args)
+    elif args.command == 'quantize':
+        results = bench_quantize(args)
+    elif args.command == 'preprocess':
+        results = bench_preprocess(args)
+    elif args.command == 'serve':
+        results = bench_serve(args)
+        if not all(result["identical"] for result in results):
+            sys.exit(1)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,21 @@
 import argparse
+import collections
 import csv
+import json
 import os
+import platform
 import signal
 import sys
 from pathlib import Path
 import threading
 import queue
 import multiprocessing
-from concurrent.futures import ThreadPoolExecutor
+import urllib.error
+import urllib.request
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
 
-import cv2
 import numpy as np
-import torch
-from huggingface_hub import hf_hub_download
-from PIL import Image
 from tqdm import tqdm
 
 import logging
@@ -23,13 +25,14 @@ import shutil
 import psutil
 import random
 
+from dataset_shard import ShardManifest, parse_shard, select_shard
+from wd14_preprocess import IMAGE_SIZE, preprocess_image, load_image
+from tag_selector import TagSelector
+
 # ロギングの設定
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# 画像サイズの定義
-IMAGE_SIZE = 448
-
 # デフォルトのwd14 taggerリポジトリ
 DEFAULT_WD14_TAGGER_REPO = "SmilingWolf/wd-v1-4-convnext-tagger-v2"
 FILES = ["keras_metadata.pb", "saved_model.pb", "selected_tags.csv"]
@@ -38,6 +41,15 @@ SUB_DIR = "variables"
 SUB_DIR_FILES = ["variables.data-00000-of-00001", "variables.index"]
 CSV_FILE = FILES[-1]
 
+# serve モードの既定のポート
+DEFAULT_SERVER_PORT = 8765
+
+# --autotune の結果のキャッシュ（マシンとモデルごと）
+AUTOTUNE_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "data-kitchen", "tagger_v3_autotune.json")
+
+# 書き出したキャプションを記録するジャーナル（--dir_save 直下、--resume で使う）
+JOURNAL_FILE = "tagger_journal.jsonl"
+
 # 停止フラグ（スレッド間で共有）
 stop_processing = False
 
@@ -93,28 +105,12 @@ def get_optimal_thread_count():
     
     return optimal_threads
 
-@retry_on_error(max_retries=3, delay=1)
-def preprocess_image(image):
-    image = np.array(image)
-    image = image[:, :, ::-1]  # RGB->BGR
-
-    # パディングを正方形に
-    size = max(image.shape[0:2])
-    pad_x = size - image.shape[1]
-    pad_y = size - image.shape[0]
-    pad_l = pad_x // 2
-    pad_t = pad_y // 2
-    image = np.pad(image, ((pad_t, pad_y - pad_t), (pad_l, pad_x - pad_l), (0, 0)), mode="constant", constant_values=255)
-
-    interp = cv2.INTER_AREA if size > IMAGE_SIZE else cv2.INTER_LANCZOS4
-    image = cv2.resize(image, (IMAGE_SIZE, IMAGE_SIZE), interpolation=interp)
-
-    image = image.astype(np.float32)
-    return image
-
-class ImageLoadingPrepDataset(torch.utils.data.Dataset):
-    def __init__(self, image_paths):
+# torch.utils.data.DataLoader は __len__ と __getitem__ があれば使えるので、torch を継承せずに定義する
+# （torch は --max_data_loader_n_workers を使うときだけ読み込む）
+class ImageLoadingPrepDataset:
+    def __init__(self, image_paths, exact=False):
         self.images = image_paths
+        self.exact = exact
 
     def __len__(self):
         return len(self.images)
@@ -123,8 +119,7 @@ class ImageLoadingPrepDataset(torch.utils.data.Dataset):
         img_path = str(self.images[idx])
 
         try:
-            image = Image.open(img_path).convert("RGB")
-            image = preprocess_image(image)
+            image = load_image(img_path, self.exact)
         except Exception as e:
             logger.error(f"Could not load image path: {img_path}, error: {e}")
             return None
@@ -135,11 +130,71 @@ def collate_fn_remove_corrupted(batch):
     batch = list(filter(lambda x: x is not None, batch))
     return batch
 
+def make_data_loader(image_paths, args):
+    """
+    ワーカープロセスで画像の読み込みと前処理を行う DataLoader を作る
+    読み込めなかった画像は collate_fn_remove_corrupted でバッチから除外される
+    """
+    import torch
+
+    loader_args = {}
+    if args.max_data_loader_n_workers > 0:
+        # 推論中も次のバッチを先読みしておく
+        loader_args["prefetch_factor"] = 2
+    return torch.utils.data.DataLoader(
+        ImageLoadingPrepDataset(image_paths, args.exact_preprocess),
+        batch_size=args.batch_size,
+        shuffle=False,
+        num_workers=args.max_data_loader_n_workers,
+        collate_fn=collate_fn_remove_corrupted,
+        drop_last=False,
+        **loader_args,
+    )
+
+def get_quantized_model(onnx_path, mode="dynamic"):
+    """
+    量子化したモデルを元のモデルの隣に作ってキャッシュし、そのパスを返す（元のモデルより古ければ作り直す）
+    dynamic: 重みをINT8に量子化し、活性は実行時に量子化する。MatMul/Gemm だけを対象にする
+    （Conv を ConvInteger にするとCPUでかえって遅くなることが多いため）
+    """
+    quantized_path = os.path.splitext(onnx_path)[0] + f".int8-{mode}.onnx"
+    if os.path.exists(quantized_path) and os.path.getmtime(quantized_path) >= os.path.getmtime(onnx_path):
+        return quantized_path
+
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    logger.info(f"Quantizing {onnx_path} ({mode}), this is done only once...")
+    temp_path = quantized_path + ".tmp"
+    quantize_dynamic(onnx_path, temp_path, op_types_to_quantize=["MatMul", "Gemm"], weight_type=QuantType.QInt8)
+    os.replace(temp_path, quantized_path)
+    return quantized_path
+
+def create_session_options(args):
+    """ONNX Runtime のスレッド数と実行モードの設定を作る（0 のスレッド数は既定値のまま）"""
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    if args.intra_op_threads > 0:
+        options.intra_op_num_threads = args.intra_op_threads
+    if args.inter_op_threads > 0:
+        options.inter_op_num_threads = args.inter_op_threads
+    options.execution_mode = ort.ExecutionMode.ORT_PARALLEL if args.execution_mode == "parallel" else ort.ExecutionMode.ORT_SEQUENTIAL
+    return options
+
+def get_onnx_path(args):
+    """実際に読み込むONNXモデルのパス（--quantize の場合は量子化済みのモデル）"""
+    onnx_path = os.path.join(args.model_dir, args.repo_id.replace("/", "_"), "model.onnx")
+    if args.quantize != "none":
+        onnx_path = get_quantized_model(onnx_path, args.quantize)
+    return onnx_path
+
 @retry_on_error(max_retries=3, delay=2)
 def load_model(args):
     model_location = os.path.join(args.model_dir, args.repo_id.replace("/", "_"))
 
     if not os.path.exists(model_location) or args.force_download:
+        from huggingface_hub import hf_hub_download
+
         os.makedirs(args.model_dir, exist_ok=True)
         logger.info(f"Downloading wd14 tagger model from hf_hub. id: {args.repo_id}")
         files = FILES
@@ -169,7 +224,6 @@ def load_model(args):
         logger.info("Using existing wd14 tagger model")
 
     if args.onnx:
-        import onnx
         import onnxruntime as ort
 
         onnx_path = f"{model_location}/model.onnx"
@@ -178,17 +232,20 @@ def load_model(args):
         if not os.path.exists(onnx_path):
             raise Exception(f"ONNX model not found: {onnx_path}")
 
-        model = onnx.load(onnx_path)
-        input_name = model.graph.input[0].name
-        
         providers = (
             ["CUDAExecutionProvider"] if "CUDAExecutionProvider" in ort.get_available_providers() else
             ["ROCMExecutionProvider"] if "ROCMExecutionProvider" in ort.get_available_providers() else
             ["CPUExecutionProvider"]
         )
+        if args.quantize != "none":
+            # 動的量子化したINT8モデルはCPU向けなので、CPUで実行する
+            onnx_path = get_quantized_model(onnx_path, args.quantize)
+            providers = ["CPUExecutionProvider"]
+            logger.info(f"Using quantized ONNX model: {onnx_path}")
         logger.info(f"Using ONNX providers: {providers}")
-        ort_sess = ort.InferenceSession(onnx_path, providers=providers)
-        return ort_sess, input_name
+        ort_sess = ort.InferenceSession(onnx_path, sess_options=create_session_options(args), providers=providers)
+        # 入力名はセッションから取得する（onnx.load でモデル全体を読み直さない）
+        return ort_sess, ort_sess.get_inputs()[0].name
     else:
         from tensorflow.keras.models import load_model
         return load_model(f"{model_location}"), None
@@ -205,9 +262,221 @@ def load_tags(model_location):
 
     return rating_tags, general_tags, character_tags
 
-def process_images(args, model, input_name, rating_tags, general_tags, character_tags):
-    global stop_processing
-    
+class InferenceBatcher:
+    """
+    ワーカースレッドが前処理した画像を固定サイズのバッチにまとめ、1バッチにつき1回だけモデルを実行する
+    推論は専用スレッド1本で行い、結果は submit が返した Future に振り分ける
+    バッチが揃わなくても最初の画像から timeout 秒経てば実行する（最後の半端なバッチが止まらないように）
+    バッチは使い回す float32 のバッファにまとめる（uint8 の画像はそこで float32 に変換される）
+    close の後の submit や、close の時点でキューに残っていた画像の Future はキャンセルされる
+    """
+
+    def __init__(self, run_batch, batch_size, timeout=0.1):
+        self.run_batch = run_batch
+        self.batch_size = max(1, batch_size)
+        self.timeout = timeout
+        # 推論が前処理に追いつかない場合にメモリを使い切らないよう、待機できる画像数を制限する
+        self.pending = queue.Queue(maxsize=self.batch_size * 4)
+        self.buffer = None
+        self.closed = False
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, image):
+        future = Future()
+        # キューが一杯の間に close された場合に待ち続けないよう、短い間隔で closed を確かめながら待つ
+        while not self.closed:
+            try:
+                self.pending.put((image, future), timeout=0.1)
+                return future
+            except queue.Full:
+                continue
+        future.cancel()
+        return future
+
+    def close(self):
+        """推論スレッドを止める。キューに残っている画像は推論せずにキャンセルする"""
+        self.closed = True
+        self._cancel_pending()
+        while True:
+            try:
+                self.pending.put_nowait(None)
+                break
+            except queue.Full:
+                self._cancel_pending()
+        self.thread.join()
+        self._cancel_pending()  # 終了の合図より後に入った画像
+
+    def _cancel_pending(self):
+        while True:
+            try:
+                item = self.pending.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None:
+                item[1].cancel()
+
+    def _loop(self):
+        closed = False
+        while not closed:
+            item = self.pending.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.timeout
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.pending.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    closed = True
+                    break
+                batch.append(item)
+            self._run(batch)
+
+    def _run(self, batch):
+        try:
+            probs = self.run_batch(self._stack([image for image, _ in batch]))
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), image_probs in zip(batch, probs):
+            future.set_result(image_probs)
+
+    def _stack(self, images):
+        # 推論は同期的に行うので、run_batch から戻ればバッファは次のバッチに使い回せる
+        shape = (self.batch_size, *images[0].shape)
+        if self.buffer is None or self.buffer.shape != shape:
+            self.buffer = np.empty(shape, dtype=np.float32)
+        batch = self.buffer[:len(images)]
+        for i, image in enumerate(images):
+            batch[i] = image
+        return batch
+
+class ModelEnsemble:
+    """
+    複数モデルのタグ表をタグ名で揃え、同じバッチに対する各モデルの確率を1つの確率行列にまとめる
+    まとめた行列の列は [レーティング, 一般タグ, キャラクタータグ] の順（いずれかのモデルにあるタグの和集合）
+      max:  モデル間の最大値
+      mean: そのタグを持つモデル間の平均
+      vote: しきい値を超えたモデルの割合が vote_ratio 以上のタグだけを残し、値は賛成したモデルの平均
+            （賛成したモデルの確率はしきい値以上なので、TagSelector は投票で残ったタグをそのまま選ぶ）
+            レーティングは各モデルの最大のレーティングへの票の割合
+    vote のしきい値と割合は combine の呼び出しごとに渡す（serve ではジョブごとに異なるため）
+    """
+
+    REDUCTIONS = ["max", "mean", "vote"]
+
+    def __init__(self, tag_tables, reduction="max"):
+        self.reduction = reduction
+        self.rating_tags, self.general_tags, self.character_tags = [], [], []
+        positions = ({}, {}, {})
+        for table in tag_tables:
+            for names, unified, position in zip(table, (self.rating_tags, self.general_tags, self.character_tags), positions):
+                for name in names:
+                    if name not in position:
+                        position[name] = len(unified)
+                        unified.append(name)
+        if len(self.rating_tags) != 4:
+            raise ValueError(f"The models do not share the same 4 rating tags: {self.rating_tags}")
+
+        # 各モデルの出力列が、まとめた行列のどの列に対応するか
+        offsets = (0, len(self.rating_tags), len(self.rating_tags) + len(self.general_tags))
+        self.n_columns = offsets[2] + len(self.character_tags)
+        self.columns = []
+        self.n_general = []
+        for rating, general, character in tag_tables:
+            self.columns.append(np.array(
+                [offsets[0] + positions[0][name] for name in rating] +
+                [offsets[1] + positions[1][name] for name in general] +
+                [offsets[2] + positions[2][name] for name in character], dtype=np.int64,
+            ))
+            self.n_general.append(len(general))
+        self.counts = np.zeros(self.n_columns, dtype=np.float32)
+        for columns in self.columns:
+            self.counts[columns] += 1
+
+    @property
+    def tags(self):
+        return self.rating_tags, self.general_tags, self.character_tags
+
+    def combine(self, probs_list, general_threshold=0.35, character_threshold=0.35, vote_ratio=0.5):
+        """各モデルの (N, 列数) の確率のリストを、まとめた (N, self.n_columns) の確率にする"""
+        n = len(probs_list[0])
+        combined = np.zeros((n, self.n_columns), dtype=np.float32)
+        if self.reduction == "max":
+            for columns, probs in zip(self.columns, probs_list):
+                combined[:, columns] = np.maximum(combined[:, columns], probs[:, :len(columns)])
+        elif self.reduction == "mean":
+            for columns, probs in zip(self.columns, probs_list):
+                combined[:, columns] += probs[:, :len(columns)]
+            combined /= self.counts
+        else:
+            votes = np.zeros((n, self.n_columns), dtype=np.float32)
+            rows = np.arange(n)
+            for columns, n_general, probs in zip(self.columns, self.n_general, probs_list):
+                n_rating = 4
+                tag_columns = columns[n_rating:]
+                tag_probs = probs[:, n_rating:len(columns)]
+                thresholds = np.where(np.arange(len(tag_columns)) < n_general, general_threshold, character_threshold).astype(np.float32)
+                yes = tag_probs >= thresholds
+                votes[:, tag_columns] += yes
+                combined[:, tag_columns] += np.where(yes, tag_probs, 0)
+                votes[rows, columns[probs[:, :n_rating].argmax(axis=1)]] += 1
+            accepted = votes >= vote_ratio * self.counts
+            combined = np.where(accepted & (votes > 0), combined / np.maximum(votes, 1), 0).astype(np.float32)
+            combined[:, :4] = votes[:, :4] / self.counts[:4]
+        return combined
+
+class EnsembleSession:
+    """
+    複数のONNXセッションを1つのセッションのように扱う
+    同じ前処理済みのバッチを全モデルに流し、確率を ModelEnsemble でまとめて返す
+    run に settings（引数の Namespace）を渡すとそのしきい値・投票の割合で、渡さない場合は読み込み時の設定でまとめる
+    """
+
+    def __init__(self, sessions, ensemble, settings):
+        self.sessions = sessions
+        self.input_names = [session.get_inputs()[0].name for session in sessions]
+        self.ensemble = ensemble
+        self.settings = settings
+
+    def get_inputs(self):
+        return self.sessions[0].get_inputs()
+
+    def get_providers(self):
+        return self.sessions[0].get_providers()
+
+    def run(self, output_names, feeds, settings=None):
+        settings = settings or self.settings
+        images = next(iter(feeds.values()))
+        probs_list = [session.run(None, {name: images})[0] for session, name in zip(self.sessions, self.input_names)]
+        return [self.ensemble.combine(probs_list, settings.general_threshold, settings.character_threshold, settings.ensemble_vote_ratio)]
+
+def make_batch_runner(args, model, input_name):
+    """(N, 448, 448, 3) の配列を受け取り (N, タグ数) の確率を返す関数を作る"""
+    if args.onnx:
+        if isinstance(model, EnsembleSession):
+            # 複数モデルの投票は、このジョブのしきい値で行う（serve で共有するセッションでも）
+            run_model = lambda images: model.run(None, {input_name: images}, args)[0]
+        else:
+            run_model = lambda images: model.run(None, {input_name: images})[0]
+        model_batch_size = model.get_inputs()[0].shape[0]
+        if isinstance(model_batch_size, int) and model_batch_size > 0:
+            # バッチ次元が固定されたモデルでは、半端なバッチを埋めて実行し、埋めた分の結果を捨てる
+            def run_fixed_batch(images):
+                n = len(images)
+                if n < model_batch_size:
+                    images = np.concatenate([images, np.zeros((model_batch_size - n, *images.shape[1:]), dtype=images.dtype)])
+                return run_model(images)[:n]
+            return run_fixed_batch
+        return run_model
+    return lambda images: model(images, training=False).numpy()
+
+def list_images(args):
+    """--dir_image の画像ファイル（単一ファイルの指定にも対応）を列挙する"""
     image_paths = []
     if os.path.isfile(args.dir_image):
         image_paths = [args.dir_image]
@@ -218,68 +487,48 @@ def process_images(args, model, input_name, rating_tags, general_tags, character
                     image_paths.append(os.path.join(root, file))
             if not args.recursive:
                 break
+    if args.shard:
+        # 複数マシンで分担する場合は、相対パスのハッシュでこのシャードに割り当てられた画像だけを処理する
+        selected = select_shard(image_paths, args.dir_image, args.shard)
+        logger.info(f"Shard {args.shard[0]}/{args.shard[1]}: {len(selected)} of {len(image_paths)} images.")
+        return selected
+    return image_paths
 
-    logger.info(f"Found {len(image_paths)} images.")
+def process_images(args, model, input_name, rating_tags, general_tags, character_tags, writer=None, image_paths=None):
+    """
+    画像にタグ付けする
+    writer（CaptionWriter）を渡すと結果をその場で書き出し、渡さない場合は (画像パス, キャプション) のリストを返す
+    image_paths を渡すと --dir_image を探索せずにその画像だけを処理する
+    """
+    global stop_processing
+    
+    if image_paths is None:
+        image_paths = list_images(args)
+        logger.info(f"Found {len(image_paths)} images.")
+        if args.resume:
+            image_paths = filter_resumed(args, image_paths)
 
-    tag_freq = {}
-    results_queue = queue.Queue()
+    selector = TagSelector(args, rating_tags, general_tags, character_tags)
+    run_batch = make_batch_runner(args, model, input_name)
+    
+    def run_and_select(images):
+        # タグの選択も推論スレッドでバッチ単位に行い、画像ごとの (キャプション, 保存用の確率) を振り分ける
+        probs = run_batch(images)
+        captions = selector.select(probs)
+        if args.save_probs:
+            return list(zip(captions, probs.astype(np.float16)))
+        return [(caption, None) for caption in captions]
+    
+    batcher = InferenceBatcher(run_and_select, args.batch_size, args.batch_timeout)
     
     def process_image(image_path):
+        # ワーカースレッドでは読み込みと前処理だけを行い、推論はバッチにまとめて実行する
         if stop_processing:
             return None
         
         try:
-            image = Image.open(image_path).convert("RGB")
-            processed_image = preprocess_image(image)
-            
-            if args.onnx:
-                probs = model.run(None, {input_name: np.array([processed_image])})[0][0]
-            else:
-                probs = model(np.array([processed_image]), training=False).numpy()[0]
-            
-            combined_tags = []
-            local_tag_freq = {}
-            
-            for i, p in enumerate(probs[4:]):
-                if i < len(general_tags) and p >= args.general_threshold:
-                    tag_name = general_tags[i]
-                    if tag_name not in args.undesired_tags:
-                        local_tag_freq[tag_name] = local_tag_freq.get(tag_name, 0) + 1
-                        combined_tags.append(tag_name)
-                elif i >= len(general_tags) and p >= args.character_threshold:
-                    tag_name = character_tags[i - len(general_tags)]
-                    if tag_name not in args.undesired_tags:
-                        local_tag_freq[tag_name] = local_tag_freq.get(tag_name, 0) + 1
-                        combined_tags.insert(0, tag_name) if args.character_tags_first else combined_tags.append(tag_name)
-
-            if args.use_rating_tags or args.use_rating_tags_as_last_tag:
-                rating_index = probs[:4].argmax()
-                found_rating = rating_tags[rating_index]
-                if found_rating not in args.undesired_tags:
-                    # プレフィックスを追加
-                    prefixed_rating = f"rating_{found_rating}"
-                    local_tag_freq[prefixed_rating] = local_tag_freq.get(prefixed_rating, 0) + 1
-                    combined_tags.insert(0, prefixed_rating) if args.use_rating_tags else combined_tags.append(prefixed_rating)
-
-            if args.always_first_tags:
-                for tag in reversed(args.always_first_tags):
-                    if tag in combined_tags:
-                        combined_tags.remove(tag)
-                        combined_tags.insert(0, tag)
-            
-            # 追加タグの処理
-            if args.add_tag:
-                add_tags = args.add_tag.split(",")
-                # 位置に応じて追加
-                if args.add_tag_position == "last":
-                    combined_tags.extend(add_tags)
-                else:  # "first" または未指定の場合
-                    for tag in reversed(add_tags):
-                        combined_tags.insert(0, tag)
-            
-            tag_text = args.caption_separator.join(combined_tags)
-            
-            return (image_path, tag_text, local_tag_freq)
+            processed_image = load_image(image_path, args.exact_preprocess)
+            return (image_path, batcher.submit(processed_image))
         
         except Exception as e:
             logger.error(f"Error processing image {image_path}: {e}")
@@ -287,36 +536,106 @@ def process_images(args, model, input_name, rating_tags, general_tags, character
                 logger.error(traceback.format_exc())
             return None
     
-    # スレッドプールで処理を実行
-    with ThreadPoolExecutor(max_workers=args.threads) as executor:
-        futures = [executor.submit(process_image, path) for path in image_paths]
-        
-        results = []
-        for future in tqdm(futures, desc="Processing images", total=len(image_paths)):
+    worker_futures = []
+    
+    def submitted_images():
+        """推論に投入した (画像パス, キャプションの Future) を入力順に返す"""
+        if args.max_data_loader_n_workers is not None:
+            # ワーカープロセスが読み込んだバッチを推論に投入し、完了したものから順に返す
+            pending = collections.deque()
+            for batch in make_data_loader(image_paths, args):
+                for image, image_path in batch:
+                    pending.append((image_path, batcher.submit(image)))
+                while pending and pending[0][1].done():
+                    yield pending.popleft()
+            yield from pending
+        else:
+            # スレッドプールで読み込みと前処理を実行
+            with ThreadPoolExecutor(max_workers=args.threads) as executor:
+                worker_futures.extend(executor.submit(process_image, path) for path in image_paths)
+                for future in worker_futures:
+                    result = future.result()
+                    if result is not None:
+                        yield result
+    
+    results = []
+    processed = 0
+    submitted = submitted_images()
+    try:
+        for image_path, caption_future in tqdm(submitted, desc="Processing images", total=len(image_paths)):
             if stop_processing:
                 break
                 
             try:
-                result = future.result()
-                if result is not None:
-                    image_path, tag_text, local_tag_freq = result
+                tag_text, image_probs = caption_future.result()
+                if writer is not None:
+                    writer.put(image_path, tag_text, image_probs)
+                else:
                     results.append((image_path, tag_text))
-                    
-                    # タグ頻度をメインのディクショナリに集約
-                    for tag, count in local_tag_freq.items():
-                        tag_freq[tag] = tag_freq.get(tag, 0) + count
+                processed += 1
+            except CaptionWriterError:
+                raise
             except Exception as e:
-                logger.error(f"Error getting result: {e}")
+                logger.error(f"Error processing image {image_path}: {e}")
                 if args.debug:
                     logger.error(traceback.format_exc())
+    finally:
+        # 中断時は、submit で待っているワーカーを batcher.close で解放し、まだ始まっていない読み込みを取り消してから
+        # ジェネレーター（スレッドプール）を閉じる
+        batcher.close()
+        for future in worker_futures:
+            future.cancel()
+        submitted.close()
     
     if stop_processing:
         logger.info("Processing was interrupted by user.")
     else:
-        logger.info(f"Processed {len(results)} images successfully.")
+        logger.info(f"Processed {processed} images successfully.")
+        if args.debug:
+            tag_freq = selector.tag_frequencies()
+            logger.info(f"Most frequent tags: {sorted(tag_freq.items(), key=lambda x: -x[1])[:20]}")
         
     return results
 
+def get_caption_path(args, image_path):
+    """画像に対応するキャプションファイルのパスを返す"""
+    # 入力が単一のファイルかディレクトリかを判断
+    if os.path.isfile(args.dir_image):
+        relative_path = os.path.basename(image_path)
+    else:
+        relative_path = os.path.relpath(image_path, args.dir_image)
+
+    # preserve_own_folder処理
+    if args.preserve_own_folder:
+        output_path = os.path.join(args.dir_save, args.own_folder, relative_path)
+    else:
+        output_path = os.path.join(args.dir_save, relative_path)
+
+    # preserve_structure処理
+    if not args.preserve_structure:
+        output_path = os.path.join(args.dir_save, os.path.basename(relative_path))
+
+    return os.path.splitext(output_path)[0] + args.caption_extension
+
+def write_caption(args, image_path, tag_text):
+    caption_file = get_caption_path(args, image_path)
+    
+    if args.append_tags and os.path.exists(caption_file):
+        with open(caption_file, "r", encoding="utf-8") as f:
+            existing_content = f.read().strip()
+        existing_tags = set(existing_content.split(args.caption_separator))
+        new_tags = set(tag_text.split(args.caption_separator))
+        combined_tags = existing_tags.union(new_tags)
+        tag_text = args.caption_separator.join(sorted(combined_tags))
+
+    os.makedirs(os.path.dirname(caption_file), exist_ok=True)
+    with open(caption_file, "w", encoding="utf-8") as f:
+        f.write(tag_text + "\n")
+
+    if args.debug:
+        logger.info(f"Processed: {image_path}")
+        logger.info(f"Tags: {tag_text}")
+
 @retry_on_error(max_retries=3, delay=1)
 def save_results(args, results):
     if stop_processing:
@@ -324,59 +643,410 @@ def save_results(args, results):
         
     with tqdm(total=len(results), desc="Saving results") as pbar:
         for image_path, tag_text in results:
-            # 入力が単一のファイルかディレクトリかを判断
-            if os.path.isfile(args.dir_image):
-                relative_path = os.path.basename(image_path)
-            else:
-                relative_path = os.path.relpath(image_path, args.dir_image)
-
-            # preserve_own_folder処理
-            if args.preserve_own_folder:
-                own_folder = os.path.basename(os.path.dirname(args.dir_image))
-                output_path = os.path.join(args.dir_save, own_folder, relative_path)
-            else:
-                output_path = os.path.join(args.dir_save, relative_path)
-
-            # preserve_structure処理
-            if args.preserve_structure:
-                os.makedirs(os.path.dirname(output_path), exist_ok=True)
-            else:
-                output_path = os.path.join(args.dir_save, os.path.basename(relative_path))
-
-            caption_file = os.path.splitext(output_path)[0] + args.caption_extension
-            
-            if args.append_tags and os.path.exists(caption_file):
-                with open(caption_file, "r", encoding="utf-8") as f:
-                    existing_content = f.read().strip()
-                existing_tags = set(existing_content.split(args.caption_separator))
-                new_tags = set(tag_text.split(args.caption_separator))
-                combined_tags = existing_tags.union(new_tags)
-                tag_text = args.caption_separator.join(sorted(combined_tags))
-
-            os.makedirs(os.path.dirname(caption_file), exist_ok=True)
-            with open(caption_file, "w", encoding="utf-8") as f:
-                f.write(tag_text + "\n")
-
-            if args.debug:
-                logger.info(f"Processed: {image_path}")
-                logger.info(f"Tags: {tag_text}")
-                
+            write_caption(args, image_path, tag_text)
             pbar.update(1)
             
             if stop_processing:
                 logger.info("Saving interrupted by user.")
                 break
 
-def main():
-    parser = argparse.ArgumentParser(description="Image Tagger")
-    parser.add_argument("--dir_image", type=str, required=True, help="Directory containing images or a single image file")
+def settings_key(args):
+    """キャプションの内容を決めるモデルとしきい値の識別子（ジャーナルに記録する）"""
+    key = f"{args.repo_id}|{args.general_threshold}|{args.character_threshold}"
+    if args.repo_id.endswith("@vote"):
+        key += f"|{args.ensemble_vote_ratio}"
+    return key
+
+def vote_settings(args):
+    """複数モデルの投票で確率をまとめる場合の、結果を左右する設定（それ以外は None）"""
+    if not args.repo_id.endswith("@vote"):
+        return None
+    return {
+        "general_threshold": args.general_threshold,
+        "character_threshold": args.character_threshold,
+        "vote_ratio": args.ensemble_vote_ratio,
+    }
+
+def load_journal(journal_path, key):
+    """ジャーナルから、最後に key の設定でキャプションを書いた画像の絶対パスの集合を返す"""
+    latest = {}
+    if not os.path.exists(journal_path):
+        return set()
+    with open(journal_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # 中断で途中までしか書かれなかった行
+            latest[entry["image"]] = entry["key"]
+    return {image for image, image_key in latest.items() if image_key == key}
+
+def filter_resumed(args, image_paths):
+    """同じモデル・しきい値で書いたキャプションが画像より新しい画像を除外する"""
+    done = load_journal(os.path.join(args.dir_save, JOURNAL_FILE), settings_key(args))
+    remaining = []
+    for image_path in image_paths:
+        if os.path.abspath(image_path) in done:
+            try:
+                if os.path.getmtime(get_caption_path(args, image_path)) >= os.path.getmtime(image_path):
+                    continue
+            except OSError:
+                pass
+        remaining.append(image_path)
+    logger.info(f"Resuming: skipping {len(image_paths) - len(remaining)} images that already have captions.")
+    return remaining
+
+class ProbabilityStore:
+    """
+    画像ごとのタグの確率ベクトルを float16 のシャード（probs_NNNNN.npy）と、対応する画像の絶対パスの一覧（probs_NNNNN.txt）に保存する
+    meta.json にモデルのタグ一覧とシャードの一覧を記録する。同じ画像が複数回保存された場合は最後のものを使う
+    投票でまとめた確率は投票時のしきい値に依存するので、その設定（vote）も記録し、異なる設定での追記を拒否する
+    """
+
+    SHARD_ROWS = 65536
+
+    def __init__(self, directory, repo_id=None, tags=None, vote=None):
+        self.directory = directory
+        self.meta_path = os.path.join(directory, "meta.json")
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                self.meta = json.load(f)
+            if repo_id is not None and (self.meta["repo_id"] != repo_id or self.meta["tags"] != tags):
+                raise ValueError(f"Probability store {directory} was written by a different model: {self.meta['repo_id']}")
+            if repo_id is not None and self.meta.get("vote") != vote:
+                raise ValueError(f"Probability store {directory} was written with different vote settings: {self.meta.get('vote')}")
+        elif repo_id is None:
+            raise FileNotFoundError(f"Probability store not found: {self.meta_path}")
+        else:
+            os.makedirs(directory, exist_ok=True)
+            self.meta = {"repo_id": repo_id, "tags": tags, "shards": []}
+            if vote is not None:
+                self.meta["vote"] = vote
+        self.pending_paths = []
+        self.pending_rows = []
+
+    def add(self, image_path, probs):
+        """確率ベクトルを追加し、シャードを書き出した（それまでに追加した分がディスクに残った）かどうかを返す"""
+        self.pending_paths.append(os.path.abspath(image_path))
+        self.pending_rows.append(probs)
+        if len(self.pending_rows) >= self.SHARD_ROWS:
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        """溜まっている確率ベクトルを新しいシャードとして書き出す"""
+        if not self.pending_rows:
+            return
+        name = f"probs_{len(self.meta['shards']):05d}"
+        np.save(os.path.join(self.directory, name + ".npy"), np.stack(self.pending_rows).astype(np.float16))
+        with open(os.path.join(self.directory, name + ".txt"), "w", encoding="utf-8") as f:
+            f.write("\n".join(self.pending_paths) + "\n")
+        self.meta["shards"].append({"name": name, "rows": len(self.pending_rows)})
+        # シャードを書き終えてから meta.json を置き換える（中断しても壊れたシャードを参照しない）
+        with open(self.meta_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.meta, f, ensure_ascii=False)
+        os.replace(self.meta_path + ".tmp", self.meta_path)
+        self.pending_paths = []
+        self.pending_rows = []
+
+    def close(self):
+        self.flush()
+
+    def iter_latest(self, chunk_rows=4096):
+        """各画像の最新の確率ベクトルを (パスのリスト, (N, 列数) の配列) のチャンクで返す"""
+        shard_paths = []
+        position = {}
+        offset = 0
+        for shard in self.meta["shards"]:
+            with open(os.path.join(self.directory, shard["name"] + ".txt"), "r", encoding="utf-8") as f:
+                paths = f.read().splitlines()
+            shard_paths.append(paths)
+            position.update(zip(paths, range(offset, offset + len(paths))))
+            offset += len(paths)
+
+        latest = np.zeros(offset, dtype=bool)
+        latest[np.fromiter(position.values(), dtype=np.int64, count=len(position))] = True
+
+        offset = 0
+        for shard, paths in zip(self.meta["shards"], shard_paths):
+            rows = np.flatnonzero(latest[offset:offset + len(paths)])
+            offset += len(paths)
+            probs = np.load(os.path.join(self.directory, shard["name"] + ".npy"), mmap_mode="r")
+            for start in range(0, len(rows), chunk_rows):
+                chunk = rows[start:start + chunk_rows]
+                if chunk[-1] - chunk[0] == len(chunk) - 1:
+                    # 連続した行は memmap をそのまま切り出して読む
+                    yield paths[chunk[0]:chunk[-1] + 1], np.asarray(probs[chunk[0]:chunk[-1] + 1])
+                else:
+                    yield [paths[i] for i in chunk], np.asarray(probs[chunk])
+
+class CaptionWriterError(RuntimeError):
+    """書き出しスレッドが続行できないエラー（確率ベクトルやジャーナルの書き込みの失敗）で止まった"""
+
+class CaptionWriter:
+    """
+    処理結果を上限付きキューで受け取り、専用スレッドで到着順にキャプションを書き出す
+    書き出すたびにジャーナルへ記録するので、中断しても書き終えた分は --resume で飛ばせる
+    store（ProbabilityStore）を渡すと確率ベクトルも同じスレッドで保存する。この場合のジャーナルへの記録は、
+    確率ベクトルがシャードとして書き出されるまで遅らせる（中断後の --resume で、確率ベクトルのない画像を飛ばさないように）
+    manifest（ShardManifest）を渡すと書き出した画像とタグをシャードのマニフェストに記録する
+    個々のキャプションの書き込みに失敗した画像は飛ばすが、それ以外のエラーで書き出しスレッドが止まった場合は
+    以降の put / close で CaptionWriterError を送出する（止まった後もキューは空にし続けるので、呼び出し側は詰まらない）
+    """
+
+    def __init__(self, args, queue_size=1024, store=None, manifest=None):
+        self.args = args
+        self.store = store
+        self.manifest = manifest
+        self.key = settings_key(args)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.journal = open(os.path.join(args.dir_save, JOURNAL_FILE), "a", encoding="utf-8")
+        self.written = 0
+        self.pending_journal = []
+        self.error = None
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def put(self, image_path, tag_text, probs=None):
+        self._raise_error()
+        self.queue.put((image_path, tag_text, probs))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is None:
+            if self.store is not None:
+                self.store.close()
+            self._flush_journal()
+        self.journal.close()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise CaptionWriterError(f"Caption writer stopped: {self.error}") from self.error
+
+    def _loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                # 止まった後は、呼び出し側がエラーに気付くまで届いた結果を捨てる
+                continue
+            try:
+                self._write(*item)
+            except Exception as e:
+                logger.error(f"Caption writer stopped: {e}")
+                logger.error(traceback.format_exc())
+                self.error = e
+
+    def _write(self, image_path, tag_text, probs):
+        deferred = self.store is not None and probs is not None
+        flushed = deferred and self.store.add(image_path, probs)
+        try:
+            write_caption(self.args, image_path, tag_text)
+        except Exception as e:
+            logger.error(f"Error writing caption for {image_path}: {e}")
+        else:
+            self.pending_journal.append(json.dumps({"image": os.path.abspath(image_path), "key": self.key}, ensure_ascii=False) + "\n")
+            if self.manifest is not None:
+                self.manifest.add(image_path, tag_text.split(self.args.caption_separator))
+            self.written += 1
+        if flushed or not deferred:
+            self._flush_journal()
+
+    def _flush_journal(self):
+        if self.pending_journal:
+            self.journal.writelines(self.pending_journal)
+            self.journal.flush()
+            self.pending_journal = []
+
+def regenerate_from_probs(args):
+    """保存済みの確率ベクトルから、推論せずに現在のしきい値・タグ設定でキャプションを作り直す"""
+    store = ProbabilityStore(args.from_probs)
+    tags = store.meta["tags"]
+    args.repo_id = store.meta["repo_id"]
+    vote = store.meta.get("vote")
+    if vote is not None:
+        # 投票でまとめた確率は、投票時と異なるしきい値では投票の結果を再現できない
+        if (args.general_threshold, args.character_threshold) != (vote["general_threshold"], vote["character_threshold"]):
+            raise ValueError(
+                f"{args.from_probs} holds vote-combined probabilities for general/character thresholds "
+                f"{vote['general_threshold']}/{vote['character_threshold']}; use the same thresholds or re-run the models"
+            )
+        args.ensemble_vote_ratio = vote["vote_ratio"]
+    selector = TagSelector(args, tags["rating"], tags["general"], tags["character"])
+
+    # --dir_image 以下の画像だけを対象にする
+    root = os.path.abspath(args.dir_image)
+    prefix = root if os.path.isfile(root) else os.path.join(root, "")
+    
+    writer = CaptionWriter(args)
+    try:
+        with tqdm(total=sum(shard["rows"] for shard in store.meta["shards"]), desc="Regenerating captions") as pbar:
+            for paths, probs in store.iter_latest():
+                for image_path, tag_text in zip(paths, selector.select(probs)):
+                    if image_path.startswith(prefix):
+                        writer.put(image_path, tag_text)
+                pbar.update(len(paths))
+                if stop_processing:
+                    break
+    finally:
+        writer.close()
+    logger.info(f"Wrote {writer.written} caption files from {args.from_probs}.")
+    return writer.written
+
+def autotune_cache_key(args, model):
+    """チューニング結果を使い回す単位（マシンとモデル）を表すキー"""
+    import onnxruntime as ort
+
+    onnx_path = os.path.abspath(get_onnx_path(args))
+    st = os.stat(onnx_path)
+    machine = f"{platform.node()}|{platform.machine()}|{psutil.cpu_count(logical=True)}/{psutil.cpu_count(logical=False)}|ort{ort.__version__}|{','.join(model.get_providers())}"
+    return f"{machine}|{onnx_path}|{st.st_size}|{st.st_mtime_ns}"
+
+def _time_inference(session, input_name, images, batch_size):
+    """前処理済みの画像をバッチに分けて推論し、1秒あたりの画像数を返す（バッチ次元が固定されたモデルでも動くよう、揃ったバッチだけを使う）"""
+    count = len(images) // batch_size * batch_size
+    session.run(None, {input_name: images[:batch_size]})  # ウォームアップ
+    start = time.perf_counter()
+    for i in range(0, count, batch_size):
+        session.run(None, {input_name: images[i:i + batch_size]})
+    return count / (time.perf_counter() - start)
+
+def autotune(args, model, input_name, tags):
+    """
+    データセットから抜き出した画像で、次の順に1項目ずつ最速の設定を探す（座標降下）
+      1. ONNX Runtime の intra_op / inter_op スレッド数と実行モード（推論のみ）
+      2. バッチサイズ（推論のみ）
+      3. 読み込み・前処理のスレッド数（process_images を通した全体）
+    結果はマシンとモデルごとにキャッシュし、次回からはベンチマークせずに使う
+    戻り値: 選んだ設定で作り直したモデル
+    """
+    import onnxruntime as ort
+
+    settings_keys = ["threads", "intra_op_threads", "inter_op_threads", "execution_mode", "batch_size"]
+    cache_key = autotune_cache_key(args, model)
+    cache = {}
+    if os.path.exists(AUTOTUNE_CACHE_PATH):
+        with open(AUTOTUNE_CACHE_PATH, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+
+    if cache_key in cache and not args.autotune_refresh:
+        best = cache[cache_key]
+        logger.info(f"Using cached autotune settings: {best}")
+    else:
+        image_paths = list_images(args)
+        random.Random(0).shuffle(image_paths)
+        images = []
+        sample_paths = []  # 読み込めた画像だけ（読み込めない画像が全体の計測に混ざらないように）
+        for image_path in image_paths:
+            if len(images) >= args.autotune_samples:
+                break
+            try:
+                images.append(load_image(image_path, args.exact_preprocess))
+            except Exception:
+                continue
+            sample_paths.append(image_path)
+        if not images:
+            logger.warning("Autotune skipped: no readable images.")
+            return model
+        images = np.stack(images).astype(np.float32)
+
+        # バッチ次元が固定されたモデルは、すべての計測をそのバッチサイズで行う
+        model_batch_size = model.get_inputs()[0].shape[0]
+        fixed_batch_size = model_batch_size if isinstance(model_batch_size, int) and model_batch_size > 0 else None
+        if fixed_batch_size is not None and len(images) < fixed_batch_size:
+            images = np.resize(images, (fixed_batch_size, *images.shape[1:]))  # 足りない分は画像を繰り返して1バッチにする
+
+        logical = psutil.cpu_count(logical=True)
+        physical = psutil.cpu_count(logical=False) or max(1, logical // 2)
+        onnx_path = get_onnx_path(args)
+        providers = model.get_providers()
+        trial_args = argparse.Namespace(**vars(args))
+        trial_args.batch_size = fixed_batch_size or min(8, len(images))
+
+        def session_for(trial):
+            trial_args.intra_op_threads, trial_args.inter_op_threads, trial_args.execution_mode = trial
+            return ort.InferenceSession(onnx_path, sess_options=create_session_options(trial_args), providers=providers)
+
+        # 1. セッションのスレッド設定
+        session_trials = [(n, 1, "sequential") for n in sorted({1, max(1, physical // 2), physical, logical})]
+        session_trials.append((max(1, physical // 2), 2, "parallel"))
+        # 各項目の最良値は最初の候補で初期化する（すべて 0 images/sec でも値が決まるように）
+        best_rate, best_session = 0.0, session_trials[0]
+        for trial in session_trials:
+            rate = _time_inference(session_for(trial), input_name, images, trial_args.batch_size)
+            logger.info(f"Autotune session intra={trial[0]} inter={trial[1]} mode={trial[2]}: {rate:.2f} images/sec")
+            if rate > best_rate:
+                best_rate, best_session = rate, trial
+        session = session_for(best_session)
+
+        # 2. バッチサイズ（バッチ次元が固定されたモデルはそのサイズのみ）
+        if fixed_batch_size is not None:
+            batch_sizes = [fixed_batch_size]
+        else:
+            batch_sizes = [b for b in (1, 4, 8, 16, 32) if b <= len(images)]
+        best_rate, best_batch_size = 0.0, batch_sizes[0]
+        for batch_size in batch_sizes:
+            rate = _time_inference(session, input_name, images, batch_size)
+            logger.info(f"Autotune batch_size={batch_size}: {rate:.2f} images/sec")
+            if rate > best_rate:
+                best_rate, best_batch_size = rate, batch_size
+        trial_args.batch_size = best_batch_size
+
+        # 3. 読み込み・前処理のスレッド数（推論スレッドと同時に動かした全体の速度で比べる）
+        # process_images には writer を渡さないので何も書き出さない。確率の保存やデバッグ出力も外し、
+        # 読み込み・前処理と推論（推論スレッドで行うタグの選択を含む）だけを計測する
+        trial_args = argparse.Namespace(**vars(trial_args))
+        trial_args.resume = False
+        trial_args.save_probs = None
+        trial_args.debug = False
+        thread_trials = sorted({1, max(1, physical // 2), physical, logical, int(physical * 1.5)})
+        best_rate, best_threads = 0.0, thread_trials[0]
+        for threads in thread_trials:
+            trial_args.threads = threads
+            start = time.perf_counter()
+            processed = process_images(trial_args, session, input_name, *tags, image_paths=sample_paths)
+            rate = len(processed) / (time.perf_counter() - start)
+            logger.info(f"Autotune decode threads={threads}: {rate:.2f} images/sec end to end")
+            if rate > best_rate:
+                best_rate, best_threads = rate, threads
+
+        best = {
+            "threads": best_threads,
+            "intra_op_threads": best_session[0],
+            "inter_op_threads": best_session[1],
+            "execution_mode": best_session[2],
+            "batch_size": best_batch_size,
+            "images_per_sec": round(best_rate, 2),
+        }
+        logger.info(f"Autotune selected: {best}")
+        cache[cache_key] = best
+        os.makedirs(os.path.dirname(AUTOTUNE_CACHE_PATH), exist_ok=True)
+        with open(AUTOTUNE_CACHE_PATH + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(cache, f, ensure_ascii=False, indent=2)
+        os.replace(AUTOTUNE_CACHE_PATH + ".tmp", AUTOTUNE_CACHE_PATH)
+
+    for key in settings_keys:
+        setattr(args, key, best[key])
+    return ort.InferenceSession(get_onnx_path(args), sess_options=create_session_options(args), providers=model.get_providers())
+
+_NOT_GIVEN = object()
+
+def parse_arguments(argv=None, serve=False):
+    parser = argparse.ArgumentParser(description="Image Tagger" if not serve else "Image Tagger server (usage: tagger_v3.py serve [options])")
+    parser.add_argument("--dir_image", type=str, required=not serve, help="Directory containing images or a single image file")
     parser.add_argument("--recursive", type=bool, default=True, help="Process subdirectories recursively")
     parser.add_argument("--dir_save", type=str, default="./output", help="Directory to save processed files")
     parser.add_argument("--preserve_own_folder", type=bool, default=True, help="Preserve the original folder structure")
     parser.add_argument("--preserve_structure", type=bool, default=True, help="Preserve the directory structure")
     parser.add_argument("--by_folder", action="store_true", help="Process each folder separately")
     parser.add_argument("--debug", action="store_true", help="Enable debug mode")
-    parser.add_argument("--repo_id", type=str, default=DEFAULT_WD14_TAGGER_REPO, help="Hugging Face repository ID for wd14 tagger")
+    parser.add_argument("--repo_id", type=str, nargs="+", default=[DEFAULT_WD14_TAGGER_REPO], help="Hugging Face repository ID for wd14 tagger (several IDs tag each image with all models and combine the results)")
+    parser.add_argument("--ensemble_reduction", type=str, default="max", choices=ModelEnsemble.REDUCTIONS, help="How to combine the probabilities of multiple models: max, mean, or vote")
+    parser.add_argument("--ensemble_vote_ratio", type=float, default=0.5, help="With --ensemble_reduction vote, the fraction of models that must pass the threshold for a tag to be kept")
     parser.add_argument("--model_dir", type=str, default="./models", help="Directory to store wd14 tagger model")
     parser.add_argument("--force_download", action="store_true", help="Force download of the model")
     parser.add_argument("--general_threshold", type=float, default=0.35, help="Threshold for general tags")
@@ -390,15 +1060,43 @@ def main():
     parser.add_argument("--always_first_tags", type=str, help="Comma-separated list of tags to always put first")
     parser.add_argument("--append_tags", action="store_true", help="Append new tags to existing caption files")
     parser.add_argument("--onnx", type=bool, default=True, help="Use ONNX runtime")
-    parser.add_argument("--batch_size", type=int, default=1, help="Batch size for processing")
-    parser.add_argument("--mem_cache", type=bool, default=True, help="Use memory cache")
+    parser.add_argument("--quantize", type=str, default="none", choices=["none", "dynamic"], help="Run an INT8 dynamically quantized copy of the ONNX model on CPU (created and cached next to model.onnx)")
+    parser.add_argument("--batch_size", type=int, default=1, help="Number of images per model call")
+    parser.add_argument("--batch_timeout", type=float, default=0.1, help="Seconds to wait for a partial batch to fill before running it")
+    parser.add_argument("--mem_cache", type=bool, default=True, help="Unused (captions are now written as they are produced)")
+    parser.add_argument("--shard", type=parse_shard, help="Process only the images assigned to shard K of N (K/N, by a stable hash of the path relative to --dir_image) and write shard_K_of_N.json to --dir_save; combine the shards with dataset_shard.py merge")
+    parser.add_argument("--save_probs", type=str, help="Also save each image's tag probabilities (float16 shards) to this directory for --from_probs")
+    parser.add_argument("--from_probs", type=str, help="Regenerate captions from probabilities saved with --save_probs instead of running the model")
+    parser.add_argument("--resume", action="store_true", help=f"Skip images whose caption was written by the same model and thresholds (per {JOURNAL_FILE} in --dir_save) and is newer than the image")
     # 新しい引数の追加
     parser.add_argument("--add_tag", type=str, help="Additional tags to add to all images (comma-separated)")
     parser.add_argument("--add_tag_position", type=str, default="first", choices=["first", "last"], 
                         help="Position to add the additional tags: 'first' (at the beginning) or 'last' (at the end)")
     parser.add_argument("--threads", type=int, help="Number of threads to use for processing (default: auto-detected)")
+    parser.add_argument("--intra_op_threads", type=int, default=0, help="ONNX Runtime intra-op threads (default: 0 = runtime default)")
+    parser.add_argument("--inter_op_threads", type=int, default=0, help="ONNX Runtime inter-op threads (default: 0 = runtime default)")
+    parser.add_argument("--execution_mode", type=str, default="sequential", choices=["sequential", "parallel"], help="ONNX Runtime execution mode")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address the server listens on (serve mode)")
+    parser.add_argument("--port", type=int, default=DEFAULT_SERVER_PORT, help=f"Port the server listens on (serve mode, default: {DEFAULT_SERVER_PORT})")
+    parser.add_argument("--server", type=str, help="Send this job to a running 'tagger_v3.py serve' at this URL (e.g. http://127.0.0.1:%d) instead of loading the model" % DEFAULT_SERVER_PORT)
+    parser.add_argument("--autotune", action="store_true", help="Benchmark thread counts, execution mode and batch size on a sample of the dataset and use the fastest (cached per machine and model)")
+    parser.add_argument("--autotune_samples", type=int, default=64, help="Number of images used by --autotune")
+    parser.add_argument("--autotune_refresh", action="store_true", help="Ignore the cached --autotune result and benchmark again")
+    parser.add_argument("--max_data_loader_n_workers", type=int, default=None, help="Load and preprocess images in this many DataLoader worker processes (default: disabled)")
+    parser.add_argument("--exact_preprocess", action="store_true", help="Pad at full resolution and then resize, as earlier versions did (slower and uses more memory than the default reduced-scale decode)")
+
+    args = parser.parse_args(argv)
+    # 既定値ではなく明示的に指定された引数（serve でサーバー側の設定と食い違う指定を見つけるのに使う）
+    # 既に属性がある Namespace には argparse が既定値を入れないので、印を付けた Namespace で解析し直す
+    given = argparse.Namespace(**{key: _NOT_GIVEN for key in vars(args)})
+    parser.parse_args(argv, namespace=given)
+    args.given_args = {key for key, value in vars(given).items() if value is not _NOT_GIVEN}
+    if args.shard and args.from_probs:
+        parser.error("--shard cannot be used with --from_probs")
 
-    args = parser.parse_args()
+    # 複数モデルの場合、repo_id はモデルの組み合わせと集約方法を表す識別子にする（ジャーナルや確率の保存で使う）
+    args.repo_ids = args.repo_id
+    args.repo_id = args.repo_ids[0] if len(args.repo_ids) == 1 else "+".join(args.repo_ids) + f"@{args.ensemble_reduction}"
 
     # スレッド数自動設定
     if args.threads is None or args.threads <= 0:
@@ -408,27 +1106,241 @@ def main():
 
     args.undesired_tags = set(args.undesired_tags.split(",")) if args.undesired_tags else set()
     args.always_first_tags = args.always_first_tags.split(",") if args.always_first_tags else []
+    # --preserve_own_folder の親フォルダ名は --dir_image の書き方（相対パスかどうか）で決まるので、
+    # serve がクライアントのカレントディレクトリを補う前の、指定されたとおりのパスから求めておく
+    dir_image = getattr(args, "dir_image", None)
+    args.own_folder = os.path.basename(os.path.dirname(dir_image)) if dir_image else ""
+    return args
+
+def fit_batch_size(args, model):
+    """ONNXモデルのバッチ次元が固定されている場合は --batch_size をそれに合わせる"""
+    if not args.onnx:
+        return
+    model_batch_size = model.get_inputs()[0].shape[0]
+    if isinstance(model_batch_size, int) and model_batch_size > 0 and model_batch_size != args.batch_size:
+        logger.warning(f"Batch size {args.batch_size} doesn't match the model's fixed batch size {model_batch_size}, using {model_batch_size}")
+        args.batch_size = model_batch_size
+
+def run_job(args, model, input_name, tags):
+    """読み込み済みのモデルで1回分のタグ付けを行い、書き出したキャプション数を返す"""
+    os.makedirs(args.dir_save, exist_ok=True)
+    if args.from_probs:
+        return regenerate_from_probs(args)
 
+    rating_tags, general_tags, character_tags = tags
+    image_paths = list_images(args)
+    logger.info(f"Found {len(image_paths)} images.")
+    manifest = None
+    if args.shard:
+        manifest = ShardManifest(args.dir_save, args.shard, args.dir_image, settings_key(args), resume=args.resume)
+        manifest.assign(image_paths)
+    if args.resume:
+        remaining = filter_resumed(args, image_paths)
+        if manifest is not None:
+            # 前回までにキャプションを書き終えた画像もこのシャードで処理済みとして記録する
+            for image_path in set(image_paths).difference(remaining):
+                manifest.add(image_path)
+        image_paths = remaining
+
+    logger.info("Starting image processing...")
+    # キャプションは処理と並行して書き出す（中断しても書き終えた分は残る）
+    store = None
+    if args.save_probs:
+        store_tags = {"rating": rating_tags, "general": general_tags, "character": character_tags}
+        store = ProbabilityStore(args.save_probs, args.repo_id, store_tags, vote_settings(args))
+    writer = CaptionWriter(args, store=store, manifest=manifest)
     try:
-        os.makedirs(args.dir_save, exist_ok=True)
+        process_images(args, model, input_name, rating_tags, general_tags, character_tags, writer, image_paths)
+    finally:
+        try:
+            writer.close()
+        finally:
+            if manifest is not None:
+                manifest.save()
+    logger.info(f"Wrote {writer.written} caption files.")
+    if manifest is not None:
+        logger.info(f"Wrote shard manifest {manifest.path}.")
+    return writer.written
 
-        logger.info(f"Loading model: {args.repo_id}")
-        model, input_name = load_model(args)
-        
-        logger.info("Loading tags...")
-        rating_tags, general_tags, character_tags = load_tags(os.path.join(args.model_dir, args.repo_id.replace("/", "_")))
-        
-        logger.info("Starting image processing...")
-        results = process_images(args, model, input_name, rating_tags, general_tags, character_tags)
-
-        if not stop_processing:
-            if args.mem_cache:
-                save_results(args, results)
-            else:
-                for result in results:
-                    if stop_processing:
-                        break
-                    save_results(args, [result])
+def load_ensemble(args):
+    """--repo_id に指定した全モデルを読み込み、EnsembleSession とまとめたタグ表を返す"""
+    sessions = []
+    tag_tables = []
+    for repo_id in args.repo_ids:
+        model_args = argparse.Namespace(**vars(args))
+        model_args.repo_id = repo_id
+        logger.info(f"Loading model: {repo_id}")
+        session, _ = load_model(model_args)
+        fit_batch_size(model_args, session)
+        if model_args.batch_size != args.batch_size:
+            # バッチ次元が固定されたモデルがあれば、全モデルをそのバッチサイズで実行する
+            if sessions and any(s.get_inputs()[0].shape[0] != model_args.batch_size for s in sessions):
+                raise ValueError(f"{repo_id} has a fixed batch size that the other models cannot use")
+            args.batch_size = model_args.batch_size
+        if sessions and session.get_inputs()[0].shape[1:] != sessions[0].get_inputs()[0].shape[1:]:
+            raise ValueError(f"{repo_id} expects a different input shape: {session.get_inputs()[0].shape}")
+        sessions.append(session)
+        tag_tables.append(load_tags(os.path.join(args.model_dir, repo_id.replace("/", "_"))))
+
+    ensemble = ModelEnsemble(tag_tables, args.ensemble_reduction)
+    logger.info(f"Ensemble of {len(sessions)} models ({args.ensemble_reduction}): {ensemble.n_columns - 4} tags in total")
+    model = EnsembleSession(sessions, ensemble, args)
+    return model, model.input_names[0], ensemble.tags
+
+def load_tagger(args):
+    """モデルとタグを読み込む（--autotune の場合は設定を決めてからセッションを作り直す）"""
+    if len(args.repo_ids) > 1:
+        if not args.onnx:
+            raise ValueError("Multiple --repo_id models require ONNX runtime")
+        if args.autotune:
+            logger.warning("--autotune is not supported with multiple models, using the given settings.")
+        return load_ensemble(args)
+
+    logger.info(f"Loading model: {args.repo_id}")
+    model, input_name = load_model(args)
+    fit_batch_size(args, model)
+    
+    logger.info("Loading tags...")
+    tags = load_tags(os.path.join(args.model_dir, args.repo_id.replace("/", "_")))
+    
+    if args.autotune:
+        if args.onnx:
+            model = autotune(args, model, input_name, tags)
+        else:
+            logger.warning("--autotune is only supported with ONNX models.")
+    return model, input_name, tags
+
+# サーバー側のモデルとその実行設定に従う引数（ジョブでサーバーと異なる値を指定した場合は拒否する）
+SERVER_OWNED_ARGS = [
+    "repo_id", "repo_ids", "ensemble_reduction", "model_dir", "onnx", "quantize", "batch_size", "batch_timeout", "threads",
+    "intra_op_threads", "inter_op_threads", "execution_mode", "max_data_loader_n_workers",
+]
+
+# クライアントのカレントディレクトリを基準に解決するパスの引数
+PATH_ARGS = ["dir_image", "dir_save", "save_probs", "from_probs"]
+
+def serve(args):
+    """
+    モデルとタグ表を読み込んだまま常駐し、localhost の HTTP でジョブを受け付ける
+      POST /job    {"argv": [通常のCLI引数...], "cwd": クライアントのカレントディレクトリ}
+      GET  /health 読み込み済みのモデルと実行設定
+    ジョブは1つずつ順番に処理する（推論セッションを共有するため）
+    """
+    model, input_name, tags = load_tagger(args)
+
+    class TaggerRequestHandler(BaseHTTPRequestHandler):
+        def _respond(self, status, body):
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path != "/health":
+                self._respond(404, {"error": f"Unknown path: {self.path}"})
+                return
+            self._respond(200, {"status": "ok", **{key: getattr(args, key) for key in SERVER_OWNED_ARGS}})
+
+        def do_POST(self):
+            if self.path != "/job":
+                self._respond(404, {"error": f"Unknown path: {self.path}"})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                job_args = parse_arguments(request["argv"])
+            except SystemExit:
+                self._respond(400, {"error": "Invalid arguments (see the server log)"})
+                return
+            except (ValueError, KeyError) as e:
+                self._respond(400, {"error": f"Invalid request: {e}"})
+                return
+
+            # 省略形（--repo）や --key=value の形でも、解析した値でサーバーの設定と比べる
+            conflicts = {
+                key: getattr(args, key) for key in SERVER_OWNED_ARGS
+                if key in job_args.given_args and getattr(job_args, key) != getattr(args, key)
+            }
+            if conflicts:
+                self._respond(400, {"error": f"This server runs with {conflicts}; restart it to use other values"})
+                return
+            for key in SERVER_OWNED_ARGS:
+                setattr(job_args, key, getattr(args, key))
+            for key in PATH_ARGS:
+                if getattr(job_args, key):
+                    setattr(job_args, key, os.path.join(request.get("cwd", ""), getattr(job_args, key)))
+
+            start = time.perf_counter()
+            try:
+                written = run_job(job_args, model, input_name, tags)
+            except Exception as e:
+                logger.error(f"Job failed: {e}")
+                logger.error(traceback.format_exc())
+                self._respond(500, {"error": str(e)})
+                return
+            self._respond(200, {"written": written, "seconds": round(time.perf_counter() - start, 3), "interrupted": stop_processing})
+
+        def log_message(self, format, *log_args):
+            logger.info(f"{self.address_string()} {format % log_args}")
+
+    server = HTTPServer((args.host, args.port), TaggerRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Serving {args.repo_id} on http://{args.host}:{args.port}")
+
+    # シグナルで停止フラグが立つまで待つ（処理中のジョブはそこで止まり、書き終えたキャプションは残る）
+    while not stop_processing:
+        time.sleep(0.5)
+    server.shutdown()
+    server.server_close()
+    logger.info("Server stopped.")
+
+def submit_job(args, argv):
+    """--server で指定したサーバーにジョブを送り、結果を待つ"""
+    # --server とその値はサーバーに渡さない
+    job_argv = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == "--server":
+            skip = True
+        elif not arg.startswith("--server="):
+            job_argv.append(arg)
+
+    body = json.dumps({"argv": job_argv, "cwd": os.getcwd()}).encode("utf-8")
+    request = urllib.request.Request(args.server.rstrip("/") + "/job", data=body, headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request) as response:
+            result = json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        result = json.loads(e.read() or b"{}")
+        logger.error(f"Server error ({e.code}): {result.get('error', e.reason)}")
+        sys.exit(1)
+    except urllib.error.URLError as e:
+        logger.error(f"Could not reach the server at {args.server}: {e.reason}")
+        sys.exit(1)
+    logger.info(f"Server wrote {result['written']} caption files in {result['seconds']} seconds.")
+    if result.get("interrupted"):
+        logger.warning("The job was interrupted on the server.")
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        serve(parse_arguments(sys.argv[2:], serve=True))
+        return
+
+    args = parse_arguments()
+
+    if args.server:
+        submit_job(args, sys.argv[1:])
+        return
+
+    try:
+        if args.from_probs:
+            run_job(args, None, None, None)
+        else:
+            model, input_name, tags = load_tagger(args)
+            run_job(args, model, input_name, tags)
 
         logger.info("Processing completed." if not stop_processing else "Processing was interrupted.")
         
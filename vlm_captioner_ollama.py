@@ -22,6 +22,8 @@ import shutil
 import logging
 from urllib.parse import urlparse
 
+from dataset_shard import ShardManifest, parse_shard, select_shard
+
 # シグナルハンドリング
 def signal_handler(sig, frame):
     print("\nプログラムを停止しています...")
@@ -252,7 +254,7 @@ def generate_caption_with_retry(args, image_base64: str, retry_count: int = 3, r
     logger.error(f"キャプション生成が失敗しました。両方のエンドポイントで{retry_count}回試行しました。")
     return "Caption generation failed."
 
-def process_image(args, image_path: str, save_path: str, results: Dict) -> Optional[str]:
+def process_image(args, image_path: str, save_path: str, results: Dict, manifest: Optional[ShardManifest] = None) -> Optional[str]:
     """単一画像を処理する関数"""
     try:
         # レート制限の処理
@@ -281,7 +283,8 @@ def process_image(args, image_path: str, save_path: str, results: Dict) -> Optio
             }
         else:
             # メモリキャッシュが無効なら直接保存
-            save_caption(caption, save_path)
+            if save_caption(caption, save_path) and manifest is not None:
+                manifest.add(image_path)
         
         return caption
     except Exception as e:
@@ -383,6 +386,8 @@ def main():
     parser.add_argument('--mem_cache', action='store_true', default=True, help='処理結果をメモリにキャッシュするかどうか')
     parser.add_argument('--threads', type=int, default=None, help='使用するスレッド数')
     parser.add_argument('--skip_connection_test', action='store_true', help='接続テストをスキップ')
+    parser.add_argument('--shard', type=parse_shard, help='K/N: --dir_image からの相対パスのハッシュでN分割したうちK番目の画像だけを処理する（dataset_shard.py merge で結果をまとめる）')
+    parser.add_argument('--resume', action='store_true', help='キャプションファイルが既にある画像をスキップする（--shard 指定時は前回のマニフェストに追記する）')
     
     # Ollama API関連の引数
     parser.add_argument('--api_base', default='http://localhost:11434', help='Ollama APIベースURL')
@@ -454,27 +459,55 @@ def main():
     if args.add_tag:
         logger.info(f"追加タグ: {args.add_tag} (位置: {args.add_tag_position})")
     
-    # フォルダごと処理するかの分岐
-    if args.by_folder and os.path.isdir(args.dir_image):
-        folders = [f.path for f in os.scandir(args.dir_image) if f.is_dir()]
-        logger.info(f"{len(folders)}個のフォルダを処理します")
-        for folder in folders:
-            process_directory(args, folder)
-    else:
-        process_directory(args, args.dir_image)
+    # シャードのマニフェスト（複数マシンで分担する場合）
+    manifest = None
+    if args.shard:
+        manifest = ShardManifest(args.dir_save, args.shard, args.dir_image, args.model, resume=args.resume)
+        logger.info(f"シャード: {args.shard[0]}/{args.shard[1]}")
+    
+    try:
+        # フォルダごと処理するかの分岐
+        if args.by_folder and os.path.isdir(args.dir_image):
+            folders = [f.path for f in os.scandir(args.dir_image) if f.is_dir()]
+            logger.info(f"{len(folders)}個のフォルダを処理します")
+            for folder in folders:
+                process_directory(args, folder, manifest)
+        else:
+            process_directory(args, args.dir_image, manifest)
+    finally:
+        # 中断（SIGINT/SIGTERM）やエラーで止まった場合も、それまでに書き出した分のマニフェストを残す
+        if manifest is not None:
+            manifest.save()
+            logger.info(f"シャードのマニフェストを保存しました: {manifest.path}")
     
     logger.info("すべての処理が完了しました")
 
-def process_directory(args, directory):
+def process_directory(args, directory, manifest: Optional[ShardManifest] = None):
     """ディレクトリ内の画像を処理する関数"""
     logger.info(f"処理対象ディレクトリ: {directory}")
     
-    # 画像ファイルのリストを取得
-    image_files = get_image_files(directory, args.recursive)
+    # 画像ファイルのリストを取得（シャード指定時は割り当てられた画像だけ）
+    image_files = select_shard(get_image_files(directory, args.recursive), args.dir_image, args.shard)
+    if manifest is not None:
+        manifest.assign(image_files)
     if not image_files:
         logger.warning(f"処理対象の画像ファイルが見つかりませんでした: {directory}")
         return
     
+    if args.resume:
+        # キャプションを書き出し済みの画像は処理済みとしてマニフェストに記録し、スキップする
+        remaining = []
+        for img_path in image_files:
+            if os.path.exists(get_save_path(args, img_path)):
+                if manifest is not None:
+                    manifest.add(img_path)
+            else:
+                remaining.append(img_path)
+        logger.info(f"{len(image_files) - len(remaining)} 個の画像は処理済みのためスキップします")
+        image_files = remaining
+        if not image_files:
+            return
+    
     logger.info(f"合計 {len(image_files)} 個の画像を処理します")
     
     # 結果を格納するディクショナリ
@@ -496,26 +529,33 @@ def process_directory(args, directory):
         with tqdm(total=len(image_files), desc="画像キャプション生成中") as progress_bar:
             # 画像処理のタスクをスケジュール
             futures = [
-                executor.submit(process_image, args, img_path, save_path, results)
+                executor.submit(process_image, args, img_path, save_path, results, manifest)
                 for img_path, save_path in zip(image_files, save_paths)
             ]
             
             # 完了したタスクを処理
-            for future in futures:
-                try:
-                    future.result()
-                    progress_bar.update(1)
-                except Exception as e:
-                    logger.error(f"タスク実行中にエラーが発生しました: {str(e)}")
-                    if args.debug:
-                        traceback.print_exc()
+            try:
+                for future in futures:
+                    try:
+                        future.result()
+                        progress_bar.update(1)
+                    except Exception as e:
+                        logger.error(f"タスク実行中にエラーが発生しました: {str(e)}")
+                        if args.debug:
+                            traceback.print_exc()
+            except SystemExit:
+                # 中断時はまだ始まっていないタスクを取り消し、実行中のものだけを待ってマニフェストの保存に進む
+                for future in futures:
+                    future.cancel()
+                raise
     
     # メモリキャッシュが有効なら、処理完了後にまとめて保存
     if args.mem_cache and results:
         logger.info("キャプションをファイルに保存しています...")
         with tqdm(total=len(results), desc="ファイル保存中") as progress_bar:
             for image_path, data in results.items():
-                save_caption(data["caption"], data["save_path"])
+                if save_caption(data["caption"], data["save_path"]) and manifest is not None:
+                    manifest.add(image_path)
                 progress_bar.update(1)
     
     logger.info(f"{len(image_files)} 個の画像の処理が完了しました")
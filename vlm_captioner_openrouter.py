@@ -21,6 +21,8 @@ from typing import List, Dict, Any, Optional, Tuple, Union
 import requests
 from tqdm import tqdm
 
+from dataset_shard import ShardManifest, parse_shard, select_shard
+
 # グローバル変数
 DEBUG = False
 TERMINATE = False
@@ -52,6 +54,7 @@ def signal_handler(sig, frame):
 
 
 signal.signal(signal.SIGINT, signal_handler)
+signal.signal(signal.SIGTERM, signal_handler)
 
 
 def parse_arguments():
@@ -94,6 +97,10 @@ def parse_arguments():
                       help="メモリキャッシュを有効にするか")
     parser.add_argument("--threads", type=int, default=DEFAULT_THREADS, 
                       help=f"使用するスレッド数 (デフォルト: {DEFAULT_THREADS})")
+    parser.add_argument("--shard", type=parse_shard, 
+                      help="K/N: --dir_image からの相対パスのハッシュでN分割したうちK番目の画像だけを処理する（dataset_shard.py merge で結果をまとめる）")
+    parser.add_argument("--resume", action="store_true", 
+                      help="キャプションファイルが既にある画像をスキップする（--shard 指定時は前回のマニフェストに追記する）")
     
     args = parser.parse_args()
     
@@ -442,12 +449,13 @@ def process_image(
         }
 
 
-def save_results(results: List[Dict[str, Any]]) -> Tuple[int, int]:
+def save_results(results: List[Dict[str, Any]], manifest: Optional[ShardManifest] = None) -> Tuple[int, int]:
     """
     結果をファイルに保存
     
     Args:
         results: 処理結果のリスト
+        manifest: 保存できた画像を記録するシャードのマニフェスト
         
     Returns:
         (成功件数, 失敗件数)
@@ -468,6 +476,8 @@ def save_results(results: List[Dict[str, Any]]) -> Tuple[int, int]:
             with open(result["output_path"], 'w', encoding='utf-8') as f:
                 f.write(result["caption"])
             
+            if manifest is not None:
+                manifest.add(result["path"])
             success_count += 1
             
         except Exception as e:
@@ -477,13 +487,14 @@ def save_results(results: List[Dict[str, Any]]) -> Tuple[int, int]:
     return success_count, failure_count
 
 
-def process_directory(args, target_dir: str = None) -> None:
+def process_directory(args, target_dir: str = None, manifest: Optional[ShardManifest] = None) -> None:
     """
     指定されたディレクトリを処理
     
     Args:
         args: コマンドライン引数
         target_dir: 処理対象ディレクトリ (None の場合は args.dir_image を使用)
+        manifest: シャードのマニフェスト (--shard 指定時)
     """
     global DEBUG
     DEBUG = args.debug
@@ -494,12 +505,31 @@ def process_directory(args, target_dir: str = None) -> None:
     dir_to_process = target_dir if target_dir else args.dir_image
     logger.info(f"処理開始: {dir_to_process}")
     
-    # 画像ファイルのリストを取得
-    image_files = get_image_files(dir_to_process, args.recursive)
+    # 画像ファイルのリストを取得（シャード指定時は割り当てられた画像だけ）
+    image_files = select_shard(get_image_files(dir_to_process, args.recursive), args.dir_image, args.shard)
+    if manifest is not None:
+        manifest.assign(image_files)
     if not image_files:
         logger.warning(f"処理対象の画像ファイルが見つかりませんでした: {dir_to_process}")
         return
     
+    if args.resume:
+        # キャプションを書き出し済みの画像は処理済みとしてマニフェストに記録し、スキップする
+        remaining = []
+        for image_path in image_files:
+            output_path = get_output_path(
+                image_path, dir_to_process, args.dir_save, args.preserve_own_folder, args.preserve_structure
+            )
+            if os.path.exists(output_path):
+                if manifest is not None:
+                    manifest.add(image_path)
+            else:
+                remaining.append(image_path)
+        logger.info(f"{len(image_files) - len(remaining)}個の画像は処理済みのためスキップします")
+        image_files = remaining
+        if not image_files:
+            return
+    
     logger.info(f"{len(image_files)}個の画像ファイルを処理します")
     
     # マルチスレッド処理の準備
@@ -539,7 +569,7 @@ def process_directory(args, target_dir: str = None) -> None:
                     results.append(result)
                 else:
                     # メモリキャッシュを使用しない場合は即時保存
-                    save_results([result])
+                    save_results([result], manifest)
                 pbar.update(1)
                 
                 if TERMINATE:
@@ -548,7 +578,7 @@ def process_directory(args, target_dir: str = None) -> None:
     # メモリキャッシュを使用している場合は、全処理完了後に一括保存
     if args.mem_cache and results:
         logger.info("キャプションをファイルに保存しています...")
-        success_count, failure_count = save_results(results)
+        success_count, failure_count = save_results(results, manifest)
         logger.info(f"処理完了: 成功={success_count}, 失敗={failure_count}")
     
     logger.info(f"ディレクトリ処理完了: {dir_to_process}")
@@ -558,20 +588,33 @@ def main():
     """メイン関数"""
     args = parse_arguments()
     
-    # by_folder オプションの処理
-    if args.by_folder and os.path.isdir(args.dir_image):
-        # 対象ディレクトリ内のサブディレクトリを個別に処理
-        for item in os.listdir(args.dir_image):
-            item_path = os.path.join(args.dir_image, item)
-            if os.path.isdir(item_path):
-                process_directory(args, item_path)
-                
-                if TERMINATE:
-                    logger.info("処理を中断しました")
-                    break
-    else:
-        # 1つのディレクトリとして処理
-        process_directory(args)
+    # シャードのマニフェスト（複数マシンで分担する場合）
+    manifest = None
+    if args.shard:
+        manifest = ShardManifest(args.dir_save, args.shard, args.dir_image, args.model, resume=args.resume)
+        logger.info(f"シャード: {args.shard[0]}/{args.shard[1]}")
+    
+    try:
+        # by_folder オプションの処理
+        if args.by_folder and os.path.isdir(args.dir_image):
+            # 対象ディレクトリ内のサブディレクトリを個別に処理
+            for item in os.listdir(args.dir_image):
+                item_path = os.path.join(args.dir_image, item)
+                if os.path.isdir(item_path):
+                    process_directory(args, item_path, manifest)
+                    
+                    if TERMINATE:
+                        logger.info("処理を中断しました")
+                        break
+        else:
+            # 1つのディレクトリとして処理
+            process_directory(args, manifest=manifest)
+    finally:
+        # 中断やエラーで止まった場合も、それまでに書き出した分のマニフェストを残す
+        if manifest is not None:
+            os.makedirs(args.dir_save, exist_ok=True)
+            manifest.save()
+            logger.info(f"シャードのマニフェストを保存しました: {manifest.path}")
     
     logger.info("すべての処理が完了しました")
 
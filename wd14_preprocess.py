@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import cv2
+import numpy as np
+from PIL import Image
+
+# WD14タガーの入力画像の前処理（白で正方形にパディングした 448x448 の BGR 画像）
+# （tagger / tagger_v3 / image_cleaner_v7 の埋め込みから import して使う）
+
+# 画像サイズの定義
+IMAGE_SIZE = 448
+
+def preprocess_image(image):
+    image = np.array(image)
+    image = image[:, :, ::-1]  # RGB->BGR
+
+    # パディングを正方形に
+    size = max(image.shape[0:2])
+    pad_x = size - image.shape[1]
+    pad_y = size - image.shape[0]
+    pad_l = pad_x // 2
+    pad_t = pad_y // 2
+    image = np.pad(image, ((pad_t, pad_y - pad_t), (pad_l, pad_x - pad_l), (0, 0)), mode="constant", constant_values=255)
+
+    interp = cv2.INTER_AREA if size > IMAGE_SIZE else cv2.INTER_LANCZOS4
+    image = cv2.resize(image, (IMAGE_SIZE, IMAGE_SIZE), interpolation=interp)
+
+    image = image.astype(np.float32)
+    return image
+
+def load_image(image_path, exact=False):
+    """
+    画像を読み込み、モデル入力の 448x448 BGR 画像（uint8）にする
+    JPEG は Image.draft で縮小してデコードし、縮小してから白いキャンバスに貼り付けて正方形にする
+    （元の解像度でのパディングや float32 の中間配列を作らない。float32 への変換はバッチをまとめるときに行う）
+    exact=True の場合は preprocess_image と同じ処理（元の解像度でパディングしてから縮小）を行う
+    """
+    with Image.open(image_path) as image:
+        if exact:
+            return preprocess_image(image.convert("RGB"))
+
+        width, height = image.size
+        scale = IMAGE_SIZE / max(width, height)
+        new_width, new_height = max(1, round(width * scale)), max(1, round(height * scale))
+        # 縮小後のサイズ以上を保つ範囲で、できるだけ小さい倍率（1/2, 1/4, 1/8）でデコードする
+        image.draft("RGB", (new_width, new_height))
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        array = np.asarray(image)
+
+    if array.shape[:2] != (new_height, new_width):
+        interp = cv2.INTER_AREA if max(array.shape[:2]) > IMAGE_SIZE else cv2.INTER_LANCZOS4
+        array = cv2.resize(array, (new_width, new_height), interpolation=interp)
+
+    canvas = np.full((IMAGE_SIZE, IMAGE_SIZE, 3), 255, dtype=np.uint8)
+    top = (IMAGE_SIZE - new_height) // 2
+    left = (IMAGE_SIZE - new_width) // 2
+    canvas[top:top + new_height, left:left + new_width] = array[:, :, ::-1]  # RGB->BGR
+    return canvas